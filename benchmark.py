@@ -0,0 +1,282 @@
+"""
+  *Load generator and latency benchmark for ServerApp
+  *
+  *python benchmark.py --connections 16 --duration 10 --output run.json
+  *python benchmark.py --rate 2000 --mix read_table=8,read_columnar=1,insert=1
+  *
+  *Without --host the server is started in-process on a MemoryDB, so the
+  *numbers measure the protocol and server path, not PostgreSQL.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import socket
+import asyncio
+import argparse
+import datetime
+import platform
+import threading
+import contextlib
+import logging as log
+
+import server as server_app
+import libs.messenger_client as msg_client
+from libs.memory_db import MemoryDB
+from libs.columnar import COLUMNAR_CONTENT_TYPE
+
+
+def seed(data_base, organizations=10, departments=10, persons=20):
+    """organizations x departments x persons rows linked by uni_codes
+    """
+    uni_code = iter(range(100000, sys.maxsize))
+    for _ in range(organizations):
+        department_codes = []
+        for _ in range(departments):
+            person_rows = []
+            for _ in range(persons):
+                person_rows.append((
+                    f'person {len(person_rows)}',
+                    datetime.date(1970, 1, 1) + datetime.timedelta(
+                        days=random.randrange(20000)),
+                    random.randrange(1000, 10000), next(uni_code)))
+            data_base.insert_rows(
+                'person', ['name', 'birth_day', 'salary_month_USD',
+                           'uni_code'], person_rows)
+            code = next(uni_code)
+            department_codes.append(code)
+            data_base.insert_rows(
+                'department', ['name', 'uni_code', 'persons_uni_codes'],
+                [(f'department {code}', code,
+                  [row[3] for row in person_rows])])
+        code = next(uni_code)
+        data_base.insert_rows(
+            'organization', ['name', 'uni_code', 'department_uni_codes'],
+            [(f'organization {code}', code, department_codes)])
+
+
+def start_local_server(addr, latency, db_workers):
+    """ServerApp on a seeded MemoryDB in a background thread
+    """
+    db_tables = ('organization', 'department', 'person')
+    data_base = MemoryDB(db_tables, latency=latency,
+                         max_connections=db_workers)
+    data_base.migrate()
+    app = server_app.ServerApp(addr, data_base, db_workers=db_workers,
+                               init_db=False)
+    seed(data_base)
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(
+        target=loop.run_until_complete, args=(app.run_server(),),
+        daemon=True)
+    thread.start()
+    for _ in range(100):
+        try:
+            socket.create_connection(addr, timeout=1).close()
+            return app
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"Server on {addr} did not start")
+
+
+def _json_request(action, value=None, **fields):
+    content = dict(action=action, value=value, **fields)
+    return dict(type="text/json", encoding="utf-8", content=content)
+
+
+def make_request(kind, rng):
+    """request of the given mix kind
+    """
+    if kind == 'read_table':
+        return _json_request('read_table')
+    if kind == 'read_columnar':
+        return _json_request('read_table', accept=COLUMNAR_CONTENT_TYPE)
+    if kind == 'insert':
+        code = rng.randrange(10 ** 9)
+        return _json_request('batch', [dict(
+            action='insert', table='person',
+            columns=['name', 'birth_day', 'salary_month_USD', 'uni_code'],
+            rows=[[f'bench {code}', '1990-01-01', 5000, code]])])
+    if kind == 'binary':
+        return dict(type="binary/custom-client-binary-type",
+                    encoding="binary", content=os.urandom(64))
+    raise ValueError(f'Unknown request kind "{kind}".')
+
+
+def parse_mix(mix):
+    """"read_table=8,insert=1" -> (kinds, weights)
+    """
+    kinds, weights = [], []
+    for item in mix.split(','):
+        kind, _, weight = item.partition('=')
+        kinds.append(kind.strip())
+        weights.append(float(weight or 1))
+    for kind in kinds:
+        make_request(kind, random.Random(0))
+    return kinds, weights
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1,
+                int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+class Worker(threading.Thread):
+    """one keep-alive connection sending requests in a closed loop, or at
+      *a fixed rate (open loop) when interval is set. In open loop latency
+      *counts from the scheduled send time, so a stalled server is not
+      *hidden by the generator waiting for it.
+    """
+    def __init__(self, addr, kinds, weights, deadline, interval, seed,
+                 version, compression=False):
+        super().__init__(daemon=True)
+        self.addr = addr
+        self.kinds = kinds
+        self.weights = weights
+        self.deadline = deadline
+        self.interval = interval
+        self.rng = random.Random(seed)
+        self.version = version
+        self.compression = compression
+        self.samples = {kind: [] for kind in kinds}
+        self.errors = 0
+
+    def run(self):
+        connection = self._connect()
+        scheduled = time.perf_counter()
+        try:
+            while True:
+                if self.interval:
+                    scheduled += self.interval
+                    delay = scheduled - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+                start = scheduled if self.interval else time.perf_counter()
+                if start >= self.deadline:
+                    break
+                kind = self.rng.choices(self.kinds, self.weights)[0]
+                try:
+                    response = connection.send(
+                        make_request(kind, self.rng))
+                except Exception:
+                    self.errors += 1
+                    connection = self._connect()
+                    continue
+                if isinstance(response, dict) and \
+                        str(response.get("result")).startswith("Error"):
+                    self.errors += 1
+                self.samples[kind].append(time.perf_counter() - start)
+        finally:
+            connection.close()
+
+    def _connect(self):
+        return msg_client.Connection(*self.addr, timeout=10,
+                                     version=self.version,
+                                     compression=self.compression)
+
+
+def _millis(value):
+    return None if value is None else value * 1000
+
+
+def summarize(latencies, duration):
+    latencies = sorted(latencies)
+    return {
+        "requests": len(latencies),
+        "throughput_rps": len(latencies) / duration if duration else 0,
+        "p50_ms": _millis(percentile(latencies, 0.50)),
+        "p95_ms": _millis(percentile(latencies, 0.95)),
+        "p99_ms": _millis(percentile(latencies, 0.99)),
+        "p999_ms": _millis(percentile(latencies, 0.999)),
+        "max_ms": _millis(latencies[-1] if latencies else None),
+    }
+
+
+def run_benchmark(addr, connections, duration, mix, rate=None, warmup=1.0,
+                  version=2, compression=False):
+    """drive the server and return the results dict
+      *rate : float - total requests per second (open loop), None for
+      *closed loop where every connection sends as fast as it can
+    """
+    kinds, weights = parse_mix(mix)
+    interval = connections / rate if rate else None
+    if warmup:
+        run_benchmark(addr, connections, warmup, mix, rate, warmup=0,
+                      version=version, compression=compression)
+    start = time.perf_counter()
+    workers = [Worker(addr, kinds, weights, start + duration, interval,
+                      seed, version, compression)
+               for seed in range(connections)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start
+    everything = []
+    by_kind = {}
+    for kind in kinds:
+        samples = [value for worker in workers
+                   for value in worker.samples[kind]]
+        everything.extend(samples)
+        by_kind[kind] = summarize(samples, elapsed)
+    return {
+        "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "config": {
+            "addr": list(addr), "connections": connections,
+            "duration": duration, "mix": mix, "rate": rate,
+            "protocol_version": version, "compression": compression,
+        },
+        "errors": sum(worker.errors for worker in workers),
+        "total": summarize(everything, elapsed),
+        "by_kind": by_kind,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument("--host", help="server to drive, "
+                        "default: start a local server on a MemoryDB")
+    parser.add_argument("--port", type=int, default=8321)
+    parser.add_argument("--connections", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--warmup", type=float, default=1.0)
+    parser.add_argument("--rate", type=float,
+                        help="total requests/s, open loop; default closed")
+    parser.add_argument("--mix", default="read_table=8,read_columnar=1,"
+                        "insert=1", help="kind=weight,... of read_table, "
+                        "read_columnar, insert, binary")
+    parser.add_argument("--protocol", type=int, default=2, choices=(1, 2))
+    parser.add_argument("--compression", action="store_true",
+                        help="accept zlib compressed responses")
+    parser.add_argument("--db-latency", type=float, default=0.0,
+                        help="seconds added to every MemoryDB query")
+    parser.add_argument("--db-workers", type=int, default=4)
+    parser.add_argument("--output", help="write results as JSON")
+    args = parser.parse_args()
+
+    log.getLogger().setLevel(log.WARNING)
+    if args.host is None:
+        addr = ("127.0.0.1", args.port)
+        start_local_server(addr, args.db_latency, args.db_workers)
+    else:
+        addr = (args.host, args.port)
+    # Client and server print every message, keep it out of the timing
+    with open(os.devnull, "w") as devnull, \
+            contextlib.redirect_stdout(devnull):
+        results = run_benchmark(addr, args.connections, args.duration,
+                                args.mix, args.rate, args.warmup,
+                                args.protocol, args.compression)
+    print(json.dumps(results["total"], indent=2))
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,47 +1,40 @@
-import selectors
-import socket
-from threading import Thread
-import asyncio
 import libs.messenger_client as msg_client
 
 
 import logging as log
 
 log.basicConfig(level=log.DEBUG)
-sel = selectors.DefaultSelector()
+
+# actions sent as text/json, others go as custom binary requests
+JSON_ACTIONS = ("read_table", "read_organization", "read_department",
+                "read_person", "stream_table", "cache_stats", "action_stats",
+                "get_org_tree", "get_department_persons",
+                "get_organization_persons", "find_person_departments",
+                "find_person_org", "org_index_stats", "salary_stats",
+                "subscribe", "feed_stats", "admission_stats", "batch")
 
 
 class ClientApp:
-    def __init__(self, host: str, port: int):
+    """pool_size : int - pipelined connections shared by send_msg() callers
+    """
+    def __init__(self, host: str, port: int, pool_size=4):
         self.host = host
         self.port = port
+        self.pool_size = pool_size
+        self._client = None
 
-    def _start_read_loop(self):
-        try:
-            while True:
-                events = sel.select(timeout=1)
-                for key, mask in events:
-                    message = key.data
-                    try:
-                        message.process_events(mask)
-                    except Exception as Error:
-                        print("Socket Error: exception for\n"+
-                              f"{message.addr}:{Error}")
-                        message.close()
-                # Check for a socket being monitored to continue.
-                if not sel.get_map():
-                    break
-        except Exception as Error:
-            log.debug(f"Unknown exception, exiting Thread: {Error}")
-        finally:
-            sel.close()
-
-    def create_request(self, action, value):
-        if action == "read_table":
+    def create_request(self, action, value, accept=None):
+        """accept : str - response content-type,
+          *msg_client.COLUMNAR_CONTENT_TYPE for binary columnar rows
+        """
+        if action in JSON_ACTIONS:
+            content = dict(action=action, value=value)
+            if accept is not None:
+                content["accept"] = accept
             return dict(
                 type="text/json",
                 encoding="utf-8",
-                content=dict(action=action, value=value),
+                content=content,
             )
         else:
             return dict(
@@ -50,41 +43,76 @@ class ClientApp:
                 content=bytes(action + value, encoding="utf-8"),
             )
 
+    def connect(self, timeout=None):
+        """open keep-alive connection to the server
+          *with client.connect() as conn: conn.send(request)
+        """
+        return msg_client.Connection(self.host, self.port, timeout=timeout)
+
+    @property
+    def client(self):
+        """pooled blocking client, opened on first use
+        """
+        if self._client is None:
+            self._client = msg_client.Client(self.host, self.port,
+                                             pool_size=self.pool_size)
+        return self._client
+
+    def async_client(self):
+        """pooled client for use inside an asyncio event loop
+          *responses = await asyncio.gather(
+          *    *(client.request(request) for request in requests))
+        """
+        return msg_client.AsyncClient(self.host, self.port,
+                                      pool_size=self.pool_size)
+
     def send_msg(self, request):
-        """send message to the server
+        """send message to the server, return concurrent.futures.Future
+          *of the response, requests from many threads share the pool
           *request = create_request(action, value)
         """
-        self.addr = (self.host, self.port)
-        log.debug(f"starting connection to {self.addr}")
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.sock.setblocking(False)
-        self.sock.connect_ex(self.addr)
-        self.events = selectors.EVENT_READ | selectors.EVENT_WRITE
-        message = msg_client.Message(sel, self.sock, self.addr, request)
-        sel.register(self.sock, self.events, data=message)
-        read_thread = Thread(target=self._start_read_loop(), 
-                                       daemon=True)
-        read_thread.start()
+        log.debug(f"sending request to {(self.host, self.port)}")
+        return self.client.submit(request)
 
-    async def on_message(message):
-        return
+    def close(self):
+        if self._client is not None:
+            self._client.close()
+            self._client = None
 
-def syntetic_load(client):
-    print(type(client))
-    request = client.create_request('read_table', "{'table' : 'organization'}")
-    client.send_msg(request)
-    print('something')
+    def create_read_request(self, table, columns=None, where=None,
+                            limit=None, cursor=None, order_by=None,
+                            accept=None):
+        """read_table page request, the result has "next", the cursor of
+          *the next page (ColumnarResult.next_cursor for columnar content)
+          *where = {"uni_code": {"in": [1, 2]}, "id": {">": 10}}
+        """
+        request = self.create_request("read_table", None, accept=accept)
+        content = request["content"]
+        content["table"] = table
+        for name, field in (("columns", columns), ("where", where),
+                            ("limit", limit), ("cursor", cursor),
+                            ("order_by", order_by)):
+            if field is not None:
+                content[name] = field
+        return request
 
+    def create_batch(self, operations):
+        """batch request, operations run in one DB transaction
+          *operations = [dict(action="insert", table=..., columns=[...],
+          *                   rows=[[...], ...]),
+          *              dict(action="read", table=..., columns="*")]
+        """
+        return self.create_request("batch", list(operations))
+
+    async def on_message(message):
+        return
 
 def main():
+    # Load generation and latency measurement live in benchmark.py
     client = ClientApp(host="127.0.0.1", port=8321 )
-    threads = [Thread(target=syntetic_load, args=[client], daemon=True) for _ in range(1)]
     request = client.create_request('read_table', "{'table' : 'organization'}")
-    client.send_msg(request) 
-    #for thread in threads:
-    #    thread.start()
-    #while threads[-1].is_alive():
-    #    1 -1 
+    print(client.send_msg(request).result())
+    client.close()
 
 if __name__ == "__main__":
     main()
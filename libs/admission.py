@@ -0,0 +1,174 @@
+"""
+  *admission control: connection, in-flight request and per-client rate
+  *limits, work over them is refused at once with an "overloaded" frame
+  *
+  *admission = Admission(max_connections=1000, max_inflight=64,
+  *                      max_pending=256, rate=100.0, burst=200)
+  *ticket = admission.admit(peer)    # OverloadedError if over a limit
+  *async with ticket: ...            # waits for an in-flight slot
+"""
+
+import time
+import asyncio
+from collections import OrderedDict
+
+from libs.router import HandlerError
+
+
+class OverloadedError(HandlerError):
+    """request refused by a limit, answered with the "overloaded" and
+      *"retry-after" header fields besides the "Error: ..." result
+      *retry_after : float - seconds until a retry may be admitted
+    """
+    def __init__(self, reason, retry_after=None):
+        super().__init__(f'overloaded, {reason}')
+        self.reason = reason
+        self.retry_after = retry_after
+
+    def response(self):
+        response = super().response()
+        response["headers"] = {"overloaded": self.reason,
+                               "retry-after": self.retry_after}
+        return response
+
+
+class TokenBucket:
+    """rate tokens per second, at most burst saved up
+      *clock : callable - current time in seconds
+    """
+    def __init__(self, rate, burst, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.tokens = burst
+        self.updated = clock()
+
+    def take(self):
+        """0.0 if a token was taken, else seconds until one is available
+        """
+        now = self.clock()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1.0:
+            self.tokens -= 1.0
+            return 0.0
+        return (1.0 - self.tokens) / self.rate
+
+
+class Ticket:
+    """admitted request, holds its place in the pending work until
+      *released; async with ticket: runs in an in-flight slot and
+      *releases it; release() is idempotent, for requests dropped
+      *before they ran
+    """
+    def __init__(self, admission):
+        self._admission = admission
+        self._running = False
+
+    async def __aenter__(self):
+        admission = self._admission
+        if admission.max_inflight is not None:
+            await admission._slots().acquire()
+        self._running = True
+        admission.inflight += 1
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.release()
+
+    def release(self):
+        admission = self._admission
+        if admission is None:
+            return
+        self._admission = None
+        if self._running:
+            admission.inflight -= 1
+            if admission.max_inflight is not None:
+                admission._slots().release()
+        admission.admitted -= 1
+
+
+class Admission:
+    """limits of one server process, None means unlimited
+      *max_connections : int - open client connections
+      *max_inflight : int - requests handled at the same time
+      *max_pending : int - admitted requests waiting for an in-flight slot
+      *rate, burst : float - requests per second and burst per peer host
+      *max_peers : int - token buckets kept, least recently used go first
+      *clock : callable - current time in seconds of the token buckets
+    """
+    def __init__(self, max_connections=None, max_inflight=None,
+                 max_pending=256, rate=None, burst=None, max_peers=10000,
+                 clock=time.monotonic):
+        self.max_connections = max_connections
+        self.max_inflight = max_inflight
+        self.max_pending = max_pending
+        self.rate = rate
+        self.burst = burst if burst is not None else rate
+        self.max_peers = max_peers
+        self.clock = clock
+        self.connections = 0
+        # Admitted requests, running or waiting for a slot
+        self.admitted = 0
+        self.inflight = 0
+        # reason -> refused requests or connections
+        self.refused = {}
+        self._semaphore = None
+        # peer host -> TokenBucket
+        self._buckets = OrderedDict()
+
+    def _slots(self):
+        # Created on first use, inside the event loop
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_inflight)
+        return self._semaphore
+
+    def _refuse(self, reason, retry_after=None):
+        self.refused[reason] = self.refused.get(reason, 0) + 1
+        return OverloadedError(reason, retry_after)
+
+    def open_connection(self):
+        """count a new connection, OverloadedError if there are too many
+        """
+        if self.max_connections is not None \
+                and self.connections >= self.max_connections:
+            raise self._refuse('too many connections')
+        self.connections += 1
+
+    def close_connection(self):
+        self.connections -= 1
+
+    def _bucket(self, peer):
+        bucket = self._buckets.get(peer)
+        if bucket is None:
+            bucket = self._buckets[peer] = TokenBucket(
+                self.rate, self.burst, self.clock)
+            if len(self._buckets) > self.max_peers:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(peer)
+        return bucket
+
+    def admit(self, peer):
+        """Ticket of a request from peer host, OverloadedError if the peer
+          *is over its rate or the pending work is full
+        """
+        if self.rate is not None:
+            wait = self._bucket(peer).take()
+            if wait:
+                raise self._refuse('rate limit', round(wait, 3))
+        if self.max_inflight is not None \
+                and self.admitted >= self.max_inflight + self.max_pending:
+            raise self._refuse('too many requests')
+        self.admitted += 1
+        return Ticket(self)
+
+    def stats(self):
+        return {
+            "connections": self.connections,
+            "inflight": self.inflight,
+            "pending": self.admitted - self.inflight,
+            "refused": dict(self.refused),
+            "peers": len(self._buckets),
+        }
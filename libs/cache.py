@@ -0,0 +1,153 @@
+"""
+  *server-side cache of encoded responses for table reads
+  *
+"""
+
+import math
+import time
+import threading
+from collections import OrderedDict, defaultdict
+
+
+class ResultCache:
+    """LRU + TTL cache of encoded responses with a memory cap
+      *key = ResultCache.make_key(action, table, columns, filters, ...)
+      *entries of a table are dropped by invalidate(table), connect
+      *on_table_changed(sender, table_name) to the DB write signal
+      *max_entries : int, max_bytes : int - size of content_bytes kept,
+      *with the encodings added by add_encoding()
+      *ttl : float - seconds an entry stays valid
+    """
+    def __init__(self, max_entries=1024, max_bytes=64 * 1024 * 1024,
+                 ttl=5.0):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        # key -> (expires, size, response)
+        self._entries = OrderedDict()
+        # id(response) -> key, of the cached responses
+        self._keys = {}
+        self._table_keys = defaultdict(set)
+        self._generations = defaultdict(int)
+        # Writes invalidate from DB worker threads
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(action, table, columns="*", filters=None, **options):
+        """normalized key, order of columns, filters and options is ignored
+        """
+        if not isinstance(columns, str):
+            columns = tuple(sorted(columns))
+        filters = tuple(sorted((filters or {}).items()))
+        return (action, table, columns, filters,
+                tuple(sorted(options.items())))
+
+    def generation(self, table):
+        """take before reading the DB and pass to put(), so a result read
+          *before a write is not cached after the write invalidated it
+        """
+        with self._lock:
+            return self._generations.get(table, 0)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires, size, response = entry
+            if expires < time.monotonic():
+                self._remove(key)
+                self.evictions += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return response
+
+    @staticmethod
+    def _size(response):
+        return len(response["content_bytes"]) + len(
+            response.get("content_zlib") or b"")
+
+    def put(self, key, response, generation):
+        size = self._size(response)
+        if size > self.max_bytes:
+            return
+        table = key[1]
+        with self._lock:
+            if generation != self._generations[table]:
+                return
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic() + self.ttl, size, response)
+            self._keys[id(response)] = key
+            self._table_keys[table].add(key)
+            self.size += size
+            self._evict()
+
+    def add_encoding(self, response, name, content):
+        """response[name] = content, e.g. the compressed copy of the
+          *content_bytes, counted in max_bytes if the response is cached
+        """
+        with self._lock:
+            response[name] = content
+            key = self._keys.get(id(response))
+            if key is None:
+                return
+            expires, size, response = self._entries[key]
+            self.size -= size
+            size = self._size(response)
+            self._entries[key] = (expires, size, response)
+            self.size += size
+            self._evict()
+
+    def _evict(self):
+        while len(self._entries) > self.max_entries or \
+                self.size > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def pin(self, table):
+        """entries of the table cached now no longer expire, they stay
+          *until invalidate(table) or eviction; for warmed entries, when
+          *every write reaches invalidate()
+        """
+        with self._lock:
+            for key in self._table_keys.get(table, ()):
+                expires, size, response = self._entries[key]
+                self._entries[key] = (math.inf, size, response)
+
+    def invalidate(self, table):
+        with self._lock:
+            self._generations[table] += 1
+            for key in list(self._table_keys.pop(table, ())):
+                self._remove(key)
+                self.invalidations += 1
+
+    def on_table_changed(self, sender, **kw):
+        self.invalidate(kw['table_name'])
+
+    def _remove(self, key):
+        expires, size, response = self._entries.pop(key)
+        self.size -= size
+        del self._keys[id(response)]
+        keys = self._table_keys.get(key[1])
+        if keys is not None:
+            keys.discard(key)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self.size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
@@ -0,0 +1,202 @@
+"""
+  *binary columnar encoding of query results, content-type "binary/columnar"
+  *
+  *header: COLUMNAR_HEADER = magic, column count, row count
+  *schema: per column type id (B), name length (H), utf-8 name
+  *data: per column validity bytes (1 - value, 0 - NULL) and
+  *  INT       : int64 per row
+  *  DATE      : int32 days since 1970-01-01 per row
+  *  TEXT      : uint32 offsets (rows + 1), utf-8 blob
+  *  INT_ARRAY : uint32 offsets (rows + 1) into values, int64 values
+  *all numbers are little-endian
+"""
+
+import sys
+import struct
+import datetime
+from array import array
+from itertools import accumulate
+
+COLUMNAR_CONTENT_TYPE = "binary/columnar"
+
+COLUMNAR_MAGIC = b"COL1"
+COLUMNAR_HEADER = struct.Struct("<4sHI")
+COLUMN_HEADER = struct.Struct("<BH")
+
+INT = 1
+TEXT = 2
+DATE = 3
+INT_ARRAY = 4
+
+EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+
+
+def _little_endian(values):
+    if sys.byteorder == "big":
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values
+
+
+def _column_type(values):
+    """type id of the column from its first non NULL value
+    """
+    for value in values:
+        if value is None:
+            continue
+        if isinstance(value, bool):
+            break
+        if isinstance(value, int):
+            return INT
+        if isinstance(value, str):
+            return TEXT
+        if isinstance(value, datetime.date):
+            return DATE
+        if isinstance(value, (list, tuple)):
+            return INT_ARRAY
+        break
+    else:
+        # All NULL column
+        return TEXT
+    raise TypeError(f"Unsupported column value {value!r}")
+
+
+def _encode_column(col_type, values):
+    chunks = [bytes(value is not None for value in values)]
+    if col_type == INT:
+        chunks.append(_little_endian(array(
+            "q", (0 if value is None else value for value in values))))
+    elif col_type == DATE:
+        chunks.append(_little_endian(array(
+            "i", (0 if value is None else value.toordinal() - EPOCH_ORDINAL
+                  for value in values))))
+    elif col_type == TEXT:
+        parts = [b"" if value is None else value.encode("utf-8")
+                 for value in values]
+        offsets = array("I", [0])
+        offsets.extend(accumulate(map(len, parts)))
+        chunks.append(_little_endian(offsets))
+        chunks.append(b"".join(parts))
+    elif col_type == INT_ARRAY:
+        flat = array("q")
+        lengths = []
+        for value in values:
+            if value is not None:
+                flat.extend(value)
+            lengths.append(0 if value is None else len(value))
+        offsets = array("I", [0])
+        offsets.extend(accumulate(lengths))
+        chunks.append(_little_endian(offsets))
+        chunks.append(_little_endian(flat))
+    return chunks
+
+
+def encode_columns(names, rows):
+    """encode rows of a query result
+      *names : list of column names
+      *rows : list of row tuples
+    """
+    columns = list(zip(*rows)) if rows else [()] * len(names)
+    types = [_column_type(values) for values in columns]
+    chunks = [COLUMNAR_HEADER.pack(COLUMNAR_MAGIC, len(names), len(rows))]
+    for name, col_type in zip(names, types):
+        name_bytes = name.encode("utf-8")
+        chunks.append(COLUMN_HEADER.pack(col_type, len(name_bytes)))
+        chunks.append(name_bytes)
+    for col_type, values in zip(types, columns):
+        chunks.extend(_encode_column(col_type, values))
+    return b"".join(chunks)
+
+
+class _Reader:
+    def __init__(self, data):
+        self.data = memoryview(data)
+        self.offset = 0
+
+    def take(self, size):
+        view = self.data[self.offset:self.offset + size]
+        if len(view) != size:
+            raise ValueError("Truncated columnar content.")
+        self.offset += size
+        return view
+
+    def array(self, typecode, count):
+        values = array(typecode)
+        values.frombytes(self.take(values.itemsize * count))
+        return _little_endian(values)
+
+
+class ColumnarResult:
+    """decoded columnar content
+      *column arrays are decoded once from the frame buffer, row tuples
+      *are built only on rows()
+    """
+    def __init__(self, data):
+        reader = _Reader(data)
+        magic, ncols, self.nrows = COLUMNAR_HEADER.unpack(
+            reader.take(COLUMNAR_HEADER.size))
+        if magic != COLUMNAR_MAGIC:
+            raise ValueError("Invalid columnar content.")
+        self.names = []
+        self.types = []
+        for _ in range(ncols):
+            col_type, name_len = COLUMN_HEADER.unpack(
+                reader.take(COLUMN_HEADER.size))
+            self.types.append(col_type)
+            self.names.append(str(reader.take(name_len), "utf-8"))
+        self.validity = {}
+        self._data = {}
+        # read_table page token, set by the client from the frame header
+        self.next_cursor = None
+        for name, col_type in zip(self.names, self.types):
+            self.validity[name] = bytes(reader.take(self.nrows))
+            if col_type == INT:
+                self._data[name] = reader.array("q", self.nrows)
+            elif col_type == DATE:
+                self._data[name] = reader.array("i", self.nrows)
+            elif col_type == TEXT:
+                offsets = reader.array("I", self.nrows + 1)
+                blob = bytes(reader.take(offsets[-1]))
+                self._data[name] = (offsets, blob)
+            elif col_type == INT_ARRAY:
+                offsets = reader.array("I", self.nrows + 1)
+                values = reader.array("q", offsets[-1])
+                self._data[name] = (offsets, values)
+            else:
+                raise ValueError(f"Unknown column type id {col_type}.")
+
+    def __len__(self):
+        return self.nrows
+
+    def column(self, name):
+        """column values, NULL cells are marked in self.validity[name]
+          *INT : array('q'), DATE : array('i') of days since 1970-01-01,
+          *TEXT : list of str, INT_ARRAY : list of array('q')
+        """
+        col_type = self.types[self.names.index(name)]
+        data = self._data[name]
+        if col_type in (INT, DATE):
+            return data
+        offsets, values = data
+        if col_type == TEXT:
+            return [str(values[offsets[i]:offsets[i + 1]], "utf-8")
+                    for i in range(self.nrows)]
+        return [values[offsets[i]:offsets[i + 1]] for i in range(self.nrows)]
+
+    def rows(self):
+        """list of row tuples with None for NULL and datetime.date for DATE
+        """
+        columns = []
+        for name, col_type in zip(self.names, self.types):
+            values = self.column(name)
+            if col_type == DATE:
+                values = [datetime.date.fromordinal(value + EPOCH_ORDINAL)
+                          for value in values]
+            elif col_type == INT_ARRAY:
+                values = [value.tolist() for value in values]
+            validity = self.validity[name]
+            if 0 in validity:
+                values = [value if valid else None
+                          for value, valid in zip(values, validity)]
+            columns.append(values)
+        return list(zip(*columns))
@@ -0,0 +1,433 @@
+"""
+  *framing code shared by the client and the server
+  *
+  *v1 frame: 2-byte JSON header length + JSON header + content
+  *v2 frame: fixed V2_HEADER + content, negotiated per connection by
+  *a v1 request carrying "protocol-versions" : [1, 2], the server answers
+  *with "protocol-version" : 2. The server detects the version of every
+  *frame by V2_MAGIC, answers in the same version and keeps accepting v1.
+  *
+  *streamed response: frames with header "stream" : "chunk" (FLAG_CHUNK)
+  *closed by one frame with "stream" : "end" (FLAG_END_STREAM)
+  *
+  *compression: a request with "accept-compression" : ["zlib"]
+  *(FLAG_ACCEPT_COMPRESSION) may be answered with zlib compressed content
+  *marked "content-compression" : "zlib" (FLAG_COMPRESSED), chunks of one
+  *stream share a zlib stream, see Compressor and Decompressor
+"""
+
+import sys
+import json
+import zlib
+import struct
+import datetime
+from collections import deque
+
+# sendmsg() takes at most IOV_MAX chunks in one call
+IOV_MAX = 1024
+
+PROTOCOL_VERSIONS = (1, 2)
+
+V1_PROTOHEADER = struct.Struct(">H")
+# magic, version, type id, encoding id, flags, request id, content length
+V2_HEADER = struct.Struct(">2sBBBBII")
+# b"PO" read as a v1 JSON header length is 20559 bytes, far over real ones
+V2_MAGIC = b"PO"
+
+FLAG_KEEP_ALIVE = 0x01
+FLAG_BIG_ENDIAN = 0x02
+FLAG_CHUNK = 0x04
+FLAG_END_STREAM = 0x08
+FLAG_COMPRESSED = 0x10
+FLAG_ACCEPT_COMPRESSION = 0x20
+
+COMPRESSION = "zlib"
+
+STREAM_FLAGS = {
+    "chunk": FLAG_CHUNK,
+    "end": FLAG_END_STREAM,
+}
+
+CONTENT_TYPES = {
+    "text/json": 1,
+    "binary/custom-client-binary-type": 2,
+    "binary/custom-server-binary-type": 3,
+    "binary/columnar": 4,
+}
+CONTENT_TYPE_NAMES = {v: k for k, v in CONTENT_TYPES.items()}
+
+CONTENT_ENCODINGS = {
+    "utf-8": 1,
+    "binary": 2,
+}
+CONTENT_ENCODING_NAMES = {v: k for k, v in CONTENT_ENCODINGS.items()}
+
+REQUIRED_HEADERS = (
+    "byteorder",
+    "content-length",
+    "content-type",
+    "content-encoding",
+)
+
+
+def _json_default(obj):
+    if isinstance(obj, datetime.date):
+        return obj.isoformat()
+    raise TypeError(f"{type(obj).__name__} is not JSON serializable")
+
+
+def json_encode(obj, encoding):
+    return json.dumps(obj, ensure_ascii=False,
+                      default=_json_default).encode(encoding)
+
+
+def json_decode(json_bytes, encoding):
+    # str() decodes straight from bytes or memoryview
+    return json.loads(str(json_bytes, encoding))
+
+
+def negotiate_version(offered):
+    """highest protocol version supported by both sides
+    """
+    common = set(offered) & set(PROTOCOL_VERSIONS)
+    return max(common) if common else 1
+
+
+def client_version(header):
+    """protocol version the sender of the frame speaks, the negotiated one
+      *for a v1 frame offering "protocol-versions"
+    """
+    if "protocol-versions" in header:
+        return negotiate_version(header["protocol-versions"])
+    return header["version"]
+
+
+def create_message(*, content_bytes, content_type, content_encoding,
+                   version=1, request_id=0, keep_alive=False, stream=None,
+                   headers=None, compressed=False, accept_compression=False):
+    """frame chunks for writelines() or SendBuffer.extend(),
+      *content is not copied into the message
+      *stream : str - "chunk" or "end" for frames of a streamed response
+      *headers : dict - extra v1 JSON header fields
+      *compressed : bool - content_bytes are zlib compressed
+      *accept_compression : bool - the response may be compressed
+      *content types and encodings missing in the v2 tables are always
+      *sent as v1 frames
+    """
+    if version == 2 and not headers \
+            and content_type in CONTENT_TYPES \
+            and content_encoding in CONTENT_ENCODINGS:
+        flags = 0
+        if keep_alive:
+            flags |= FLAG_KEEP_ALIVE
+        if sys.byteorder == "big":
+            flags |= FLAG_BIG_ENDIAN
+        if stream is not None:
+            flags |= STREAM_FLAGS[stream]
+        if compressed:
+            flags |= FLAG_COMPRESSED
+        if accept_compression:
+            flags |= FLAG_ACCEPT_COMPRESSION
+        header = V2_HEADER.pack(
+            V2_MAGIC, 2, CONTENT_TYPES[content_type],
+            CONTENT_ENCODINGS[content_encoding], flags, request_id,
+            len(content_bytes))
+        return [header, content_bytes]
+    jsonheader = {
+        "byteorder": sys.byteorder,
+        "content-type": content_type,
+        "content-encoding": content_encoding,
+        "content-length": len(content_bytes),
+    }
+    if keep_alive:
+        jsonheader["connection"] = "keep-alive"
+    if request_id:
+        jsonheader["request-id"] = request_id
+    if stream is not None:
+        jsonheader["stream"] = stream
+    if compressed:
+        jsonheader["content-compression"] = COMPRESSION
+    if accept_compression:
+        jsonheader["accept-compression"] = [COMPRESSION]
+    if headers:
+        jsonheader.update(headers)
+    jsonheader_bytes = json_encode(jsonheader, "utf-8")
+    message_hdr = V1_PROTOHEADER.pack(len(jsonheader_bytes))
+    return [message_hdr, jsonheader_bytes, content_bytes]
+
+
+def _decode_v2_header(data):
+    magic, version, type_id, encoding_id, flags, request_id, length = \
+        V2_HEADER.unpack(data)
+    if version != 2:
+        raise ValueError(f"Unsupported protocol version {version}.")
+    if type_id not in CONTENT_TYPE_NAMES:
+        raise ValueError(f"Unknown content type id {type_id}.")
+    if encoding_id not in CONTENT_ENCODING_NAMES:
+        raise ValueError(f"Unknown content encoding id {encoding_id}.")
+    header = {
+        "version": 2,
+        "byteorder": "big" if flags & FLAG_BIG_ENDIAN else "little",
+        "content-type": CONTENT_TYPE_NAMES[type_id],
+        "content-encoding": CONTENT_ENCODING_NAMES[encoding_id],
+        "content-length": length,
+        "flags": flags,
+    }
+    if request_id:
+        header["request-id"] = request_id
+    if flags & FLAG_KEEP_ALIVE:
+        header["connection"] = "keep-alive"
+    if flags & FLAG_CHUNK:
+        header["stream"] = "chunk"
+    elif flags & FLAG_END_STREAM:
+        header["stream"] = "end"
+    if flags & FLAG_COMPRESSED:
+        header["content-compression"] = COMPRESSION
+    if flags & FLAG_ACCEPT_COMPRESSION:
+        header["accept-compression"] = [COMPRESSION]
+    return header
+
+
+def accepts_compression(header):
+    return COMPRESSION in header.get("accept-compression", ())
+
+
+class Compressor:
+    """zlib compression of frame content
+      *level : int - zlib level, 1 fastest .. 9 smallest
+      *threshold : int - content shorter than this is sent as is
+    """
+    def __init__(self, level=6, threshold=1024):
+        self.level = level
+        self.threshold = threshold
+
+    def compress(self, content):
+        """compressed bytes, None if content is under the threshold
+        """
+        if len(content) < self.threshold:
+            return None
+        return zlib.compress(content, self.level)
+
+    def stream(self):
+        return StreamCompressor(self.level, self.threshold)
+
+
+class StreamCompressor(Compressor):
+    """compressor of one streamed response: chunks share one zlib stream,
+      *so later chunks reuse the window of earlier ones, every compressed
+      *chunk ends with a sync flush and is decompressed on arrival
+    """
+    def __init__(self, level=6, threshold=1024):
+        super().__init__(level, threshold)
+        self._zlib = zlib.compressobj(level)
+
+    def compress(self, content):
+        if len(content) < self.threshold:
+            return None
+        return self._zlib.compress(content) + \
+            self._zlib.flush(zlib.Z_SYNC_FLUSH)
+
+
+class Decompressor:
+    """decompression of received frames, per connection
+      *zlib streams of chunked responses are kept by request id until the
+      *end-of-stream frame
+      *max_size : int - limit of decompressed content, against zip bombs
+    """
+    def __init__(self, max_size=256 * 1024 * 1024):
+        self.max_size = max_size
+        self._streams = {}
+
+    def decompress(self, header, content):
+        """content as sent, decompressed if the frame is compressed
+        """
+        compression = header.get("content-compression")
+        stream = header.get("stream")
+        request_id = header.get("request-id", 0)
+        if compression is not None:
+            if compression != COMPRESSION:
+                raise ValueError(f'Unknown compression "{compression}".')
+            if stream is None:
+                decompressor = zlib.decompressobj()
+            else:
+                decompressor = self._streams.get(request_id)
+                if decompressor is None:
+                    decompressor = self._streams[request_id] = \
+                        zlib.decompressobj()
+            content = decompressor.decompress(content, self.max_size)
+            if decompressor.unconsumed_tail:
+                raise ValueError(f"Decompressed content is over "
+                                 f"{self.max_size} bytes.")
+        if stream == "end":
+            self._streams.pop(request_id, None)
+        return content
+
+
+class FrameReader:
+    """Incremental parser of v1 and v2 frames from a RecvBuffer
+      *frame = (header, content): header is a dict with the v1 JSON header
+      *keys plus "version", content is a memoryview into the buffer
+    """
+    def __init__(self, recv_buffer):
+        self.recv_buffer = recv_buffer
+        self.header = None
+
+    def read_frame(self):
+        """next complete frame or None
+        """
+        if self.header is None:
+            self.header = self._read_header()
+            if self.header is None:
+                return None
+        content_len = self.header["content-length"]
+        if len(self.recv_buffer) < content_len:
+            return None
+        header, self.header = self.header, None
+        return header, self.recv_buffer.consume(content_len)
+
+    def frames(self):
+        """all complete frames in the buffer
+        """
+        while True:
+            frame = self.read_frame()
+            if frame is None:
+                return
+            yield frame
+
+    def _read_header(self):
+        buffer = self.recv_buffer
+        hdrlen = V1_PROTOHEADER.size
+        if len(buffer) < hdrlen:
+            return None
+        if buffer.peek(hdrlen) == V2_MAGIC:
+            if len(buffer) < V2_HEADER.size:
+                return None
+            return _decode_v2_header(buffer.consume(V2_HEADER.size))
+        jsonheader_len = V1_PROTOHEADER.unpack(buffer.peek(hdrlen))[0]
+        if len(buffer) < hdrlen + jsonheader_len:
+            return None
+        buffer.consume(hdrlen)
+        jsonheader = json_decode(buffer.consume(jsonheader_len), "utf-8")
+        for reqhdr in REQUIRED_HEADERS:
+            if reqhdr not in jsonheader:
+                raise ValueError(f'Missing required header "{reqhdr}".')
+        jsonheader["version"] = 1
+        return jsonheader
+
+
+class RecvBuffer:
+    """Receive buffer on a single bytearray
+      *data is received straight into the free tail (recv_into),
+      *frames are consumed from the front as memoryviews by moving an offset,
+      *consumed space is reclaimed only when the tail runs out of room.
+      *Views returned by consume() are valid until the next get_buffer().
+      *size : int - bytes allocated by the first get_buffer(); the buffer
+      *grows for large frames and shrinks back to size once it is empty,
+      *so idle connections hold size bytes at most
+    """
+    def __init__(self, size=8192):
+        self.size = size
+        self._buffer = bytearray()
+        self._start = 0
+        self._end = 0
+
+    def __len__(self):
+        return self._end - self._start
+
+    def get_buffer(self, sizehint=-1):
+        """memoryview of the free tail, at least sizehint bytes long
+        """
+        needed = max(sizehint, self.size // 4)
+        if len(self._buffer) - self._end < needed:
+            size = len(self)
+            if size + needed > len(self._buffer) // 2:
+                # Grow, old views keep old bytearray alive
+                new_buffer = bytearray(max(len(self._buffer) * 2,
+                                           size + needed, self.size))
+                new_buffer[:size] = self._buffer[self._start:self._end]
+                self._buffer = new_buffer
+            else:
+                # Compact, move only the unconsumed bytes to the front
+                self._buffer[:size] = self._buffer[self._start:self._end]
+            self._start = 0
+            self._end = size
+        return memoryview(self._buffer)[self._end:]
+
+    def buffer_updated(self, nbytes):
+        """nbytes were written to the view from get_buffer()
+        """
+        self._end += nbytes
+        if self._start == self._end:
+            self._clear()
+
+    def _clear(self):
+        """empty buffer starts over, a grown one is replaced by a new one
+          *of size, views still held keep the old bytearray alive
+        """
+        self._start = self._end = 0
+        if len(self._buffer) > self.size:
+            self._buffer = bytearray(self.size)
+
+    def recv_into(self, sock):
+        """receive from the socket straight into the buffer
+          *return number of received bytes, 0 if peer closed
+        """
+        nbytes = sock.recv_into(self.get_buffer())
+        self.buffer_updated(nbytes)
+        return nbytes
+
+    def peek(self, size):
+        return memoryview(self._buffer)[self._start:self._start + size]
+
+    def consume(self, size):
+        """memoryview of the next size bytes, removed from the buffer
+        """
+        view = memoryview(self._buffer)[self._start:self._start + size]
+        self._start += size
+        if self._start == self._end:
+            self._clear()
+        return view
+
+
+class SendBuffer:
+    """Send buffer as a list of chunks
+      *header and body are sent together with sendmsg() scatter-gather,
+      *partially sent chunks are sliced as memoryviews, never copied
+    """
+    def __init__(self):
+        self._chunks = deque()
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def append(self, data):
+        if data:
+            self._chunks.append(memoryview(data))
+            self._size += len(data)
+
+    def extend(self, chunks):
+        for data in chunks:
+            self.append(data)
+
+    def send(self, sock):
+        """send as much as the socket takes, return number of sent bytes
+        """
+        if hasattr(sock, "sendmsg"):
+            chunks = [self._chunks[i]
+                      for i in range(min(len(self._chunks), IOV_MAX))]
+            sent = sock.sendmsg(chunks)
+        else:
+            sent = sock.send(self._chunks[0])
+        self._advance(sent)
+        return sent
+
+    def _advance(self, nbytes):
+        self._size -= nbytes
+        while nbytes:
+            chunk = self._chunks[0]
+            if nbytes < len(chunk):
+                self._chunks[0] = chunk[nbytes:]
+                return
+            nbytes -= len(chunk)
+            self._chunks.popleft()
@@ -0,0 +1,558 @@
+"""
+  *in-memory storage engine, runs the server without a DB server
+  *
+  *every column is one array: INT and SERIAL columns array("q"), DATE
+  *array("i") of day ordinals, TEXT a list of str and integer[] a list of
+  *array("q"), NULLs are flagged in a bytearray per column. Indexed
+  *columns have a hash index value -> row numbers, integer[] columns an
+  *inverted one element -> row numbers; PRIMARY KEY columns are always
+  *indexed and reject duplicates. read_page walks a sorted list of the
+  *key of each PAGE_ORDERS order. Data lives as long as the process.
+"""
+
+import math
+import time
+import bisect
+import heapq
+import datetime
+import itertools
+import threading
+from array import array
+
+from libs.storage import Storage, on_table_changed, SCHEMA, PAGE_ORDERS, \
+    FILTERS, SALARY_GROUPS, INDEX_METHODS, INT, DATE, INT_ARRAY, column_kind
+
+
+class Column:
+    """values of one column, row number -> value
+    """
+    def __init__(self, kind, serial=False, not_null=False, unique=False):
+        self.kind = kind
+        self.serial = serial
+        self.not_null = not_null
+        self.unique = unique
+        self.nulls = bytearray()
+        if kind == INT:
+            self.values = array('q')
+        elif kind == DATE:
+            self.values = array('i')
+        else:
+            self.values = []
+        # value -> [row numbers], None if not indexed
+        self.index = {} if unique else None
+
+    def cast(self, value):
+        """request value compared with the column values, DATE columns
+          *take ISO date strings
+        """
+        if self.kind == DATE and isinstance(value, str):
+            return datetime.date.fromisoformat(value)
+        return value
+
+    def is_value(self, value):
+        """value can be ordered with the column values
+        """
+        if self.kind == INT:
+            return isinstance(value, int)
+        if self.kind == DATE:
+            return isinstance(value, datetime.date)
+        if self.kind == INT_ARRAY:
+            return isinstance(value, list)
+        return isinstance(value, str)
+
+    def _encode(self, value):
+        if self.kind == INT:
+            return int(value)
+        if self.kind == DATE:
+            if isinstance(value, str):
+                value = datetime.date.fromisoformat(value)
+            return value.toordinal()
+        if self.kind == INT_ARRAY:
+            return array('q', value)
+        return str(value)
+
+    def append(self, value, row):
+        if value is None:
+            if self.not_null:
+                raise ValueError('NULL in a NOT NULL column.')
+            self.nulls.append(1)
+            self.values.append(0 if self.kind in (INT, DATE) else None)
+            return
+        value = self._encode(value)
+        if self.unique and value in self.index:
+            raise ValueError(f'Duplicate key {value} in a unique column.')
+        self.values.append(value)
+        self.nulls.append(0)
+        if self.index is not None:
+            self._index(row)
+
+    def _index(self, row):
+        if self.kind == INT_ARRAY:
+            for element in set(self.values[row]):
+                self.index.setdefault(element, []).append(row)
+        else:
+            self.index.setdefault(self.values[row], []).append(row)
+
+    def build_index(self):
+        self.index = {}
+        for row in range(len(self.values)):
+            if not self.nulls[row]:
+                self._index(row)
+
+    def truncate(self, length):
+        """drop the rows from length on, for a failed batch
+        """
+        if self.index is not None:
+            for row in range(length, len(self.values)):
+                if self.nulls[row]:
+                    continue
+                keys = set(self.values[row]) if self.kind == INT_ARRAY \
+                    else (self.values[row],)
+                for key in keys:
+                    rows = self.index[key]
+                    rows.remove(row)
+                    if not rows:
+                        del self.index[key]
+        del self.values[length:]
+        del self.nulls[length:]
+
+    def get(self, row):
+        if self.nulls[row]:
+            return None
+        value = self.values[row]
+        if self.kind == DATE:
+            return datetime.date.fromordinal(value)
+        if self.kind == INT_ARRAY:
+            return value.tolist()
+        return value
+
+    def lookup(self, operator, operand):
+        """row numbers the index gives for operator, None if it can not
+          *answer it
+        """
+        if self.index is None:
+            return None
+        if self.kind == INT_ARRAY:
+            if operator != 'contains':
+                return None
+            rows = None
+            for element in set(operand):
+                found = set(self.index.get(element, ()))
+                rows = found if rows is None else rows & found
+            return sorted(rows) if rows is not None else None
+        try:
+            if operator == '=':
+                return list(self.index.get(self._encode(operand), ()))
+            if operator == 'in':
+                return sorted({row for value in operand
+                               for row in self.index.get(
+                                   self._encode(value), ())})
+        except (TypeError, ValueError, AttributeError):
+            # Not a value of the column, the scan compares it
+            return None
+        return None
+
+
+class Table:
+    def __init__(self, vars):
+        self.columns = {}
+        for name, sql_type in vars.items():
+            self.columns[name.lower()] = Column(*column_kind(sql_type))
+        self.names = list(self.columns)
+        self.length = 0
+        # next value of SERIAL columns
+        self.serial = 1
+        # key columns -> sorted [(key values..., row number)], built by the
+        # first read_page in that order and kept sorted by writes
+        self.orders = {}
+
+    def column(self, name):
+        column = self.columns.get(name)
+        if column is None:
+            raise ValueError(f'Invalid column "{name}".')
+        return column
+
+    def insert(self, columns, rows):
+        """append rows, all or none of them
+        """
+        targets = [self.column(name) for name in columns]
+        length, serial = self.length, self.serial
+        try:
+            for values in rows:
+                if len(values) != len(targets):
+                    raise ValueError('Row and column counts differ.')
+                given = dict(zip(columns, values))
+                for name, column in self.columns.items():
+                    value = given.get(name)
+                    if value is None and column.serial:
+                        value = self.serial
+                    if column.serial:
+                        self.serial = max(self.serial, int(value) + 1)
+                    column.append(value, self.length)
+                self.length += 1
+        except Exception:
+            self.truncate(length, serial)
+            raise
+        for keys, order in self.orders.items():
+            for row in range(length, self.length):
+                bisect.insort(order, self.key(keys, row))
+        return len(rows)
+
+    def key(self, keys, row):
+        """entry of the row in the order of the keys columns
+        """
+        return tuple(self.columns[key].get(row) for key in keys) + (row,)
+
+    def order(self, keys):
+        order = self.orders.get(keys)
+        if order is None:
+            order = sorted(self.key(keys, row) for row in range(self.length))
+            self.orders[keys] = order
+        return order
+
+    def ids(self, start):
+        """id column values from row start on, None without an id column
+        """
+        column = self.columns.get('id')
+        if column is None:
+            return None
+        return column.values[start:].tolist()
+
+    def truncate(self, length, serial):
+        for column in self.columns.values():
+            column.truncate(length)
+        for keys, order in self.orders.items():
+            self.orders[keys] = [entry for entry in order
+                                 if entry[-1] < length]
+        self.length = length
+        self.serial = serial
+
+    def row(self, row, names):
+        return tuple(self.columns[name].get(row) for name in names)
+
+    def rows(self, names, rows=None):
+        if rows is None:
+            rows = range(self.length)
+        return [self.row(row, names) for row in rows]
+
+
+class MemoryRowStream:
+    """stream_rows result, the rows are read by the first fetch(), in the
+      *DB worker thread like the chunks of the PostgreSQL RowStream
+    """
+    def __init__(self, data_base, var_name, table_name, chunk_size):
+        self.data_base = data_base
+        self.query = (var_name, table_name)
+        self.columns = None
+        self._rows = None
+        self._chunk_size = chunk_size
+
+    def fetch(self):
+        if self._rows is None:
+            answer = self.data_base.read_rows(*self.query)
+            if answer is None:
+                raise ValueError(f'Table "{self.query[1]}" does not exist.')
+            self.columns, self._rows = answer
+        if not self._rows:
+            return None
+        chunk = self._rows[:self._chunk_size]
+        del self._rows[:self._chunk_size]
+        return chunk
+
+    def close(self):
+        self._rows = []
+
+
+class MemoryDB(Storage):
+    """storage engine keeping the tables in process memory
+      *latency : float - seconds added to every call, to model a DB
+      *server in benchmarks
+    """
+    def __init__(self, db_tables: tuple, max_connections=4, latency=0.0):
+        super().__init__(db_tables, max_connections=max_connections)
+        self.latency = latency
+        self.tables = {}
+        # One writer or reader at a time, like a serializable DB
+        self._lock = threading.RLock()
+
+    def connect(self):
+        return self
+
+    def close(self):
+        return
+
+    def _wait(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _table(self, table_name):
+        self._check_table(table_name)
+        table = self.tables.get(table_name)
+        if table is None:
+            raise ValueError(f'Table "{table_name}" does not exist.')
+        return table
+
+    def _names(self, table, var_name):
+        names = self._column_names(var_name)
+        if names == '*':
+            return list(table.names)
+        for name in names:
+            table.column(name)
+        return list(names)
+
+    def migrate(self):
+        for table_name, (vars, indexes) in SCHEMA.items():
+            if table_name in self.db_tables:
+                self.create_table(table_name, vars, indexes)
+        return []
+
+    def create_table(self, table_name: str, vars: dict, indexes=None):
+        if table_name not in self.db_tables:
+            return False
+        with self._lock:
+            self.tables.setdefault(table_name, Table(vars))
+            for column, method in (indexes or {}).items():
+                self.create_index(table_name, column, method)
+        on_table_changed.send(self, table_name=table_name, change='create')
+        return True
+
+    def create_index(self, table_name: str, column: str, method='btree'):
+        if method not in INDEX_METHODS:
+            raise ValueError(f'Invalid index method "{method}".')
+        with self._lock:
+            column = self._table(table_name).column(column.lower())
+            if column.index is None:
+                column.build_index()
+
+    def delete_table(self, table_name):
+        self._check_table(table_name)
+        with self._lock:
+            self.tables.pop(table_name, None)
+        on_table_changed.send(self, table_name=table_name, change='delete')
+        return True
+
+    def insert_rows(self, table_name: str, columns, rows):
+        self._wait()
+        columns = self._column_names(columns)
+        with self._lock:
+            table = self._table(table_name)
+            start = table.length
+            count = table.insert(columns, rows)
+            ids = table.ids(start)
+        self._send_inserted(table_name, columns, rows, ids)
+        return count
+
+    def execute_batch(self, operations):
+        self._wait()
+        results = []
+        inserted = []
+        with self._lock:
+            # (table, length, serial) to roll back to
+            undo = []
+            try:
+                for operation in operations:
+                    action = operation.get('action')
+                    table = self._table(operation.get('table'))
+                    if action == 'insert':
+                        undo.append((table, table.length, table.serial))
+                        results.append(table.insert(
+                            self._column_names(operation['columns']),
+                            operation['rows']))
+                        inserted.append((operation, table.ids(undo[-1][1])))
+                    elif action == 'read':
+                        results.append(table.rows(self._names(
+                            table, operation.get('columns', '*'))))
+                    else:
+                        raise ValueError(f'Invalid batch action "{action}".')
+            except Exception:
+                for table, length, serial in reversed(undo):
+                    table.truncate(length, serial)
+                raise
+        for operation, ids in inserted:
+            self._send_inserted(
+                operation['table'], self._column_names(operation['columns']),
+                operation['rows'], ids)
+        return results
+
+    def read_rows(self, var_name, table_name):
+        self._wait()
+        with self._lock:
+            table = self.tables.get(table_name)
+            self._check_table(table_name)
+            if table is None:
+                return None
+            names = self._names(table, var_name)
+            return names, table.rows(names)
+
+    def read_page(self, table_name, columns='*', where=None, order_by='id',
+                  after=None, limit=100):
+        """candidate rows of an indexed predicate are ordered by a heap,
+          *without one the sorted order is walked from the cursor until the
+          *page is full
+        """
+        self._check_page(table_name, columns, where, order_by, after, limit)
+        keys = PAGE_ORDERS[order_by]
+        self._wait()
+        with self._lock:
+            table = self._table(table_name)
+            names = self._names(table, columns)
+            key_columns = [table.column(key) for key in keys]
+            if after is not None:
+                if not all(column.is_value(value)
+                           for column, value in zip(key_columns, after)):
+                    raise ValueError('Invalid page cursor.')
+                after = tuple(after)
+            predicates = []
+            for name, condition in (where or {}).items():
+                if not isinstance(condition, dict):
+                    condition = {'=': condition}
+                for operator, operand in condition.items():
+                    column = table.column(name.lower())
+                    if operator == 'in':
+                        operand = [column.cast(value) for value in operand]
+                    else:
+                        operand = column.cast(operand)
+                    predicates.append((column, operator, operand))
+            candidates = None
+            for column, operator, operand in predicates:
+                found = column.lookup(operator, operand)
+                if found is not None:
+                    candidates = set(found) if candidates is None \
+                        else candidates & set(found)
+
+            def matches(row):
+                return all(column.get(row) is not None
+                           and FILTERS[operator](column.get(row), operand)
+                           for column, operator, operand in predicates)
+            if candidates is not None:
+                entries = (table.key(keys, row) for row in candidates
+                           if matches(row))
+                if after is not None:
+                    entries = (entry for entry in entries
+                               if entry[:-1] > after)
+                page = heapq.nsmallest(limit, entries)
+            else:
+                order = table.order(keys)
+                start = 0 if after is None \
+                    else bisect.bisect_right(order, after + (math.inf,))
+                page = list(itertools.islice(
+                    (entry for entry in itertools.islice(order, start, None)
+                     if matches(entry[-1])), limit))
+            names = names + list(keys)
+            return names, table.rows(names, [entry[-1] for entry in page])
+
+    def stream_rows(self, var_name, table_name, chunk_size=1000):
+        self._check_table(table_name)
+        if chunk_size < 1:
+            raise ValueError(f'Invalid chunk size {chunk_size}.')
+        return MemoryRowStream(self, var_name, table_name, chunk_size)
+
+    def _by_uni_code(self, table_name, uni_codes):
+        """row numbers of the uni_codes, through the hash index
+        """
+        column = self._table(table_name).column('uni_code')
+        if column.index is None:
+            column.build_index()
+        return [row for uni_code in uni_codes
+                for row in column.index.get(uni_code, ())]
+
+    def _members(self, table_name, rows, children):
+        """distinct uni_codes the rows list in the children column
+        """
+        column = self._table(table_name).column(children)
+        return {code for row in rows for code in column.get(row) or ()}
+
+    def _containing(self, table_name, children, uni_code):
+        """row numbers listing uni_code in the children column
+        """
+        table = self._table(table_name)
+        column = table.column(children)
+        rows = column.lookup('contains', [uni_code])
+        if rows is None:
+            rows = [row for row in range(table.length)
+                    if uni_code in (column.get(row) or ())]
+        return rows
+
+    def _persons(self, department_rows):
+        """(column names, rows) of the persons the departments list, each
+          *once, in id order
+        """
+        table = self._table('person')
+        persons = self._by_uni_code('person', self._members(
+            'department', department_rows, 'persons_uni_codes'))
+        ids = table.column('id')
+        return list(table.names), table.rows(
+            table.names, sorted(persons, key=ids.get))
+
+    def persons_by_department(self, uni_code):
+        self._wait()
+        with self._lock:
+            return self._persons(self._by_uni_code('department', [uni_code]))
+
+    def persons_by_organization(self, uni_code):
+        self._wait()
+        with self._lock:
+            organizations = self._by_uni_code('organization', [uni_code])
+            return self._persons(self._by_uni_code(
+                'department', self._members(
+                    'organization', organizations, 'department_uni_codes')))
+
+    def person_organizations(self, uni_code):
+        self._wait()
+        with self._lock:
+            departments = self._table('department').column('uni_code')
+            organizations = self._table('organization').column('uni_code')
+            rows = set()
+            for department in self._containing(
+                    'department', 'persons_uni_codes', uni_code):
+                code = departments.get(department)
+                parents = self._containing(
+                    'organization', 'department_uni_codes', code)
+                for organization in parents or [None]:
+                    rows.add((code, None if organization is None
+                              else organizations.get(organization)))
+            return ['department_uni_code', 'organization_uni_code'], sorted(
+                rows, key=lambda row: (row[0], row[1] is None, row[1]))
+
+    def _group_persons(self, group_by, uni_code):
+        """person row numbers of the group, once per department row
+          *listing them, like the joins of DB.salary_stats
+        """
+        departments = self._by_uni_code(group_by, [uni_code])
+        if group_by == 'organization':
+            departments = [
+                department for organization in departments
+                for department in self._by_uni_code(
+                    'department', self._members(
+                        'organization', [organization],
+                        'department_uni_codes'))]
+        return [person for department in departments
+                for person in self._by_uni_code('person', self._members(
+                    'department', [department], 'persons_uni_codes'))]
+
+    def salary_stats(self, group_by=None):
+        if group_by not in SALARY_GROUPS:
+            raise ValueError(f'Invalid group "{group_by}".')
+        self._wait()
+        with self._lock:
+            persons = self._table('person')
+            salary = persons.column('salary_month_usd')
+            if group_by is None:
+                groups = [(None, range(persons.length))]
+            else:
+                table = self._table(group_by)
+                codes = table.column('uni_code')
+                groups = [(code, self._group_persons(group_by, code))
+                          for code in sorted({codes.get(row) for row
+                                              in range(table.length)})]
+            rows = []
+            for code, members in groups:
+                salaries = [salary.get(row) for row in members
+                            if salary.get(row) is not None]
+                stats = (len(members), sum(salaries) if salaries else None,
+                         sum(salaries) / len(salaries) if salaries else None,
+                         min(salaries) if salaries else None,
+                         max(salaries) if salaries else None)
+                rows.append(stats if group_by is None else (code,) + stats)
+        names = ['count', 'sum', 'avg', 'min', 'max']
+        return (names if group_by is None else ['uni_code'] + names), rows
@@ -1,22 +1,79 @@
 
-import sys
+import socket
+import asyncio
+import threading
 import selectors
-import json
-import io
-import struct
+from collections import deque
+from libs.framing import RecvBuffer, SendBuffer, FrameReader, \
+    create_message, json_encode, json_decode, PROTOCOL_VERSIONS, \
+    Decompressor
+from libs.columnar import COLUMNAR_CONTENT_TYPE, ColumnarResult
+
+def decode_content(header, data):
+    """decode frame content by its content-type
+    """
+    content_type = header["content-type"]
+    if content_type == "text/json":
+        encoding = header["content-encoding"]
+        return json_decode(data, encoding)
+    if content_type == COLUMNAR_CONTENT_TYPE:
+        # Column arrays are decoded straight from the recv buffer
+        result = ColumnarResult(data)
+        result.next_cursor = header.get("next-cursor")
+        return result
+    # Binary or unknown content-type, copy out of the recv buffer
+    return bytes(data)
+
+
+def _encode_request(request):
+    """request dict(type=..., encoding=..., content=...) as create_message
+      *keyword arguments
+    """
+    content = request["content"]
+    content_type = request["type"]
+    content_encoding = request["encoding"]
+    if content_type == "text/json":
+        content = json_encode(content, content_encoding)
+    return {
+        "content_bytes": content,
+        "content_type": content_type,
+        "content_encoding": content_encoding,
+    }
+
+
+def _raise_on_error(response):
+    if isinstance(response, dict):
+        result = response.get("result")
+        if isinstance(result, str) and result.startswith("Error"):
+            raise RuntimeError(result)
+
 
 class Message:
-    def __init__(self, selector, sock, addr, request):
+    def __init__(self, selector, sock, addr, request, keep_alive=False,
+                 version=1, offer_versions=False, compression=False):
+        """version : int - protocol version of the request frame
+          *offer_versions : bool - send supported protocol versions to
+          *the server, the answer is in jsonheader["protocol-version"]
+          *compression : bool - accept a compressed response
+        """
         self.selector = selector
         self.sock = sock
         self.addr = addr
         self.request = request
-        self._recv_buffer = b""
-        self._send_buffer = b""
+        self.keep_alive = keep_alive
+        self.version = version
+        self.offer_versions = offer_versions
+        self.compression = compression
+        self._decompressor = Decompressor()
+        self._recv_buffer = RecvBuffer()
+        self._send_buffer = SendBuffer()
+        self._reader = FrameReader(self._recv_buffer)
         self._request_queued = False
-        self._jsonheader_len = None
         self.jsonheader = None
         self.response = None
+        # Decoded chunks of a streamed response, the end-of-stream frame
+        # content becomes the response
+        self.chunks = deque()
 
     def _set_selector_events_mask(self, mode):
         """Set selector to listen for events: mode is 'r', 'w', or 'rw'."""
@@ -33,52 +90,23 @@ class Message:
     def _read(self):
         try:
             # Should be ready to read
-            data = self.sock.recv(4096)
+            nbytes = self._recv_buffer.recv_into(self.sock)
         except BlockingIOError:
             # Resource temporarily unavailable (errno EWOULDBLOCK)
             pass
         else:
-            if data:
-                self._recv_buffer += data
-            else:
+            if not nbytes:
                 raise RuntimeError("Peer closed.")
 
     def _write(self):
         if self._send_buffer:
-            print("sending", repr(self._send_buffer), "to", self.addr)
+            print("sending", len(self._send_buffer), "bytes to", self.addr)
             try:
                 # Should be ready to write
-                sent = self.sock.send(self._send_buffer)
+                self._send_buffer.send(self.sock)
             except BlockingIOError:
                 # Resource temporarily unavailable (errno EWOULDBLOCK)
                 pass
-            else:
-                self._send_buffer = self._send_buffer[sent:]
-
-    def _json_encode(self, obj, encoding):
-        return json.dumps(obj, ensure_ascii=False).encode(encoding)
-
-    def _json_decode(self, json_bytes, encoding):
-        tiow = io.TextIOWrapper(
-            io.BytesIO(json_bytes), encoding=encoding, newline=""
-        )
-        obj = json.load(tiow)
-        tiow.close()
-        return obj
-
-    def _create_message(
-        self, *, content_bytes, content_type, content_encoding
-    ):
-        jsonheader = {
-            "byteorder": sys.byteorder,
-            "content-type": content_type,
-            "content-encoding": content_encoding,
-            "content-length": len(content_bytes),
-        }
-        jsonheader_bytes = self._json_encode(jsonheader, "utf-8")
-        message_hdr = struct.pack(">H", len(jsonheader_bytes))
-        message = message_hdr + jsonheader_bytes + content_bytes
-        return message
 
     def _process_response_json_content(self):
         content = self.response
@@ -87,7 +115,10 @@ class Message:
 
     def _process_response_binary_content(self):
         content = self.response
-        print(f"got response: {repr(content)}")
+        if self.jsonheader["content-type"] == COLUMNAR_CONTENT_TYPE:
+            print(f"got {len(content)} rows of {content.names}")
+        else:
+            print(f"got response: {repr(content)}")
 
     def process_events(self, mask):
         if mask & selectors.EVENT_READ:
@@ -98,16 +129,16 @@ class Message:
     def read(self):
         self._read()
 
-        if self._jsonheader_len is None:
-            self.process_protoheader()
-
-        if self._jsonheader_len is not None:
-            if self.jsonheader is None:
-                self.process_jsonheader()
-
-        if self.jsonheader:
-            if self.response is None:
-                self.process_response()
+        while self.response is None:
+            frame = self._reader.read_frame()
+            if frame is None:
+                break
+            self.jsonheader, content = frame
+            content = self._decompressor.decompress(self.jsonheader, content)
+            if self.jsonheader.get("stream") == "chunk":
+                self.chunks.append(self._decode_content(content))
+            else:
+                self.process_response(content)
 
     def write(self):
         if not self._request_queued:
@@ -142,67 +173,383 @@ class Message:
             self.sock = None
 
     def queue_request(self):
-        content = self.request["content"]
-        content_type = self.request["type"]
-        content_encoding = self.request["encoding"]
-        if content_type == "text/json":
-            req = {
-                "content_bytes": self._json_encode(content, content_encoding),
-                "content_type": content_type,
-                "content_encoding": content_encoding,
-            }
-        else:
-            req = {
-                "content_bytes": content,
-                "content_type": content_type,
-                "content_encoding": content_encoding,
-            }
-        message = self._create_message(**req)
-        self._send_buffer += message
+        req = _encode_request(self.request)
+        headers = None
+        if self.offer_versions:
+            headers = {"protocol-versions": list(PROTOCOL_VERSIONS)}
+        message = create_message(version=self.version,
+                                 keep_alive=self.keep_alive,
+                                 headers=headers,
+                                 accept_compression=self.compression, **req)
+        self._send_buffer.extend(message)
         self._request_queued = True
 
-    def process_protoheader(self):
-        hdrlen = 2
-        if len(self._recv_buffer) >= hdrlen:
-            self._jsonheader_len = struct.unpack(
-                ">H", self._recv_buffer[:hdrlen]
-            )[0]
-            self._recv_buffer = self._recv_buffer[hdrlen:]
-
-    def process_jsonheader(self):
-        hdrlen = self._jsonheader_len
-        if len(self._recv_buffer) >= hdrlen:
-            self.jsonheader = self._json_decode(
-                self._recv_buffer[:hdrlen], "utf-8"
-            )
-            self._recv_buffer = self._recv_buffer[hdrlen:]
-            for reqhdr in (
-                "byteorder",
-                "content-length",
-                "content-type",
-                "content-encoding",
-            ):
-                if reqhdr not in self.jsonheader:
-                    raise ValueError(f'Missing required header "{reqhdr}".')
-
-    def process_response(self):
-        content_len = self.jsonheader["content-length"]
-        if not len(self._recv_buffer) >= content_len:
-            return
-        data = self._recv_buffer[:content_len]
-        self._recv_buffer = self._recv_buffer[content_len:]
+    def _decode_content(self, data):
+        return decode_content(self.jsonheader, data)
+
+    def process_response(self, data):
+        self.response = self._decode_content(data)
         if self.jsonheader["content-type"] == "text/json":
-            encoding = self.jsonheader["content-encoding"]
-            self.response = self._json_decode(data, encoding)
             print("received response", repr(self.response), "from", self.addr)
             self._process_response_json_content()
         else:
-            # Binary or unknown content-type
-            self.response = data
             print(
                 f'received {self.jsonheader["content-type"]} response from',
                 self.addr,
             )
             self._process_response_binary_content()
-        # Close when response has been processed
-        self.close()
\ No newline at end of file
+        # Close when response has been processed, keep-alive socket
+        # is owned by the Connection and stays open for next requests.
+        if not self.keep_alive:
+            self.close()
+
+
+class Connection:
+    """Reusable keep-alive connection to the server
+      *requests are sent one by one over the same socket
+      *response = Connection(host, port).send(request)
+    """
+    def __init__(self, host: str, port: int, timeout=None, version=2,
+                 compression=False):
+        """version : int - highest protocol version to negotiate,
+          *the first request is always sent as v1
+          *compression : bool - accept compressed responses
+        """
+        self.addr = (host, port)
+        self.compression = compression
+        self.timeout = timeout
+        self.max_version = version
+        self.version = 1
+        self._negotiated = version == 1
+        self.selector = selectors.DefaultSelector()
+        self.sock = socket.create_connection(self.addr, timeout=timeout)
+        self.sock.setblocking(False)
+        self.selector.register(self.sock, selectors.EVENT_READ, data=None)
+
+    def send(self, request):
+        """send request and wait for the response
+          *request = dict(type=..., encoding=..., content=...)
+        """
+        message = self._start(request)
+        while message.response is None:
+            self._poll()
+        self._finish(message)
+        return message.response
+
+    def stream(self, request):
+        """send request and yield decoded chunks of the streamed response
+          *as they arrive, raise RuntimeError on the server error result
+          *for row in conn.stream(request): ...
+        """
+        message = self._start(request)
+        while True:
+            while message.chunks:
+                yield message.chunks.popleft()
+            if message.response is not None:
+                break
+            self._poll()
+        self._finish(message)
+        _raise_on_error(message.response)
+
+    def _start(self, request):
+        if self.sock is None:
+            raise RuntimeError(f"Connection to {self.addr} is closed.")
+        message = Message(self.selector, self.sock, self.addr, request,
+                          keep_alive=True, version=self.version,
+                          offer_versions=not self._negotiated,
+                          compression=self.compression)
+        self.selector.modify(self.sock, selectors.EVENT_WRITE, data=message)
+        return message
+
+    def _poll(self):
+        try:
+            events = self.selector.select(timeout=self.timeout)
+            if not events:
+                raise TimeoutError(f"No response from {self.addr}")
+            for key, mask in events:
+                key.data.process_events(mask)
+        except Exception:
+            self.close()
+            raise
+
+    def _finish(self, message):
+        if not self._negotiated:
+            self._negotiated = True
+            self.version = min(self.max_version,
+                               message.jsonheader.get("protocol-version", 1))
+        if message.jsonheader.get("connection") != "keep-alive":
+            # Server does not support keep-alive and closed the socket
+            self.close()
+
+    def close(self):
+        if self.sock is None:
+            return
+        print("closing connection to", self.addr)
+        try:
+            self.selector.unregister(self.sock)
+        except Exception as e:
+            print(
+                f"error: selector.unregister() exception for",
+                f"{self.addr}: {repr(e)}",
+            )
+        self.sock.close()
+        self.sock = None
+        self.selector.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class AsyncConnection(asyncio.BufferedProtocol):
+    """Pipelined asyncio connection: many requests in flight at once,
+      *responses are matched to requests by request id in any order
+      *conn = await AsyncConnection.connect(host, port)
+      *response = await conn.request(request)
+    """
+    # End-of-stream marker in stream queues
+    _END = object()
+
+    def __init__(self, version=2, compression=False):
+        """version : int - highest protocol version to negotiate, requests
+          *are sent as v1 until the first response answers the offer
+          *compression : bool - accept compressed responses
+        """
+        self.compression = compression
+        self._decompressor = Decompressor()
+        self.transport = None
+        self.addr = None
+        self.max_version = version
+        self.version = 1
+        self._negotiated = version == 1
+        self._recv_buffer = RecvBuffer()
+        self._reader = FrameReader(self._recv_buffer)
+        self._last_id = 0
+        # request id -> Future, or asyncio.Queue of a streamed response
+        self._pending = {}
+
+    @classmethod
+    async def connect(cls, host: str, port: int, version=2,
+                      compression=False):
+        loop = asyncio.get_running_loop()
+        transport, connection = await loop.create_connection(
+            lambda: cls(version=version, compression=compression),
+            host, port)
+        return connection
+
+    @property
+    def closed(self):
+        return self.transport is None
+
+    @property
+    def in_flight(self):
+        return len(self._pending)
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.addr = transport.get_extra_info("peername")
+
+    def connection_lost(self, exc):
+        self.transport = None
+        error = ConnectionError(f"Connection to {self.addr} lost")
+        for waiter in self._pending.values():
+            if isinstance(waiter, asyncio.Queue):
+                waiter.put_nowait(error)
+            elif not waiter.done():
+                waiter.set_exception(error)
+        self._pending.clear()
+
+    def get_buffer(self, sizehint):
+        return self._recv_buffer.get_buffer(sizehint)
+
+    def buffer_updated(self, nbytes):
+        self._recv_buffer.buffer_updated(nbytes)
+        try:
+            for header, content in self._reader.frames():
+                self._process_frame(header, content)
+        except Exception as Error:
+            print(
+                "error: exception for",
+                f"{self.addr}:\n{Error}",
+            )
+            self.close()
+
+    def _process_frame(self, header, content):
+        if not self._negotiated and "protocol-version" in header:
+            self._negotiated = True
+            self.version = min(self.max_version, header["protocol-version"])
+        content = self._decompressor.decompress(header, content)
+        waiter = self._pending.get(header.get("request-id"))
+        if waiter is None:
+            # Cancelled request
+            return
+        response = decode_content(header, content)
+        if isinstance(waiter, asyncio.Queue):
+            if header.get("stream") == "chunk":
+                waiter.put_nowait(response)
+                return
+            # End-of-stream frame content
+            waiter.put_nowait((self._END, response))
+        elif not waiter.done():
+            waiter.set_result(response)
+        del self._pending[header["request-id"]]
+
+    def _send(self, request, waiter):
+        if self.transport is None:
+            raise ConnectionError(f"Connection to {self.addr} is closed.")
+        # Request ids are uint32, 0 means no id
+        self._last_id = self._last_id % 0xFFFFFFFF + 1
+        request_id = self._last_id
+        headers = None
+        if not self._negotiated:
+            headers = {"protocol-versions": list(PROTOCOL_VERSIONS)}
+        self._pending[request_id] = waiter
+        self.transport.writelines(create_message(
+            version=self.version, request_id=request_id, keep_alive=True,
+            headers=headers, accept_compression=self.compression,
+            **_encode_request(request)))
+        return request_id
+
+    async def request(self, request):
+        """send request and wait for its response
+          *request = dict(type=..., encoding=..., content=...)
+        """
+        waiter = asyncio.get_running_loop().create_future()
+        request_id = self._send(request, waiter)
+        try:
+            return await waiter
+        finally:
+            self._pending.pop(request_id, None)
+
+    async def stream(self, request):
+        """send request and yield decoded chunks of the streamed response
+          *async for chunk in conn.stream(request): ...
+        """
+        chunks = asyncio.Queue()
+        request_id = self._send(request, chunks)
+        try:
+            while True:
+                chunk = await chunks.get()
+                if isinstance(chunk, Exception):
+                    raise chunk
+                if isinstance(chunk, tuple) and chunk[0] is self._END:
+                    _raise_on_error(chunk[1])
+                    break
+                # Chunks are yielded as they arrive, for pushed changes
+                yield chunk
+        finally:
+            self._pending.pop(request_id, None)
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+
+
+class AsyncClient:
+    """Pool of pipelined connections to one server
+      *each request goes to the open connection with the fewest requests
+      *in flight, connections are opened on demand up to pool_size and
+      *replaced when lost
+      *client = AsyncClient(host, port)
+      *responses = await asyncio.gather(*(client.request(r) for r in reqs))
+    """
+    def __init__(self, host: str, port: int, pool_size=4, version=2,
+                 compression=False):
+        self.host = host
+        self.port = port
+        self.pool_size = pool_size
+        self.version = version
+        self.compression = compression
+        self.connections = []
+        self._connecting = None
+
+    async def _connection(self):
+        self.connections = [conn for conn in self.connections
+                            if not conn.closed]
+        idle = min(self.connections, key=lambda conn: conn.in_flight,
+                   default=None)
+        if idle is not None and (idle.in_flight == 0 or
+                                 len(self.connections) >= self.pool_size):
+            return idle
+        if self._connecting is None:
+            self._connecting = asyncio.ensure_future(AsyncConnection.connect(
+                self.host, self.port, version=self.version,
+                compression=self.compression))
+        connecting = self._connecting
+        try:
+            connection = await asyncio.shield(connecting)
+        finally:
+            if self._connecting is connecting:
+                self._connecting = None
+        if connection not in self.connections:
+            self.connections.append(connection)
+        return connection
+
+    async def request(self, request):
+        connection = await self._connection()
+        return await connection.request(request)
+
+    async def stream(self, request):
+        connection = await self._connection()
+        async for chunk in connection.stream(request):
+            yield chunk
+
+    async def close(self):
+        for connection in self.connections:
+            connection.close()
+        self.connections = []
+
+
+class Client:
+    """Blocking API over AsyncClient, which runs in a background event
+      *loop thread, so any number of threads can share one pool
+      *future = client.submit(request) - concurrent.futures.Future
+      *response = client.send(request)
+    """
+    def __init__(self, host: str, port: int, pool_size=4, version=2,
+                 compression=False):
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever,
+                                        daemon=True)
+        self._thread.start()
+        self.async_client = AsyncClient(host, port, pool_size=pool_size,
+                                        version=version,
+                                        compression=compression)
+
+    def submit(self, request):
+        """send request, return concurrent.futures.Future of the response
+        """
+        return asyncio.run_coroutine_threadsafe(
+            self.async_client.request(request), self._loop)
+
+    def send(self, request, timeout=None):
+        return self.submit(request).result(timeout)
+
+    def stream(self, request, timeout=None):
+        """yield decoded chunks of the streamed response
+        """
+        chunks = self.async_client.stream(request)
+        try:
+            while True:
+                try:
+                    yield asyncio.run_coroutine_threadsafe(
+                        chunks.__anext__(), self._loop).result(timeout)
+                except StopAsyncIteration:
+                    return
+        finally:
+            asyncio.run_coroutine_threadsafe(
+                chunks.aclose(), self._loop).result(timeout)
+
+    def close(self):
+        asyncio.run_coroutine_threadsafe(
+            self.async_client.close(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
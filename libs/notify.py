@@ -0,0 +1,261 @@
+"""
+  *table changes pushed to subscribed connections
+  *
+  *ChangeFeed fans changes out to Subscriptions on the event loop, it is
+  *fed by LocalNotifier from the on_table_changed signal of this process
+  *or by PgNotifier, which LISTENs on the channel the NOTIFY triggers of
+  *the tables write to and so sees the writes of every server process
+  *
+  *change = {"table": str, "change": "insert" | "update" | "delete" |
+  *"reset", "key": uni_code of the row or None for the whole table}
+"""
+
+import json
+import select
+import asyncio
+import threading
+import logging as log
+from collections import OrderedDict
+
+try:
+    import psycopg2 as psql
+    import psycopg2.extensions
+except ImportError:
+    # PgNotifier needs psycopg2, LocalNotifier works without it
+    psql = None
+
+# NOTIFY channel of the table change triggers, see MIGRATIONS
+CHANNEL = 'table_changes'
+
+
+class Subscription:
+    """changes of the subscribed tables not sent yet
+      *pending changes are coalesced by (table, key), the last change of
+      *a row wins; past max_pending the changes of a table collapse into
+      *one "reset" change telling the subscriber to re-read it, so a slow
+      *subscriber holds bounded memory and never blocks the feed
+      *async for changes in subscription: ... - lists of changes, ends
+      *when the subscription is closed
+    """
+    def __init__(self, feed, tables, max_pending=1000):
+        self.feed = feed
+        self.tables = frozenset(tables)
+        self.max_pending = max_pending
+        self.coalesced = 0
+        self.closed = False
+        # (table, key) -> change
+        self._pending = OrderedDict()
+        self._ready = asyncio.Event()
+
+    def put(self, change):
+        """queue change, called on the event loop
+        """
+        table = change['table']
+        if (table, None) in self._pending \
+                and self._pending[(table, None)]['change'] == 'reset':
+            # Subscriber re-reads the table anyway
+            self.coalesced += 1
+            return
+        if change['key'] is None or len(self._pending) >= self.max_pending:
+            if change['key'] is not None:
+                change = dict(table=table, change='reset', key=None)
+            for key in [key for key in self._pending if key[0] == table]:
+                del self._pending[key]
+                self.coalesced += 1
+        elif (table, change['key']) in self._pending:
+            del self._pending[(table, change['key'])]
+            self.coalesced += 1
+        self._pending[(table, change['key'])] = change
+        self._ready.set()
+
+    def take(self):
+        """pending changes in arrival order, the buffer is emptied
+        """
+        changes = list(self._pending.values())
+        self._pending.clear()
+        self._ready.clear()
+        return changes
+
+    def close(self):
+        self.closed = True
+        self._ready.set()
+        self.feed.remove(self)
+
+    def __aiter__(self):
+        return self._changes()
+
+    async def _changes(self):
+        try:
+            while True:
+                await self._ready.wait()
+                if self.closed:
+                    return
+                yield self.take()
+        finally:
+            self.close()
+
+
+class ChangeFeed:
+    """table -> subscriptions, publish() may be called from any thread
+      *max_pending : int - changes buffered per subscriber, see
+      *Subscription
+    """
+    def __init__(self, max_pending=1000):
+        self.max_pending = max_pending
+        self.published = 0
+        self._loop = None
+        self._subscriptions = set()
+        self._listeners = []
+
+    def start(self, loop):
+        """deliver changes on loop, published changes are dropped before
+        """
+        self._loop = loop
+
+    def subscribe(self, tables):
+        subscription = Subscription(self, tables, self.max_pending)
+        self._subscriptions.add(subscription)
+        return subscription
+
+    def remove(self, subscription):
+        self._subscriptions.discard(subscription)
+
+    def listen(self, listener):
+        """listener(change, origin) is called on the loop for every change,
+          *origin is the application_name of the DB connection that wrote
+          *it, None if not known
+        """
+        self._listeners.append(listener)
+
+    def publish(self, change, origin=None):
+        if self._loop is None or self._loop.is_closed():
+            return
+        self._loop.call_soon_threadsafe(self._deliver, change, origin)
+
+    def _deliver(self, change, origin):
+        self.published += 1
+        for listener in self._listeners:
+            listener(change, origin)
+        for subscription in self._subscriptions:
+            if change['table'] in subscription.tables:
+                subscription.put(change)
+
+    def close(self):
+        """end every subscription, for shutdown
+        """
+        for subscription in list(self._subscriptions):
+            subscription.close()
+
+    def stats(self):
+        return {
+            "subscriptions": len(self._subscriptions),
+            "published": self.published,
+            "pending": sum(len(subscription._pending)
+                           for subscription in self._subscriptions),
+            "coalesced": sum(subscription.coalesced
+                             for subscription in self._subscriptions),
+        }
+
+
+class LocalNotifier:
+    """publishes the writes of this process, connect on_table_changed to
+      *the DB write signal; for tests and DBs without the NOTIFY triggers
+    """
+    def __init__(self, feed: ChangeFeed):
+        self.feed = feed
+
+    def on_table_changed(self, sender, **kw):
+        table_name = kw['table_name']
+        change = kw['change']
+        if change not in ('insert', 'delete'):
+            return
+        if change == 'insert' and 'rows' in kw:
+            columns = [column.lower() for column in kw['columns']]
+            if 'uni_code' in columns:
+                index = columns.index('uni_code')
+                for row in kw['rows']:
+                    self.feed.publish(dict(table=table_name, change=change,
+                                           key=row[index]))
+                return
+        self.feed.publish(dict(table=table_name, change=change, key=None))
+
+    def start(self):
+        return
+
+    def stop(self):
+        return
+
+
+class PgNotifier:
+    """LISTEN on CHANNEL in a thread with its own DB connection
+      *after a lost connection every table is published as "reset",
+      *notifications sent while it was down are lost
+      *poll_interval : float - seconds between checks of stop()
+    """
+    def __init__(self, feed: ChangeFeed, data_base, poll_interval=1.0,
+                 retry_delay=1.0):
+        self.feed = feed
+        self.data_base = data_base
+        self.poll_interval = poll_interval
+        self.retry_delay = retry_delay
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name="pg-notifier")
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _connect(self):
+        data_base = self.data_base
+        connection = psql.connect(
+            host=data_base.host, port=data_base.port,
+            database=data_base.db_name, user=data_base.user,
+            password=data_base.password)
+        connection.set_isolation_level(
+            psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        with connection.cursor() as cursor:
+            cursor.execute(f"LISTEN {CHANNEL}")
+        return connection
+
+    def _run(self):
+        reconnect = False
+        while not self._stopped.is_set():
+            try:
+                connection = self._connect()
+            except psql.Error as Error:
+                log.debug(f"notifier can not connect...\n{Error}")
+                self._stopped.wait(self.retry_delay)
+                continue
+            if reconnect:
+                for table_name in self.data_base.db_tables:
+                    self.feed.publish(
+                        dict(table=table_name, change='reset', key=None))
+            reconnect = True
+            try:
+                self._listen(connection)
+            except (psql.Error, OSError) as Error:
+                log.debug(f"notifier connection lost...\n{Error}")
+            finally:
+                connection.close()
+
+    def _listen(self, connection):
+        while not self._stopped.is_set():
+            readable, _, _ = select.select(
+                [connection], [], [], self.poll_interval)
+            if not readable:
+                continue
+            connection.poll()
+            while connection.notifies:
+                notify = connection.notifies.pop(0)
+                try:
+                    change = json.loads(notify.payload)
+                    origin = change.pop('origin', None)
+                    self.feed.publish(change, origin=origin)
+                except ValueError:
+                    log.debug(f"invalid notification {notify.payload!r}")
@@ -0,0 +1,445 @@
+"""
+  *in-memory index of the organization -> department -> person hierarchy
+  *
+  *organization.department_uni_codes and department.persons_uni_codes
+  *link the tables, the index keeps id -> row and uni_code -> ids for every
+  *table (uni_code is not unique) and child -> parent codes for departments
+  *and persons, so tree queries are answered without the DB
+  *
+  *headcount and salary totals per department and organization are kept
+  *as a summary: person writes update the running totals of the groups
+  *the person is in, department and organization writes only mark their
+  *groups, and removing a group's min or max salary marks the group, to
+  *be recomputed by the next salary_stats()
+"""
+
+import threading
+from collections import Counter
+from contextlib import contextmanager
+
+from libs.storage import column_kinds
+
+ORGANIZATION = 'organization'
+DEPARTMENT = 'department'
+PERSON = 'person'
+TABLES = (ORGANIZATION, DEPARTMENT, PERSON)
+
+# table -> (child table, column with uni_codes of the children)
+CHILDREN = {
+    ORGANIZATION: (DEPARTMENT, 'department_uni_codes'),
+    DEPARTMENT: (PERSON, 'persons_uni_codes'),
+}
+# child table -> parent table
+PARENTS = {DEPARTMENT: ORGANIZATION, PERSON: DEPARTMENT}
+SALARY = 'salary_month_usd'
+# salary_stats columns after the group uni_code
+STATS_COLUMNS = ('count', 'sum', 'avg', 'min', 'max')
+# Summary key of the totals over every person, groups are keyed
+# (table, uni_code)
+ALL_PERSONS = None
+
+
+class Hierarchy:
+    """rows, links and salary totals of the three tables, the state
+      *load() builds whole before OrgIndex swaps it in
+      *totals are counted like DB.salary_stats joins the rows: a person
+      *listed by two department rows of one group counts twice
+    """
+    def __init__(self):
+        # table -> id -> row dict
+        self.rows = {ORGANIZATION: {}, DEPARTMENT: {}, PERSON: {}}
+        # table -> uni_code -> ids of the rows
+        self.ids = {ORGANIZATION: {}, DEPARTMENT: {}, PERSON: {}}
+        # child table -> child uni_code -> Counter of parent uni_code ->
+        # parent rows listing the child
+        self.parents = {DEPARTMENT: {}, PERSON: {}}
+        # Summary key -> [persons, salaries, sum, min, max]
+        self.totals = {ALL_PERSONS: [0, 0, 0, None, None]}
+        # Summary keys to recompute before they are read
+        self.stale = set()
+
+    def add(self, table_name, names, table_rows):
+        """rows of the table, columns missing in names are None, a row
+          *with the id of an indexed row replaces it
+        """
+        names = [name.lower() for name in names]
+        blank = dict.fromkeys(column_kinds(table_name))
+        rows = self.rows[table_name]
+        for values in table_rows:
+            row = dict(blank)
+            row.update(zip(names, values))
+            row_id = row['id']
+            if row_id is None:
+                continue
+            if row_id in rows:
+                self.remove(table_name, [row_id])
+            rows[row_id] = row
+            self.ids[table_name].setdefault(row['uni_code'], set()).add(
+                row_id)
+            self._link(table_name, row, 1)
+
+    def remove(self, table_name, row_ids):
+        for row_id in row_ids:
+            row = self.rows[table_name].pop(row_id, None)
+            if row is None:
+                continue
+            ids = self.ids[table_name][row['uni_code']]
+            ids.discard(row_id)
+            if not ids:
+                del self.ids[table_name][row['uni_code']]
+            self._link(table_name, row, -1)
+
+    def clear(self, table_name):
+        self.remove(table_name, list(self.rows[table_name]))
+
+    def replace(self, table_name, uni_codes, names, table_rows):
+        """rows of the uni_codes are table_rows now
+        """
+        ids = self.ids[table_name]
+        self.remove(table_name, [row_id for code in uni_codes
+                                 for row_id in list(ids.get(code, ()))])
+        self.add(table_name, names, table_rows)
+
+    def _link(self, table_name, row, times):
+        """count the row in (times 1) or out of (times -1) the parent
+          *links and the totals
+        """
+        uni_code = row['uni_code']
+        if table_name == PERSON:
+            self._count_person(uni_code, row[SALARY], times)
+            return
+        child_table, children = CHILDREN[table_name]
+        parents = self.parents[child_table]
+        for child in set(row[children] or ()):
+            links = parents.setdefault(child, Counter())
+            links[uni_code] += times
+            if links[uni_code] <= 0:
+                del links[uni_code]
+                if not links:
+                    del parents[child]
+        self.stale.add((table_name, uni_code))
+        if table_name == DEPARTMENT:
+            self.stale.update(
+                (ORGANIZATION, organization) for organization
+                in self.parents[DEPARTMENT].get(uni_code, ()))
+
+    def _count_person(self, uni_code, salary, times):
+        self._count(ALL_PERSONS, salary, times)
+        departments = self.parents[PERSON].get(uni_code, {})
+        for department, department_times in departments.items():
+            self._count((DEPARTMENT, department), salary,
+                        times * department_times)
+            organizations = self.parents[DEPARTMENT].get(department, {})
+            for organization, organization_times in organizations.items():
+                self._count((ORGANIZATION, organization), salary,
+                            times * department_times * organization_times)
+
+    def _count(self, key, salary, times):
+        if key in self.stale:
+            return
+        totals = self.totals.setdefault(key, [0, 0, 0, None, None])
+        totals[0] += times
+        if salary is None:
+            return
+        totals[1] += times
+        totals[2] += salary * times
+        if times < 0:
+            if salary in (totals[3], totals[4]):
+                # The extreme may be gone, only a recount can tell
+                self.stale.add(key)
+            return
+        totals[3] = salary if totals[3] is None else min(totals[3], salary)
+        totals[4] = salary if totals[4] is None else max(totals[4], salary)
+
+    def persons(self, uni_codes):
+        """person rows of the uni_codes, each once, in id order
+        """
+        ids = self.ids[PERSON]
+        return [self.rows[PERSON][row_id] for row_id in sorted(
+            {row_id for code in uni_codes for row_id in ids.get(code, ())})]
+
+    def _group_salaries(self, key):
+        """salaries, None included, of every person row joined to the group
+        """
+        if key is ALL_PERSONS:
+            return [person[SALARY] for person in self.rows[PERSON].values()]
+        table_name, uni_code = key
+        departments = [self.rows[table_name][row_id]
+                       for row_id in self.ids[table_name].get(uni_code, ())]
+        if table_name == ORGANIZATION:
+            departments = [
+                self.rows[DEPARTMENT][row_id]
+                for organization in departments
+                for code in set(organization['department_uni_codes'] or ())
+                for row_id in self.ids[DEPARTMENT].get(code, ())]
+        return [self.rows[PERSON][row_id][SALARY]
+                for department in departments
+                for code in set(department['persons_uni_codes'] or ())
+                for row_id in self.ids[PERSON].get(code, ())]
+
+    def refresh_totals(self):
+        for key in self.stale:
+            if key is not ALL_PERSONS and key[1] not in self.ids[key[0]]:
+                self.totals.pop(key, None)
+                continue
+            persons = self._group_salaries(key)
+            salaries = [salary for salary in persons if salary is not None]
+            self.totals[key] = [
+                len(persons), len(salaries), sum(salaries),
+                min(salaries, default=None), max(salaries, default=None)]
+        self.stale.clear()
+
+
+class OrgIndex:
+    """Hierarchy of the DB tables
+      *built by load() from the DB, kept up to date by connecting
+      *on_table_changed(sender, table_name, change, columns, rows) to the
+      *DB write signal
+    """
+    def __init__(self, data_base):
+        self.data_base = data_base
+        self.hierarchy = Hierarchy()
+        self.loaded = False
+        # Change lists of the DB reads in progress, the changes seen while
+        # a read runs are replayed on its result
+        self._readers = []
+        # Writes come from DB worker threads
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def _reading(self):
+        changes = []
+        with self._lock:
+            self._readers.append(changes)
+        try:
+            yield changes
+        finally:
+            with self._lock:
+                self._readers.remove(changes)
+
+    def _change(self, change, reader=None):
+        """apply change, to be replayed by the reads in progress but the
+          *reader's
+        """
+        for changes in self._readers:
+            if changes is not reader:
+                changes.append(change)
+        self._apply(self.hierarchy, change)
+
+    def load(self):
+        """(re)build the index from the DB, tables missing in the DB or
+          *failing to read are left empty
+        """
+        with self._reading() as changes:
+            hierarchy = Hierarchy()
+            for table_name in TABLES:
+                if table_name not in self.data_base.db_tables:
+                    continue
+                answer = self.data_base.read_rows('*', table_name)
+                if answer is None:
+                    continue
+                names, table_rows = answer
+                hierarchy.add(table_name, names, table_rows)
+            with self._lock:
+                for change in changes:
+                    self._apply(hierarchy, change)
+                self.hierarchy = hierarchy
+                self.loaded = True
+
+    def sync(self, table_name, uni_codes, page_size=1000):
+        """re-read the rows of the uni_codes from the DB, for writes the
+          *on_table_changed signal of this process does not see
+          *return False if the DB read failed
+        """
+        uni_codes = list(uni_codes)
+        rows = []
+        after = None
+        with self._reading() as changes:
+            while True:
+                answer = self.data_base.read_page(
+                    table_name, where={'uni_code': {'in': uni_codes}},
+                    after=after, limit=page_size)
+                if answer is None:
+                    return False
+                names, page = answer
+                rows.extend(page)
+                if len(page) < page_size:
+                    break
+                # Key of order_by "id" is appended to the rows
+                after = [page[-1][-1]]
+            with self._lock:
+                self._change(dict(table_name=table_name, change='replace',
+                                  uni_codes=uni_codes, columns=names,
+                                  rows=rows), reader=changes)
+                for change in changes:
+                    self._apply(self.hierarchy, change)
+        return True
+
+    def on_table_changed(self, sender, **kw):
+        if kw['table_name'] not in TABLES:
+            return
+        with self._lock:
+            self._change(kw)
+
+    @staticmethod
+    def _apply(hierarchy, change):
+        table_name = change['table_name']
+        if change['change'] == 'replace':
+            hierarchy.replace(table_name, change['uni_codes'],
+                              change['columns'], change['rows'])
+        elif change['change'] == 'insert' and 'rows' in change:
+            hierarchy.add(table_name, change['columns'], change['rows'])
+        elif change['change'] in ('insert', 'delete'):
+            # Unknown rows changed, drop what the index has of the table
+            hierarchy.clear(table_name)
+
+    def _first(self, table_name, uni_code):
+        """row of the uni_code with the lowest id, None if not found
+        """
+        ids = self.hierarchy.ids[table_name].get(uni_code)
+        if not ids:
+            return None
+        return self.hierarchy.rows[table_name][min(ids)]
+
+    def _parent(self, table_name, uni_code):
+        """row with the lowest id listing the uni_code, None if not found
+        """
+        parent_table = PARENTS[table_name]
+        children = CHILDREN[parent_table][1]
+        rows = self.hierarchy.rows[parent_table]
+        ids = self.hierarchy.ids[parent_table]
+        return min((rows[row_id] for code
+                    in self.hierarchy.parents[table_name].get(uni_code, ())
+                    for row_id in ids[code]
+                    if uni_code in (rows[row_id][children] or ())),
+                   key=lambda row: row['id'], default=None)
+
+    def _children(self, table_name, row):
+        child_table, children = CHILDREN[table_name]
+        ids = self.hierarchy.ids[child_table]
+        rows = self.hierarchy.rows[child_table]
+        return [rows[row_id] for code in row[children] or ()
+                for row_id in sorted(ids.get(code, ()))]
+
+    def _department_tree(self, department):
+        return dict(department,
+                    persons=self._children(DEPARTMENT, department))
+
+    def _organization_tree(self, organization):
+        return dict(organization, departments=[
+            self._department_tree(department)
+            for department in self._children(ORGANIZATION, organization)])
+
+    def org_tree(self, uni_code=None):
+        """organization row with "departments", each with "persons",
+          *all organizations if uni_code is None, None if not found
+        """
+        with self._lock:
+            organizations = self.hierarchy.rows[ORGANIZATION]
+            if uni_code is None:
+                return [self._organization_tree(organizations[row_id])
+                        for row_id in sorted(organizations)]
+            organization = self._first(ORGANIZATION, uni_code)
+            if organization is None:
+                return None
+            return self._organization_tree(organization)
+
+    def department_persons(self, uni_code):
+        """person rows of the departments with the uni_code, in id order,
+          *None if not found
+        """
+        with self._lock:
+            hierarchy = self.hierarchy
+            ids = hierarchy.ids[DEPARTMENT].get(uni_code)
+            if not ids:
+                return None
+            return hierarchy.persons(
+                code for row_id in ids for code
+                in hierarchy.rows[DEPARTMENT][row_id]['persons_uni_codes']
+                or ())
+
+    def organization_persons(self, uni_code):
+        """person rows of the departments of the organizations with the
+          *uni_code, in id order, None if not found
+        """
+        with self._lock:
+            hierarchy = self.hierarchy
+            ids = hierarchy.ids[ORGANIZATION].get(uni_code)
+            if not ids:
+                return None
+            departments = {
+                code for row_id in ids for code in hierarchy.rows[
+                    ORGANIZATION][row_id]['department_uni_codes'] or ()}
+            return hierarchy.persons(
+                code for department in departments
+                for row_id in hierarchy.ids[DEPARTMENT].get(department, ())
+                for code in hierarchy.rows[DEPARTMENT][row_id][
+                    'persons_uni_codes'] or ())
+
+    def person_departments(self, uni_code):
+        """distinct {"department_uni_code", "organization_uni_code"} of
+          *the departments listing the person, organization None for a
+          *department of none, in order; None if there is neither one nor
+          *a person row
+        """
+        with self._lock:
+            parents = self.hierarchy.parents
+            pairs = sorted(
+                ((department, organization) for department
+                 in parents[PERSON].get(uni_code, ())
+                 for organization
+                 in parents[DEPARTMENT].get(department) or [None]),
+                key=lambda pair: (pair[0], pair[1] is None, pair[1]))
+            if not pairs and uni_code not in self.hierarchy.ids[PERSON]:
+                return None
+            return [dict(department_uni_code=department,
+                         organization_uni_code=organization)
+                    for department, organization in pairs]
+
+    def person_org(self, uni_code):
+        """{"person", "department", "organization"} rows of the person,
+          *None if not found, unknown parents are None; of rows sharing a
+          *uni_code the one with the lowest id, its parents list it
+        """
+        with self._lock:
+            person = self._first(PERSON, uni_code)
+            if person is None:
+                return None
+            department = self._parent(PERSON, uni_code)
+            return {
+                "person": person,
+                "department": department,
+                "organization": department and self._parent(
+                    DEPARTMENT, department['uni_code']),
+            }
+
+    @staticmethod
+    def _stats(totals):
+        """STATS_COLUMNS values of a summary entry
+        """
+        persons, salaries, total, low, high = totals
+        return [persons, total if salaries else None,
+                total / salaries if salaries else None, low, high]
+
+    def salary_stats(self, group_by=None):
+        """headcount and salary_month_USD sum, avg, min and max from the
+          *summary, same result as DB.salary_stats
+          *group_by : str - None, "department" or "organization"
+          *return (column names, rows), one row per group
+        """
+        if group_by not in (None, DEPARTMENT, ORGANIZATION):
+            raise ValueError(f'Invalid group "{group_by}".')
+        with self._lock:
+            hierarchy = self.hierarchy
+            hierarchy.refresh_totals()
+            if group_by is None:
+                return list(STATS_COLUMNS), [
+                    self._stats(hierarchy.totals[ALL_PERSONS])]
+            return ['uni_code'] + list(STATS_COLUMNS), [
+                [code] + self._stats(hierarchy.totals[group_by, code])
+                for code in sorted(hierarchy.ids[group_by])]
+
+    def stats(self):
+        with self._lock:
+            return {table_name: len(rows)
+                    for table_name, rows in self.hierarchy.rows.items()}
@@ -0,0 +1,172 @@
+"""
+  *action dispatch for json requests
+  *
+  *router = Router(middleware=(timing,))
+  *@router.action('read_table', cached(read_table_key))
+  *async def read_table(sender, request): ...
+  *
+  *handlers are looked up by request["action"] in one dict, middleware is
+  *wrapped around a handler once when it is added, not on every request
+"""
+
+import time
+import inspect
+
+from libs.framing import json_encode
+
+
+class HandlerError(Exception):
+    """raised by a handler or middleware, answered as "Error: ..." result
+    """
+    def response(self):
+        return json_response(f'Error: {self}')
+
+
+def json_response(result):
+    content_encoding = "utf-8"
+    return {
+        "content_bytes": json_encode({"result": result}, content_encoding),
+        "content_type": "text/json",
+        "content_encoding": content_encoding,
+    }
+
+
+def is_response(response):
+    """encoded response dict, sent as is
+    """
+    return isinstance(response, dict) and "content_bytes" in response
+
+
+def _encoded(handler):
+    """coroutine handler returning encoded responses
+      *handler may be sync or async and return a response dict (sent
+      *pre-encoded, e.g. cached bytes), an async iterator of them (stream)
+      *or any other result, sent as JSON {"result": result}
+    """
+    async def encoded(sender, request):
+        response = handler(sender, request)
+        if inspect.isawaitable(response):
+            response = await response
+        if is_response(response) or hasattr(response, "__aiter__"):
+            return response
+        return json_response(response)
+    return encoded
+
+
+def _answer_errors(handler):
+    async def answer_errors(sender, request):
+        try:
+            return await handler(sender, request)
+        except HandlerError as Error:
+            return Error.response()
+    return answer_errors
+
+
+class Router:
+    """action -> handler registry
+      *middleware : callable(action, handler) -> handler, wrapped around
+      *every handler, first one outermost; per-action middleware goes
+      *inside the router-wide one
+    """
+    def __init__(self, middleware=()):
+        self.middleware = tuple(middleware)
+        self.handlers = {}
+
+    def add(self, action, handler, *middleware):
+        handler = _encoded(handler)
+        for wrap in reversed(self.middleware + middleware):
+            handler = wrap(action, handler)
+        self.handlers[action] = _answer_errors(handler)
+
+    def action(self, action, *middleware):
+        """decorator version of add()
+        """
+        def register(handler):
+            self.add(action, handler, *middleware)
+            return handler
+        return register
+
+    def dispatch(self, sender, request):
+        """awaitable of the response to the json request
+        """
+        action = request.get('action')
+        handler = self.handlers.get(action)
+        if handler is None:
+            return self._invalid(action)
+        return handler(sender, request)
+
+    async def _invalid(self, action):
+        return json_response(f'Error: invalid action "{action}".')
+
+
+class Timing:
+    """middleware counting requests and handler time per action
+      *streams are timed until the first chunk is ready
+    """
+    def __init__(self):
+        # action -> [requests, errors, total seconds, max seconds]
+        self._actions = {}
+
+    def __call__(self, action, handler):
+        counters = self._actions.setdefault(action, [0, 0, 0.0, 0.0])
+
+        async def timed(sender, request):
+            start = time.perf_counter()
+            try:
+                return await handler(sender, request)
+            except Exception:
+                counters[1] += 1
+                raise
+            finally:
+                elapsed = time.perf_counter() - start
+                counters[0] += 1
+                counters[2] += elapsed
+                counters[3] = max(counters[3], elapsed)
+        return timed
+
+    def stats(self):
+        return {
+            action: {
+                "requests": requests,
+                "errors": errors,
+                "avg_ms": total / requests * 1000 if requests else None,
+                "max_ms": longest * 1000,
+            }
+            for action, (requests, errors, total, longest)
+            in self._actions.items()
+        }
+
+
+def cached(make_key):
+    """middleware answering from sender.cache, see ResultCache
+      *make_key : callable(request) -> ResultCache key, table is key[1]
+    """
+    def middleware(action, handler):
+        async def cached_handler(sender, request):
+            key = make_key(request)
+            response = sender.cache.get(key)
+            if response is not None:
+                return response
+            generation = sender.cache.generation(key[1])
+            response = await handler(sender, request)
+            if is_response(response):
+                sender.cache.put(key, response, generation)
+            return response
+        return cached_handler
+    return middleware
+
+
+def validate(**fields):
+    """middleware checking request field types
+      *validate(value=list, chunk_size=(int, type(None)))
+    """
+    def middleware(action, handler):
+        async def validated(sender, request):
+            for name, types in fields.items():
+                if not isinstance(request.get(name), types):
+                    raise HandlerError(
+                        f'{action} {name} has invalid type '
+                        f'{type(request.get(name)).__name__}.')
+            return await handler(sender, request)
+        return validated
+    return middleware
@@ -4,69 +4,489 @@
 """
 
 #libs for DB server side 
-import psycopg2 as psql
+try:
+    import psycopg2 as psql
+    import psycopg2.pool
+    import psycopg2.extras
+    import psycopg2.errors
+    from psycopg2 import sql as psql_sql
+except ImportError:
+    # Only the in-memory storage is available, see libs.memory_db
+    psql = psql_sql = None
 import logging as log
+import threading
+import itertools
+import time
+import uuid
 import sys
+import re
+import weakref
+from contextlib import contextmanager
+from libs.storage import Storage, on_table_changed, SCHEMA, PAGE_ORDERS, \
+    FILTERS, INDEX_METHODS, column_kinds
 
+# Column names accepted from requests, anything else is rejected
+IDENTIFIER = re.compile(r"[A-Za-z_][A-Za-z0-9_]*\Z")
 
-class DB:
+# salary_stats aggregates of person p
+SALARY_STATS = (
+    "count(p.id) AS count, sum(p.salary_month_usd) AS sum, "
+    "avg(p.salary_month_usd)::float8 AS avg, "
+    "min(p.salary_month_usd) AS min, max(p.salary_month_usd) AS max")
+# salary_stats group -> (tables, query), groups without persons count 0
+SALARY_QUERIES = {
+    None: (('person',), f"SELECT {SALARY_STATS} FROM person p"),
+    'department': (
+        ('department', 'person'),
+        f"SELECT d.uni_code, {SALARY_STATS} FROM department d "
+        "LEFT JOIN person p ON p.uni_code = ANY(d.persons_uni_codes) "
+        "GROUP BY d.uni_code ORDER BY d.uni_code"),
+    'organization': (
+        ('organization', 'department', 'person'),
+        f"SELECT o.uni_code, {SALARY_STATS} FROM organization o "
+        "LEFT JOIN department d ON d.uni_code = ANY(o.department_uni_codes) "
+        "LEFT JOIN person p ON p.uni_code = ANY(d.persons_uni_codes) "
+        "GROUP BY o.uni_code ORDER BY o.uni_code"),
+}
+
+# read_page where operators of FILTERS -> SQL with {column} and {value}
+FILTER_OPERATORS = {
+    '=': "{} = {}",
+    '!=': "{} <> {}",
+    '<': "{} < {}",
+    '<=': "{} <= {}",
+    '>': "{} > {}",
+    '>=': "{} >= {}",
+    'in': "{} = ANY({})",
+    'contains': "{} @> {}",
+}
+
+
+if psql is not None:
+    class ConnectionPool(psql.pool.ThreadedConnectionPool):
+        """ThreadedConnectionPool keeping every returned connection, up to
+          *maxconn; the base pool closes the ones above minconn, so each
+          *concurrent checkout past the first would reconnect
+          *minconn connections are still opened up front
+        """
+        def __init__(self, minconn, maxconn, *args, **kwargs):
+            super().__init__(minconn, maxconn, *args, **kwargs)
+            # _putconn keeps up to minconn idle connections
+            self.minconn = self.maxconn
+
+
+class DB(Storage):
     def __init__(self, host: str, db_name: str, 
-                 user: str, password: str, db_tables: tuple, port=5432):
-        """ DB read & write class 
+                 user: str, password: str, db_tables: tuple, port=5432,
+                 min_connections=1, max_connections=4, max_streams=None,
+                 health_check_interval=30.0, max_prepared=64):
+        """ DB read & write class, PostgreSQL storage
+          *min_connections : int - connections opened by connect()
+          *max_connections : int - connection pool size, returned
+          *connections stay open up to it
+          *max_streams : int - open stream_rows results, each keeps a pooled
+          *connection between fetches; below max_connections so the other
+          *calls always get one, max_connections - 1 by default
+          *health_check_interval : float - seconds a pooled connection may
+          *stay idle before it is checked with "select 1" on checkout
+          *max_prepared : int - prepared statements kept per connection
+          *application_name of the connections is unique per DB object,
+          *the NOTIFY triggers send it as the origin of a change
         """
+        super().__init__(db_tables, max_connections=max_connections)
         self.host = host
         self.port = port
         self.db_name = db_name
-        self.db_tables = db_tables
         self.user = user
         self.password = password
+        self.min_connections = min_connections
+        self.health_check_interval = health_check_interval
+        self.pool = None
+        self._slots = threading.BoundedSemaphore(max_connections)
+        if max_streams is None:
+            max_streams = max_connections - 1
+        if max_streams >= max_connections:
+            raise ValueError('max_streams must be below max_connections.')
+        self.max_streams = max_streams
+        self._stream_slots = threading.BoundedSemaphore(max_streams)
+        # connection -> time it was returned to the pool, weak so a new
+        # connection never inherits the state of a closed one
+        self._last_used = weakref.WeakKeyDictionary()
+        self._cursor_ids = itertools.count()
+        self.max_prepared = max_prepared
+        self.application_name = f"pseudoorg-{uuid.uuid4().hex[:16]}"
+        # connection -> {statement shape: prepared statement name}
+        self._prepared = weakref.WeakKeyDictionary()
+        self._statement_ids = itertools.count()
 
     def connect(self):
-        """start connection with the sql server
+        """start connection pool with the sql server
+        """
+        self.pool = ConnectionPool(
+            self.min_connections, self.max_connections,
+            host=self.host, port=self.port, database=self.db_name,
+            user=self.user, password=self.password,
+            application_name=self.application_name)
+        return self.pool
+
+    def close(self):
+        """close all pooled connections
+        """
+        if self.pool is not None:
+            self.pool.closeall()
+            self.pool = None
+        self._prepared.clear()
+
+    def migrate(self):
+        return migrate(self)
+
+    def reset(self):
+        super().reset()
+        self._execute_sql("DROP TABLE IF EXISTS schema_version")
+
+    def _is_db_online(self, connection):
+        """check that connection is alive
         """
-        self.connection = psql.connect(host=self.host, port=self.port, 
-                                       database=self.db_name, user=self.user,
-                                       password=self.password)
-        self.cursor = self.connection.cursor()
-        return self.connection
+        if connection.closed:
+            return False
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute("select 1")
+            connection.rollback()
+            return True
+        except(psql.OperationalError, psql.InterfaceError) as Error:
+            log.debug(f"DB connection lost...\n{Error}")
+            return False
 
-    def _is_db_online(self):
-        """Nothing yet
+    def _get_connection(self):
+        """get healthy connection from the pool, broken connections left
+          *after DB restart are replaced by new ones
         """
-        self.cursor.execute("select 1")
+        for _ in range(self.max_connections + 1):
+            connection = self.pool.getconn()
+            last_used = self._last_used.get(connection)
+            if last_used is None:
+                return connection
+            idle = time.monotonic() - last_used
+            if not connection.closed and idle < self.health_check_interval:
+                return connection
+            if self._is_db_online(connection):
+                return connection
+            self._put_connection(connection, close=True)
+        raise psql.OperationalError("No healthy DB connection")
+
+    def _put_connection(self, connection, close=False):
+        if close or connection.closed:
+            self._last_used.pop(connection, None)
+            self._prepared.pop(connection, None)
+            self.pool.putconn(connection, close=True)
+        else:
+            self._last_used[connection] = time.monotonic()
+            self.pool.putconn(connection)
+            if connection.closed:
+                # The pool drops connections lost by the server
+                self._last_used.pop(connection, None)
+                self._prepared.pop(connection, None)
+
+    @contextmanager
+    def checkout(self):
+        """check out connection for one request and return it to the pool
+          *with data_base.checkout() as connection: ...
+          *transaction is rolled back if the block raises
+        """
+        with self._slots:
+            connection = self._get_connection()
+            broken = False
+            try:
+                yield connection
+            except(psql.OperationalError, psql.InterfaceError):
+                broken = True
+                raise
+            except Exception:
+                if not connection.closed:
+                    connection.rollback()
+                raise
+            finally:
+                self._put_connection(connection, close=broken)
 
     def _is_table_exists(self, table_name):
         """check if table exists in db
         """
-        self.cursor().execute(f"SELECT * FROM information_schema.tables WHERE table_name={table_name};")
-        self.cursor().commit()
-        if self.cursor.fetchone()[0] == 1:
+        row = self._execute_sql(
+            "SELECT count(*) FROM information_schema.tables "
+            "WHERE table_name = %s;", (table_name,))
+        if row is not None and row[0] == 1:
             return True
         return False
 
-    def _execute_sql(self, sql: str):
+    def _execute_sql(self, sql, params=None):
         try:
-            self.cursor.execute(sql)
-            self.connection.commit()
-            return self.cursor.fetchone()
+            with self.checkout() as connection:
+                with connection.cursor() as cursor:
+                    cursor.execute(sql, params)
+                    connection.commit()
+                    if cursor.description is not None:
+                        return cursor.fetchone()
+                    return None
+        except(Exception, psql.DatabaseError) as Error:
+            log.debug(f"DB execution Error...\n{Error}")
+            return None
+
+    def _query_rows(self, sql, params=None):
+        """run query, return (column names, rows) or None on error
+        """
+        try:
+            with self.checkout() as connection:
+                with connection.cursor() as cursor:
+                    cursor.execute(sql, params)
+                    rows = cursor.fetchall()
+                    connection.commit()
+                    names = [column[0] for column in cursor.description]
+                    return names, rows
+        except(Exception, psql.DatabaseError) as Error:
+            log.debug(f"DB execution Error...\n{Error}")
+            return None
+
+    def _execute_prepared(self, cursor, shape, sql, params=()):
+        """execute sql as a server-side prepared statement
+          *shape : tuple - key of the statement, same shape same sql
+          *sql : Composable - statement with $1, $2... placeholders
+          *the statement is PREPAREd once per connection, later calls
+          *only send EXECUTE with the bound values and reuse the plan
+          *a statement the server no longer knows is PREPAREd again when
+          *the EXECUTE opened the transaction, inside a running one the
+          *error is raised and the next call prepares it
+        """
+        connection = cursor.connection
+        statements = self._prepared.setdefault(connection, {})
+        name = statements.get(shape)
+        if name is not None:
+            opens_transaction = connection.info.transaction_status == \
+                psql.extensions.TRANSACTION_STATUS_IDLE
+            try:
+                self._execute_statement(cursor, name, params)
+                return
+            except psql.errors.InvalidSqlStatementName:
+                del statements[shape]
+                if not opens_transaction:
+                    raise
+                connection.rollback()
+        name = self._prepare(cursor, statements, shape, sql)
+        self._execute_statement(cursor, name, params)
+
+    def _prepare(self, cursor, statements, shape, sql):
+        """PREPARE sql for the connection of cursor, return its name
+        """
+        if len(statements) >= self.max_prepared:
+            cursor.execute("DEALLOCATE ALL")
+            statements.clear()
+        # Unique names, a PREPARE left by a failed transaction is
+        # never redefined
+        name = f"stmt_{next(self._statement_ids)}"
+        cursor.execute(psql_sql.SQL("PREPARE {} AS {}").format(
+            psql_sql.Identifier(name), sql))
+        statements[shape] = name
+        return name
+
+    @staticmethod
+    def _execute_statement(cursor, name, params):
+        if params:
+            cursor.execute(psql_sql.SQL("EXECUTE {} ({})").format(
+                psql_sql.Identifier(name),
+                psql_sql.SQL(", ").join(
+                    psql_sql.Placeholder() * len(params))), params)
+        else:
+            cursor.execute(psql_sql.SQL("EXECUTE {}").format(
+                psql_sql.Identifier(name)))
+
+    def _query_prepared(self, shape, sql, params=(), fetch_all=True):
+        """run prepared query in own transaction
+          *return (column names, rows), first row if not fetch_all,
+          *None on error
+        """
+        try:
+            with self.checkout() as connection:
+                with connection.cursor() as cursor:
+                    self._execute_prepared(cursor, shape, sql, params)
+                    if fetch_all:
+                        rows = cursor.fetchall()
+                    else:
+                        rows = cursor.fetchone()
+                    connection.commit()
+                    if not fetch_all:
+                        return rows
+                    names = [column[0] for column in cursor.description]
+                    return names, rows
         except(Exception, psql.DatabaseError) as Error:
             log.debug(f"DB execution Error...\n{Error}")
             return None
 
     def read_values(self, var_name, table_name):
-        sql = f'SELECT {var_name} FROM {table_name};'
-        return self._execute_sql(sql)
+        """first row of the table
+        """
+        return self._query_prepared(*self._select(var_name, table_name),
+                                    fetch_all=False)
 
-    def insert_value(self, table_name: str, var_name, value):
-        """table_name = str - name of the table
-          *var_to_insert_value = str - name of the var
-          *value = ? - value
-          *out_var_name = - value which would be returned (id or uni_code)
+    def read_rows(self, var_name, table_name):
+        """all rows of the table as (column names, rows)
         """
-        if table_name in self.db_tables:
-            
-            sql = f"""INSERT INTO {table_name}({var_name}) VALUES ({value});"""
-            return self._execute_sql(sql)
+        return self._query_prepared(*self._select(var_name, table_name))
+
+    def read_page(self, table_name, columns='*', where=None, order_by='id',
+                  after=None, limit=100):
+        """one page of rows in order_by order, keyset pagination: the next
+          *page starts after the key of the last row, so every page costs
+          *one index range scan whatever its number
+          *where : dict - {column: value} or {column: {operator: value}},
+          *operators are FILTERS, predicates are ANDed
+          *order_by : str - key of PAGE_ORDERS
+          *after : list - key values of the last row of the previous page
+          *return (column names, rows) or None on DB error, the key
+          *columns of order_by are appended to every row
+        """
+        self._check_page(table_name, columns, where, order_by, after, limit)
+        keys = PAGE_ORDERS[order_by]
+        columns = self._column_names(columns)
+        if columns == '*':
+            columns_sql = [psql_sql.SQL('*')]
+        else:
+            columns_sql = [self._identifier(column) for column in columns]
+        columns_sql.extend(self._identifier(key) for key in keys)
+        predicates = []
+        for column, condition in sorted((where or {}).items()):
+            if not isinstance(condition, dict):
+                condition = {'=': condition}
+            for operator, value in sorted(condition.items()):
+                predicates.append((column.lower(), operator, value))
+        params = [value for column, operator, value in predicates]
+        conditions = [
+            psql_sql.SQL(FILTER_OPERATORS[operator]).format(
+                self._identifier(column), psql_sql.SQL(f"${i}"))
+            for i, (column, operator, value) in enumerate(predicates, 1)]
+        if after is not None:
+            first = len(params) + 1
+            params.extend(after)
+            conditions.append(psql_sql.SQL("({}) > ({})").format(
+                psql_sql.SQL(", ").join(map(self._identifier, keys)),
+                psql_sql.SQL(", ").join(
+                    psql_sql.SQL(f"${i}")
+                    for i in range(first, first + len(keys)))))
+        params.append(limit)
+        sql = psql_sql.SQL("SELECT {} FROM {}{} ORDER BY {} LIMIT {}").format(
+            psql_sql.SQL(", ").join(columns_sql),
+            self._identifier(table_name),
+            psql_sql.SQL(" WHERE ") + psql_sql.SQL(" AND ").join(conditions)
+            if conditions else psql_sql.SQL(""),
+            psql_sql.SQL(", ").join(map(self._identifier, keys)),
+            psql_sql.SQL(f"${len(params)}"))
+        shape = ('page', table_name, columns, order_by, after is not None,
+                 tuple((column, operator)
+                       for column, operator, value in predicates))
+        return self._query_prepared(shape, sql, tuple(params))
+
+    def stream_rows(self, var_name, table_name, chunk_size=1000):
+        """all rows of the table read chunk by chunk, see RowStream
+          *raise DBBusyError if max_streams streams are open
+        """
+        if chunk_size < 1:
+            raise ValueError(f'Invalid chunk size {chunk_size}.')
+        # Named cursors can not DECLARE over EXECUTE, no prepared statement
+        shape, sql = self._select(var_name, table_name)
+        return RowStream(self, sql, chunk_size)
+
+    def _identifier(self, name):
+        # Unquoted names in create_table are folded to lower case
+        if not IDENTIFIER.match(name):
+            raise ValueError(f'Invalid identifier "{name}".')
+        return psql_sql.Identifier(name.lower())
+
+    def _select(self, var_name, table_name):
+        """(shape, sql) of SELECT var_name FROM table_name
+        """
+        self._check_table(table_name)
+        columns = self._column_names(var_name)
+        if columns == '*':
+            columns_sql = psql_sql.SQL('*')
+        else:
+            columns_sql = psql_sql.SQL(", ").join(
+                map(self._identifier, columns))
+        sql = psql_sql.SQL("SELECT {} FROM {}").format(
+            columns_sql, self._identifier(table_name))
+        return ('select', table_name, columns), sql
+
+    def _insert_rows(self, cursor, table_name, columns, rows,
+                     page_size=1000):
+        """multi-row INSERT ... VALUES, page_size rows per statement,
+          *a single row goes through a prepared statement
+          *return ids of the rows, None if the table has no id column
+        """
+        self._check_table(table_name)
+        columns = self._column_names(columns)
+        table_sql = self._identifier(table_name)
+        columns_sql = psql_sql.SQL(", ").join(map(self._identifier, columns))
+        returning = 'id' in column_kinds(table_name)
+        returning_sql = psql_sql.SQL(" RETURNING id" if returning else "")
+        if len(rows) == 1:
+            sql = psql_sql.SQL("INSERT INTO {} ({}) VALUES ({}){}").format(
+                table_sql, columns_sql, psql_sql.SQL(", ").join(
+                    psql_sql.SQL(f"${i}")
+                    for i in range(1, len(columns) + 1)), returning_sql)
+            self._execute_prepared(cursor, ('insert', table_name, columns),
+                                   sql, tuple(rows[0]))
+            ids = cursor.fetchall() if returning else None
+        else:
+            sql = psql_sql.SQL("INSERT INTO {} ({}) VALUES %s{}").format(
+                table_sql, columns_sql, returning_sql)
+            ids = psql.extras.execute_values(
+                cursor, sql, rows, page_size=page_size, fetch=returning)
+        return [row[0] for row in ids] if returning else None
+
+    def insert_rows(self, table_name: str, columns, rows):
+        """bulk insert in one transaction
+          *columns : list of column names
+          *rows : list of value tuples
+          *return number of inserted rows
+        """
+        with self.checkout() as connection:
+            with connection.cursor() as cursor:
+                ids = self._insert_rows(cursor, table_name, columns, rows)
+            connection.commit()
+        self._send_inserted(table_name, self._column_names(columns), rows,
+                            ids)
+        return len(rows)
+
+    def execute_batch(self, operations):
+        """run operations in one transaction, nothing is committed if
+          *one of them fails
+          *operation : dict
+          *  {"action": "insert", "table": str, "columns": [str], "rows": [[]]}
+          *  {"action": "read", "table": str, "columns": [str] or "*"}
+          *return list of results: inserted row count or read rows
+        """
+        results = []
+        inserted = []
+        with self.checkout() as connection:
+            with connection.cursor() as cursor:
+                for operation in operations:
+                    action = operation.get('action')
+                    table_name = operation.get('table')
+                    if action == 'insert':
+                        inserted.append((operation, self._insert_rows(
+                            cursor, table_name, operation['columns'],
+                            operation['rows'])))
+                        results.append(len(operation['rows']))
+                    elif action == 'read':
+                        self._execute_prepared(cursor, *self._select(
+                            operation.get('columns', '*'), table_name))
+                        results.append(cursor.fetchall())
+                    else:
+                        raise ValueError(f'Invalid batch action "{action}".')
+            connection.commit()
+        for operation, ids in inserted:
+            self._send_inserted(
+                operation['table'], self._column_names(operation['columns']),
+                operation['rows'], ids)
+        return results
 
     def fill_row(self):
         return
@@ -75,259 +495,770 @@ class DB:
         return
 
     def delete_table(self, table_name):
-        self._execute_sql(f'DROP TABLE IF EXISTS "{table_name}" CASCADE;')
+        self._check_table(table_name)
+        self._execute_sql(psql_sql.SQL(
+            "DROP TABLE IF EXISTS {} CASCADE").format(
+                self._identifier(table_name)))
+        on_table_changed.send(self, table_name=table_name, change='delete')
         return True
 
-    def create_table(self, table_name: str, vars: dict):
+    def create_table(self, table_name: str, vars: dict, indexes=None):
         """create table
             table_name : str
             vars : dict - {"id" : "INT PRIMARY KEY     NOT NULL", "NAME" : "TEXT", AGE - INT}
+            indexes : dict - {"uni_code" : "btree", "codes" : "gin"},
+            created with the table or added to an existing one
         """
         if table_name in self.db_tables:
-            sql = f'CREATE TABLE IF NOT EXISTS {table_name} ('
-            current_key = 1
-            for key in vars:
-                sql += f"{key} {vars[key]}"
-                if current_key < len(vars):
-                    sql += ","
-                elif current_key == len(vars):
-                    sql += ");"
-                current_key += 1
-            self._execute_sql(sql)
+            self._execute_sql(self._create_table_sql(table_name, vars))
+            for column, method in (indexes or {}).items():
+                self.create_index(table_name, column, method)
+            on_table_changed.send(self, table_name=table_name,
+                                  change='create')
             return True
         else:
             return False
 
+    def _create_table_sql(self, table_name, vars):
+        # Column types are DDL from the code, names are validated
+        return psql_sql.SQL("CREATE TABLE IF NOT EXISTS {} ({})").format(
+            self._identifier(table_name),
+            psql_sql.SQL(", ").join(
+                psql_sql.SQL("{} {}").format(
+                    self._identifier(key), psql_sql.SQL(vars[key]))
+                for key in vars))
+
+    def create_index(self, table_name: str, column: str, method='btree'):
+        """secondary index <table>_<column>_idx, kept if it exists
+          *method : str - btree for = and range lookups, gin for array
+          *containment (@>, &&) on integer[] columns
+        """
+        self._execute_sql(self._create_index_sql(table_name, column, method))
+
+    def _create_index_sql(self, table_name, column, method):
+        self._check_table(table_name)
+        if method not in INDEX_METHODS:
+            raise ValueError(f'Invalid index method "{method}".')
+        return psql_sql.SQL(
+            "CREATE INDEX IF NOT EXISTS {} ON {} USING {} ({})").format(
+                self._identifier(f"{table_name}_{column}_idx"),
+                self._identifier(table_name), psql_sql.SQL(method),
+                self._identifier(column))
+
+    def _join_query(self, shape, tables, sql, uni_code):
+        """prepared join over the hierarchy tables, see persons_by_*
+        """
+        for table_name in tables:
+            self._check_table(table_name)
+        return self._query_prepared(shape, psql_sql.SQL(sql), (uni_code,))
+
+    def persons_by_department(self, uni_code):
+        """persons listed in department.persons_uni_codes in one statement,
+          *each once in id order, (column names, rows) or None on error
+        """
+        return self._join_query(
+            ('persons_by_department',), ('department', 'person'),
+            "SELECT p.* FROM person p WHERE p.uni_code IN ("
+            "SELECT unnest(d.persons_uni_codes) FROM department d "
+            "WHERE d.uni_code = $1) ORDER BY p.id", uni_code)
+
+    def persons_by_organization(self, uni_code):
+        """persons of all departments of the organization
+        """
+        return self._join_query(
+            ('persons_by_organization',),
+            ('organization', 'department', 'person'),
+            "SELECT p.* FROM person p WHERE p.uni_code IN ("
+            "SELECT unnest(d.persons_uni_codes) FROM organization o "
+            "JOIN department d ON d.uni_code = ANY(o.department_uni_codes) "
+            "WHERE o.uni_code = $1) ORDER BY p.id", uni_code)
+
+    def person_organizations(self, uni_code):
+        """distinct (department, organization) uni_code pairs of the
+          *person, organization NULL for departments of none, in order;
+          *array containment is answered by the GIN indexes
+        """
+        return self._join_query(
+            ('person_organizations',), ('organization', 'department'),
+            "SELECT DISTINCT d.uni_code AS department_uni_code, "
+            "o.uni_code AS organization_uni_code FROM department d "
+            "LEFT JOIN organization o "
+            "ON o.department_uni_codes @> ARRAY[d.uni_code] "
+            "WHERE d.persons_uni_codes @> ARRAY[$1::integer] "
+            "ORDER BY 1, 2", uni_code)
+
+    def salary_stats(self, group_by=None):
+        """headcount and salary_month_USD sum, avg, min and max computed by
+          *the DB, only one row per group is sent back
+          *group_by : str - one of SALARY_GROUPS, None for all persons
+          *return (column names, rows) or None on DB error
+        """
+        if group_by not in SALARY_QUERIES:
+            raise ValueError(f'Invalid group "{group_by}".')
+        tables, group_sql = SALARY_QUERIES[group_by]
+        for table_name in tables:
+            self._check_table(table_name)
+        return self._query_prepared(
+            ('salary_stats', group_by), psql_sql.SQL(group_sql))
+
+
+class RowStream:
+    """Rows of a query fetched chunk by chunk with a named server-side
+      *cursor, only one chunk is held in memory at a time
+      *holds one pooled connection until exhausted or closed, it is taken
+      *from the max_streams stream slots of the DB without waiting: a
+      *DBExecutor worker blocked on a connection held by idle streams
+      *would never let those streams fetch again
+      *fetch() and close() are blocking, run them in the DBExecutor
+    """
+    def __init__(self, data_base: DB, sql: str, chunk_size: int):
+        if not data_base._stream_slots.acquire(blocking=False):
+            raise DBBusyError(
+                f"DB stream slots are full ({data_base.max_streams} streams)")
+        self._slot = True
+        self.data_base = data_base
+        self.sql = sql
+        self.chunk_size = chunk_size
+        self.columns = None
+        self._chunks = self._read()
+        # close() from another thread waits for a running fetch()
+        self._lock = threading.Lock()
+
+    def _read(self):
+        cursor_name = f"stream_{next(self.data_base._cursor_ids)}"
+        try:
+            with self.data_base.checkout() as connection:
+                with connection.cursor(name=cursor_name) as cursor:
+                    cursor.itersize = self.chunk_size
+                    cursor.execute(self.sql)
+                    rows = cursor.fetchmany(self.chunk_size)
+                    self.columns = [column[0]
+                                    for column in cursor.description]
+                    while rows:
+                        yield rows
+                        rows = cursor.fetchmany(self.chunk_size)
+                connection.commit()
+        finally:
+            self._release()
+
+    def _release(self):
+        if self._slot:
+            self._slot = False
+            self.data_base._stream_slots.release()
+
+    def fetch(self):
+        """next list of rows, None when the result is exhausted
+        """
+        with self._lock:
+            return next(self._chunks, None)
+
+    def close(self):
+        """return the connection to the pool before the result is exhausted
+        """
+        with self._lock:
+            self._chunks.close()
+            # Not started streams do not run the finally of _read
+            self._release()
+
+
+def _create_tables(data_base, cursor):
+    for table_name, (vars, indexes) in SCHEMA.items():
+        if table_name in data_base.db_tables:
+            cursor.execute(data_base._create_table_sql(table_name, vars))
 
-def db_init(data_base: DB):
-    
+
+def _create_indexes(data_base, cursor):
+    for table_name, (vars, indexes) in SCHEMA.items():
+        if table_name in data_base.db_tables:
+            for column, method in indexes.items():
+                cursor.execute(data_base._create_index_sql(
+                    table_name, column, method))
+
+
+# Sends the change of every row as JSON on the libs.notify.CHANNEL channel
+NOTIFY_FUNCTION = """
+CREATE OR REPLACE FUNCTION notify_table_change() RETURNS trigger AS $$
+DECLARE
+    key integer;
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        key := OLD.uni_code;
+    ELSIF TG_OP IN ('INSERT', 'UPDATE') THEN
+        key := NEW.uni_code;
+    END IF;
+    IF TG_OP = 'UPDATE' AND OLD.uni_code IS DISTINCT FROM NEW.uni_code THEN
+        -- The row left the old uni_code too
+        PERFORM pg_notify('table_changes', json_build_object(
+            'table', TG_TABLE_NAME, 'change', 'update',
+            'key', OLD.uni_code,
+            'origin', current_setting('application_name'))::text);
+    END IF;
+    PERFORM pg_notify('table_changes', json_build_object(
+        'table', TG_TABLE_NAME,
+        'change', CASE TG_OP WHEN 'TRUNCATE' THEN 'delete'
+                  ELSE lower(TG_OP) END,
+        'key', key,
+        'origin', current_setting('application_name'))::text);
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql
+"""
+
+
+def _create_notify_function(data_base, cursor):
+    cursor.execute(NOTIFY_FUNCTION)
+
+
+def _create_notify_triggers(data_base, cursor):
+    _create_notify_function(data_base, cursor)
+    for table_name in SCHEMA:
+        if table_name not in data_base.db_tables:
+            continue
+        table = data_base._identifier(table_name)
+        for name, when in (
+                ("table_changes", "AFTER INSERT OR UPDATE OR DELETE ON {} "
+                 "FOR EACH ROW"),
+                ("table_truncates", "AFTER TRUNCATE ON {} "
+                 "FOR EACH STATEMENT")):
+            cursor.execute(psql_sql.SQL(
+                "DROP TRIGGER IF EXISTS {} ON {}").format(
+                    psql_sql.Identifier(name), table))
+            cursor.execute(psql_sql.SQL(
+                "CREATE TRIGGER {} " + when +
+                " EXECUTE PROCEDURE notify_table_change()").format(
+                    psql_sql.Identifier(name), table))
+
+
+# (version, description, apply(data_base, cursor)), append only; tables
+# made before schema_version existed are at version 0 and pick up the
+# missing pieces, every step is idempotent
+MIGRATIONS = (
+    (1, "organization, department and person tables", _create_tables),
+    (2, "uni_code btree and uni_codes array GIN indexes", _create_indexes),
+    (3, "NOTIFY triggers for change subscriptions", _create_notify_triggers),
+    (4, "NOTIFY the origin of changes and the old uni_code of updates",
+     _create_notify_function),
+)
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+# pg_advisory_xact_lock key, servers starting together migrate one by one
+MIGRATION_LOCK = 0x50534f52
+
+
+def migrate(data_base: DB):
+    """apply pending MIGRATIONS in one transaction, data is kept
+      *return list of applied versions, empty if the schema is current
+    """
+    applied = []
+    with data_base.checkout() as connection:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_advisory_xact_lock(%s)",
+                           (MIGRATION_LOCK,))
+            cursor.execute(
+                "CREATE TABLE IF NOT EXISTS schema_version ("
+                "version INT PRIMARY KEY, description TEXT, "
+                "applied_at TIMESTAMP NOT NULL DEFAULT now())")
+            cursor.execute(
+                "SELECT coalesce(max(version), 0) FROM schema_version")
+            current = cursor.fetchone()[0]
+            for version, description, apply in MIGRATIONS:
+                if version <= current:
+                    continue
+                log.debug(f"migrating schema to {version}: {description}")
+                apply(data_base, cursor)
+                cursor.execute(
+                    "INSERT INTO schema_version (version, description) "
+                    "VALUES (%s, %s)", (version, description))
+                applied.append(version)
+        connection.commit()
+    for table_name in data_base.db_tables:
+        on_table_changed.send(data_base, table_name=table_name,
+                              change='create')
+    return applied
+
+
+def db_init(data_base: Storage, mode='reset'):
+    """connect and prepare the schema
+      *mode : str - "reset" drops the tables and starts from one
+      *organization row, "migrate" keeps the data and only applies
+      *pending migrations, so its time does not depend on table sizes
+    """
     data_base.connect()
     try:
-        for table in data_base.db_tables:
-            data_base.delete_table(table)
-
-        data_base.create_table('organization', { 
-                        'id': "SERIAL PRIMARY KEY",
-                        'name': "TEXT NOT NULL",
-                        'uni_code': "INT NOT NULL",
-                        'department_uni_codes': "integer[]"})   
-        data_base.create_table('department', {
-                        'id': "SERIAL PRIMARY KEY",    
-                        'name': "TEXT NOT NULL",
-                        'uni_code': "INT NOT NULL",
-                        'persons_uni_codes': "integer[]"})
-        data_base.create_table('person', {
-                        'id': "SERIAL PRIMARY KEY",
-                        'name': "TEXT NOT NULL",
-                        'birth_day': "DATE NOT NULL",
-                        'salary_month_USD': "INT",
-                        'uni_code': "INT NOT NULL"})
-        data_base.insert_value(table_name='organization', var_name=('name, uni_code, department_uni_codes'), value=("'Corp', 12345, ARRAY[12345]"))
+        if mode == 'migrate':
+            data_base.migrate()
+            return data_base
+        if mode != 'reset':
+            raise ValueError(f'Invalid db_init mode "{mode}".')
+        data_base.reset()
+        data_base.migrate()
+        data_base.insert_value(table_name='organization', var_name=('name, uni_code, department_uni_codes'), value=('Corp', 12345, [12345]))
         value = data_base.read_values(table_name='organization', var_name=('name'))
         return data_base
-    except(Exception, psql.DatabaseError) as Error:
+    except Exception as Error:
             log.debug(f"DB Init Error...\n{Error}")
             return None
 
 
 
 # libs for Server side
-import io
-import json
 import types
-import struct
 import socket
-import blinker
-import selectors
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from libs.framing import RecvBuffer, FrameReader, create_message, \
+    json_encode, json_decode, negotiate_version, accepts_compression, \
+    client_version, Compressor, Decompressor
+from libs.columnar import COLUMNAR_CONTENT_TYPE, encode_columns
+from libs.cache import ResultCache
+from libs.router import Router
+from libs.admission import Admission, OverloadedError, Ticket
+
+
+class DBBusyError(OverloadedError):
+    """All DB workers are busy and the wait queue is full, or no stream
+      *slot is free"""
+
 
+class DBExecutor:
+    """Bounded thread pool for blocking DB calls, so the event loop keeps
+      *accepting and reading while queries run
+      *workers : int - threads running queries
+      *queue_depth : int - queries allowed to wait for a free worker
+    """
+    def __init__(self, workers=1, queue_depth=64):
+        self.workers = workers
+        self.queue_depth = queue_depth
+        self.pending = 0
+        self.pool = ThreadPoolExecutor(max_workers=workers,
+                                       thread_name_prefix="db")
+
+    async def run(self, func, *args, **kwargs):
+        """await func(*args, **kwargs) executed in the pool
+          *raise DBBusyError if queue is full
+        """
+        if self.pending >= self.workers + self.queue_depth:
+            raise DBBusyError(f"DB queue is full ({self.pending} pending)")
+        self.pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(
+                self.pool, functools.partial(func, *args, **kwargs)
+            )
+        finally:
+            self.pending -= 1
 
-on_request = blinker.signal('on_request')
+    def shutdown(self):
+        self.pool.shutdown(wait=False)
 
 
-class Server:
-    def __init__(self, selector, sock, addr, data_base: DB):
-        self.selector = selector
-        self.sock = sock
-        self.addr = addr
-        self._recv_buffer = b""
-        self._send_buffer = b""
-        self._jsonheader_len = None
-        self.jsonheader = None
-        self.request = None
-        self.response_created = False
+class Server(asyncio.BufferedProtocol):
+    """Per-connection protocol: data is received straight into the
+      *RecvBuffer, frames are parsed incrementally in buffer_updated
+      *and answered by a coroutine in request order. Pipelined requests
+      *carrying a request id are answered concurrently, as soon as each
+      *response is ready, with the same request id.
+      *Responses are built once and queued as frame chunks, all frames
+      *queued in one loop iteration go to the transport in one
+      *writelines(). Reading is paused while the transport buffer is over
+      *its high-water mark, so a slow reader can not grow server memory.
+    """
+    # Seconds a refused connection has to send its first request and
+    # read the answer before it is closed
+    refuse_timeout = 2.0
+
+    def __init__(self, data_base: DB, db_executor: DBExecutor,
+                 cache: ResultCache, router: Router, connections=None,
+                 write_high_water=256 * 1024, org_index=None,
+                 compressor: Compressor = None, feed=None,
+                 admission: Admission = None):
+        """connections : set - open connections of the app, for shutdown
+          *org_index : OrgIndex - hierarchy index for the tree actions
+          *feed : ChangeFeed - table changes for the subscribe action
+          *admission : Admission - limits shared by the app's connections,
+          *refused connections and requests get an "overloaded" frame
+          *compressor : Compressor - for clients accepting compressed
+          *responses, None to never compress
+          *write_high_water : int - bytes buffered for the client before
+          *reads and streams pause, they resume at a quarter of it
+        """
+        self.transport = None
+        self.addr = None
+        self._recv_buffer = RecvBuffer()
+        self._reader = FrameReader(self._recv_buffer)
+        self._requests = asyncio.Queue()
+        self._handler_task = None
+        self._tasks = set()
+        self._inflight = 0
+        self._closing = False
+        self.connections = connections if connections is not None else set()
+        self._can_write = asyncio.Event()
+        self._can_write.set()
+        self.write_high_water = write_high_water
+        self._output = []
+        self._output_size = 0
+        self._flush_handle = None
         self.data_base = data_base
         if self.data_base is None:
             raise Exception('No data_base provided')
+        self.db_executor = db_executor
+        self.cache = cache
+        self.router = router
+        self.org_index = org_index
+        self.compressor = compressor
+        self.feed = feed
+        self.admission = admission
+        self._admitted = False
+        # OverloadedError answered to a refused connection
+        self._refused = None
+        self._refusal_sent = False
+        self._refuse_timer = None
+        self._decompressor = Decompressor()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.addr = transport.get_extra_info("peername")
+        transport.set_write_buffer_limits(
+            high=self.write_high_water, low=self.write_high_water // 4)
+        if self.admission is not None:
+            try:
+                self.admission.open_connection()
+            except OverloadedError as Error:
+                # Fail fast instead of queueing behind the admitted ones
+                self._refuse(Error)
+                return
+            self._admitted = True
+        print("accepted connection from", self.addr)
+        self.connections.add(self)
+        self._handler_task = asyncio.ensure_future(self._handle_requests())
+
+    def get_buffer(self, sizehint):
+        return self._recv_buffer.get_buffer(sizehint)
+
+    def buffer_updated(self, nbytes):
+        self._recv_buffer.buffer_updated(nbytes)
+        if self._refused is not None:
+            self._read_refused()
+            return
+        self._read_requests()
+
+    def _refuse(self, error):
+        """answer the first request of the connection with error, then
+          *half-close and discard what the client still sends until it
+          *closes; closing with unread data would reset the connection and
+          *the client could lose the answer before reading it
+        """
+        self._refused = error
+        self._refuse_timer = asyncio.get_running_loop().call_later(
+            self.refuse_timeout, self._refuse_expired)
+
+    def _read_refused(self):
+        if not self._refusal_sent:
+            try:
+                frame = self._reader.read_frame()
+            except Exception:
+                # Not a frame, the answer goes as v1
+                frame = (dict(version=1), None)
+            if frame is None:
+                return
+            self._send_refusal(frame[0])
+        self._recv_buffer.consume(len(self._recv_buffer))
 
-    def _set_selector_events_mask(self, mode):
-        """Set selector to listen for events: mode is 'r', 'w', or 'rw'."""
-        if mode == "r":
-            events = selectors.EVENT_READ
-        elif mode == "w":
-            events = selectors.EVENT_WRITE
-        elif mode == "rw":
-            events = selectors.EVENT_READ | selectors.EVENT_WRITE
+    def _send_refusal(self, header):
+        self._refusal_sent = True
+        self._write_response(header, self._refused.response(), False)
+        self._flush()
+        if self.transport.can_write_eof():
+            # eof_received() closes when the client is done
+            self.transport.write_eof()
         else:
-            raise ValueError(f"Invalid events mask mode {repr(mode)}.")
-        self.selector.modify(self.sock, events, data=self)
+            self.close()
 
-    def _read(self):
+    def _refuse_expired(self):
+        if self.transport is None:
+            return
+        if not self._refusal_sent:
+            self._send_refusal(dict(version=1))
+        self.close()
+
+    def _read_requests(self):
         try:
-            data = self.sock.recv(4096)
-        except BlockingIOError:
-            # Resource temporarily unavailable
-            pass
-        else:
-            if data:
-                self._recv_buffer += data
-            else:
-                raise RuntimeError("Peer closed.")
+            # Frames received while writing is paused wait in the buffer
+            while self._can_write.is_set():
+                frame = self._reader.read_frame()
+                if frame is None:
+                    return
+                header, content = frame
+                request = self.process_request(header, content)
+                ticket = self._admit()
+                if header.get("request-id"):
+                    task = asyncio.ensure_future(
+                        self._answer(header, request, ticket))
+                    self._tasks.add(task)
+                    task.add_done_callback(self._tasks.discard)
+                    if isinstance(ticket, Ticket):
+                        # Also when cancelled before it started
+                        task.add_done_callback(self._release(ticket))
+                else:
+                    self._requests.put_nowait((header, request, ticket))
+        except Exception as Error:
+            print(
+                "main: error: exception for",
+                f"{self.addr}:\n{Error}",
+            )
+            self.close()
 
-    def _write(self):
-        if self._send_buffer:
-            print("sending", repr(self._send_buffer), "to", self.addr)
-            try:
-                # Should be ready to write
-                sent = self.sock.send(self._send_buffer)
-            except BlockingIOError:
-                # Resource temporarily unavailable (errno EWOULDBLOCK)
-                pass
-            else:
-                self._send_buffer = self._send_buffer[sent:]
-                # Close when the buffer is drained. The response has been sent.
-                if sent and not self._send_buffer:
-                    self.close()
-
-    def _json_encode(self, obj, encoding):
-        return json.dumps(obj, ensure_ascii=False).encode(encoding)
-
-    def _json_decode(self, json_bytes, encoding):
-        tiow = io.TextIOWrapper(
-            io.BytesIO(json_bytes), encoding=encoding, newline=""
-        )
-        obj = json.load(tiow)
-        tiow.close()
-        return obj
-
-    def _create_message(
-        self, *, content_bytes, content_type, content_encoding
-    ):
-        jsonheader = {
-            "byteorder": sys.byteorder,
-            "content-type": content_type,
-            "content-encoding": content_encoding,
-            "content-length": len(content_bytes),
-        }
-        jsonheader_bytes = self._json_encode(jsonheader, "utf-8")
-        message_hdr = struct.pack(">H", len(jsonheader_bytes))
-        message = message_hdr + jsonheader_bytes + content_bytes
-        return message
+    def _admit(self):
+        """Ticket of the request just read, the OverloadedError if it is
+          *refused, None without admission control
+        """
+        if self.admission is None:
+            return None
+        try:
+            return self.admission.admit(self.addr[0] if self.addr else None)
+        except OverloadedError as Error:
+            return Error
+
+    @staticmethod
+    def _release(ticket):
+        def release(task):
+            ticket.release()
+        return release
+
+    def connection_lost(self, exc):
+        print("closing connection to", self.addr)
+        self.connections.discard(self)
+        if self._refuse_timer is not None:
+            self._refuse_timer.cancel()
+        if self._admitted:
+            self._admitted = False
+            self.admission.close_connection()
+        while not self._requests.empty():
+            header, request, ticket = self._requests.get_nowait()
+            if isinstance(ticket, Ticket):
+                ticket.release()
+        if self._handler_task is not None:
+            self._handler_task.cancel()
+        for task in list(self._tasks):
+            task.cancel()
+        self.transport = None
+        self._output.clear()
+        self._can_write.set()
+
+    def pause_writing(self):
+        # Stop taking requests until the client reads its responses
+        self._can_write.clear()
+        self.transport.pause_reading()
+
+    def resume_writing(self):
+        self._can_write.set()
+        if not self._closing:
+            self.transport.resume_reading()
+            self._read_requests()
+
+    async def _drain(self):
+        """wait until the transport write buffer is below its low-water mark
+        """
+        self._flush()
+        await self._can_write.wait()
+
+    def _write(self, chunks):
+        """queue frame chunks, flushed at the end of this loop iteration
+          *or at once when the queue reaches the high-water mark
+        """
+        self._output.extend(chunks)
+        self._output_size += sum(map(len, chunks))
+        if self._output_size >= self.write_high_water:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_soon(
+                self._flush)
 
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if self._output and self.transport is not None:
+            self.transport.writelines(self._output)
+        self._output = []
+        self._output_size = 0
 
-    def _create_response_binary_content(self):
+    def _create_response_binary_content(self, request):
         response = {
             "content_bytes": b"First 10 bytes of request: "
-            + self.request[:10],
+            + request[:10],
             "content_type": "binary/custom-server-binary-type",
             "content_encoding": "binary",
         }
         return response
 
-    def process_events(self, mask):
-        if mask & selectors.EVENT_READ:
-            self.read()
-        if mask & selectors.EVENT_WRITE:
-            self.write()
-
-    def read(self):
-        self._read()
-
-        if self._jsonheader_len is None:
-            self.process_protoheader()
-
-        if self._jsonheader_len is not None:
-            if self.jsonheader is None:
-                self.process_jsonheader()
-
-        if self.jsonheader:
-            if self.request is None:
-                self.process_request()
-
-    def write(self):
-        response = None
-        if self.request:
-            response = on_request.send(self, request=self.request)
+    async def create_response(self, request, ticket=None):
+        """Build response for the request
+          *json requests go to the router, the response may be an async
+          *iterator of responses to be sent as a stream of chunk frames
+          *ticket : Ticket - in-flight slot taken while the response is
+          *built, streams are sent after it is released; OverloadedError
+          *of a refused request
+        """
+        if isinstance(ticket, OverloadedError):
+            return ticket.response()
+        if ticket is not None:
+            async with ticket:
+                return await self.create_response(request)
+        if isinstance(request, dict):
+            response = await self.router.dispatch(self, request)
         else:
-            response = self._create_response_binary_content()
-        self._send_buffer += self._create_message(**response[0][1])
-        self.response_created = True
-        self._write()
+            response = self._create_response_binary_content(request)
+        return response
 
-    def close(self):
-        """Close connection to the client
+    async def _handle_requests(self):
+        while True:
+            header, request, ticket = await self._requests.get()
+            try:
+                if not await self._answer(header, request, ticket):
+                    return
+            finally:
+                if isinstance(ticket, Ticket):
+                    ticket.release()
+
+    async def _answer(self, header, request, ticket=None):
+        """build and write the response, False if the connection is closed
         """
-        print("closing connection to", self.addr)
+        keep_alive = header.get("connection") == "keep-alive"
+        self._inflight += 1
         try:
-            self.selector.unregister(self.sock)
-        except Exception as e:
+            response = await self.create_response(request, ticket)
+            if self.transport is None:
+                return False
+            if hasattr(response, "__aiter__"):
+                await self._write_stream(header, response, keep_alive)
+            else:
+                self._write_response(header, response, keep_alive)
+        except Exception as Error:
             print(
-                f"error: selector.unregister() exception for",
-                f"{self.addr}: {repr(e)}",
+                "main: error: exception for",
+                f"{self.addr}:\n{Error}",
             )
+            self.close()
+            return False
+        finally:
+            self._inflight -= 1
+        if not keep_alive or self._closing and self._is_idle():
+            # Close when the response is flushed.
+            self.close()
+            return False
+        return True
 
+    def _is_idle(self):
+        return self._inflight == 0 and self._requests.empty()
+
+    def shutdown(self):
+        """Stop reading and close after the received requests are answered
+        """
+        self._closing = True
+        if self.transport is None:
+            return
+        self.transport.pause_reading()
+        if self._is_idle():
+            self.close()
+
+    def _write_response(self, header, response, keep_alive, stream=None,
+                        compressor=None):
+        """compressor : StreamCompressor - of the stream the frame is in
+        """
+        headers = None
+        if "protocol-versions" in header:
+            version = negotiate_version(header["protocol-versions"])
+            headers = {"protocol-version": version}
+        content = response["content_bytes"]
+        compressed = None
+        if compressor is not None:
+            compressed = compressor.compress(content)
+        elif self.compressor is not None and accepts_compression(header):
+            # Cached responses keep their compressed content
+            compressed = response.get("content_zlib")
+            if compressed is None:
+                compressed = self.compressor.compress(content)
+                if compressed is not None:
+                    self.cache.add_encoding(response, "content_zlib",
+                                            compressed)
+        if compressed is not None:
+            content = compressed
+        extra = {name: value
+                 for name, value in response.get("headers", {}).items()
+                 if value is not None}
+        if extra:
+            headers = dict(headers or {}, **extra)
+        # Answer in the version the request came in
+        self._write(create_message(
+            content_bytes=content,
+            content_type=response["content_type"],
+            content_encoding=response["content_encoding"],
+            version=header["version"],
+            request_id=header.get("request-id", 0),
+            keep_alive=keep_alive, stream=stream, headers=headers,
+            compressed=compressed is not None,
+        ))
+
+    async def _write_stream(self, header, responses, keep_alive):
+        """write responses as chunk frames followed by the end-of-stream
+          *frame, the next chunk is not produced before the transport
+          *drains, so memory stays flat for any result size
+        """
+        chunks = 0
+        result = None
+        compressor = None
+        if self.compressor is not None and accepts_compression(header):
+            compressor = self.compressor.stream()
         try:
-            self.sock.close()
-        except OSError as e:
+            async for response in responses:
+                if self.transport is None:
+                    return
+                self._write_response(header, response, keep_alive,
+                                     stream="chunk", compressor=compressor)
+                chunks += 1
+                await self._drain()
+        except Exception as Error:
             print(
-                f"error: socket.close() exception for",
-                f"{self.addr}: {repr(e)}",
+                "main: error: stream exception for",
+                f"{self.addr}:\n{Error}",
             )
+            result = f'Error: {Error}'
         finally:
-            # Delete reference to socket object for garbage collection
-            self.sock = None
-
-    def process_protoheader(self):
-        hdrlen = 2
-        if len(self._recv_buffer) >= hdrlen:
-            self._jsonheader_len = struct.unpack(
-                ">H", self._recv_buffer[:hdrlen]
-            )[0]
-            self._recv_buffer = self._recv_buffer[hdrlen:]
-
-    def process_jsonheader(self):
-        hdrlen = self._jsonheader_len
-        if len(self._recv_buffer) >= hdrlen:
-            self.jsonheader = self._json_decode(
-                self._recv_buffer[:hdrlen], "utf-8"
-            )
-            self._recv_buffer = self._recv_buffer[hdrlen:]
-            for reqhdr in (
-                "byteorder",
-                "content-length",
-                "content-type",
-                "content-encoding",
-            ):
-                if reqhdr not in self.jsonheader:
-                    raise ValueError(f'Missing required header "{reqhdr}".')
-
-    def process_request(self):
-        content_len = self.jsonheader["content-length"]
-        if not len(self._recv_buffer) >= content_len:
+            if hasattr(responses, "aclose"):
+                await responses.aclose()
+        if self.transport is None:
             return
-        data = self._recv_buffer[:content_len]
-        self._recv_buffer = self._recv_buffer[content_len:]
-        if self.jsonheader["content-type"] == "text/json":
-            encoding = self.jsonheader["content-encoding"]
-            self.request = self._json_decode(data, encoding)
-            print("received request", repr(self.request), "from", self.addr)
+        content_encoding = "utf-8"
+        end = {
+            "content_bytes": json_encode(
+                {"result": result, "chunks": chunks}, content_encoding),
+            "content_type": "text/json",
+            "content_encoding": content_encoding,
+        }
+        self._write_response(header, end, keep_alive, stream="end")
+
+    def close(self):
+        """Close connection to the client, queued responses are sent first
+        """
+        if self.transport is not None:
+            self._flush()
+            self.transport.close()
+
+    def process_request(self, header, content):
+        content = self._decompressor.decompress(header, content)
+        if header["content-type"] == "text/json":
+            encoding = header["content-encoding"]
+            request = json_decode(content, encoding)
+            print("received request", repr(request), "from", self.addr)
+            if isinstance(request, dict):
+                # Handlers keep the answers v1 clients expect
+                request["protocol-version"] = client_version(header)
         else:
-            # Binary or unknown content-type
-            self.request = data
+            # Binary or unknown content-type, copy out of the recv buffer
+            request = bytes(content)
             print(
-                f'received {self.jsonheader["content-type"]} request from',
+                f'received {header["content-type"]} request from',
                 self.addr,
             )
-        # Set selector to listen for write events, we're done reading.
-        self._set_selector_events_mask("w")
-
-
+        return request
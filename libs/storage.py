@@ -0,0 +1,286 @@
+"""
+  *storage interface of the server, engines:
+  *libs.sql_access_server.DB - PostgreSQL through psycopg2
+  *libs.memory_db.MemoryDB - in-process column arrays, no DB server
+  *
+  *the tables, page orders and write signal below are shared by both
+"""
+
+import blinker
+
+
+# sent after a write to a table: (data_base, table_name=..., change=...),
+# inserts also carry the written columns=[...] and rows=[...], led by the
+# "id" the table gave every row
+on_table_changed = blinker.signal('on_table_changed')
+
+# table -> (columns, indexes), see Storage.create_table
+SCHEMA = {
+    'organization': ({
+        'id': "SERIAL PRIMARY KEY",
+        'name': "TEXT NOT NULL",
+        'uni_code': "INT NOT NULL",
+        'department_uni_codes': "integer[]"},
+        {'uni_code': 'btree', 'department_uni_codes': 'gin'}),
+    'department': ({
+        'id': "SERIAL PRIMARY KEY",
+        'name': "TEXT NOT NULL",
+        'uni_code': "INT NOT NULL",
+        'persons_uni_codes': "integer[]"},
+        {'uni_code': 'btree', 'persons_uni_codes': 'gin'}),
+    'person': ({
+        'id': "SERIAL PRIMARY KEY",
+        'name': "TEXT NOT NULL",
+        'birth_day': "DATE NOT NULL",
+        'salary_month_USD': "INT",
+        'uni_code': "INT NOT NULL"},
+        {'uni_code': 'btree'}),
+}
+
+# read_page order -> key columns, uni_code is not unique so id breaks ties
+PAGE_ORDERS = {
+    'id': ('id',),
+    'uni_code': ('uni_code', 'id'),
+}
+
+# read_page where operator -> test of a column value against the operand,
+# the engines translate these and only these
+FILTERS = {
+    '=': lambda value, operand: value == operand,
+    '!=': lambda value, operand: value != operand,
+    '<': lambda value, operand: value < operand,
+    '<=': lambda value, operand: value <= operand,
+    '>': lambda value, operand: value > operand,
+    '>=': lambda value, operand: value >= operand,
+    'in': lambda value, operand: value in operand,
+    'contains': lambda value, operand: set(operand) <= set(value),
+}
+
+# salary_stats groups, persons are linked to them by the uni_codes arrays
+SALARY_GROUPS = (None, 'department', 'organization')
+
+INDEX_METHODS = ('btree', 'hash', 'gin', 'brin')
+
+# column kinds, by the SQL type of the column
+INT = 'int'
+DATE = 'date'
+TEXT = 'text'
+INT_ARRAY = 'int_array'
+
+
+def column_kind(sql_type):
+    """(kind, serial, not null, unique) of a column from its SQL type
+    """
+    sql_type = sql_type.upper()
+    serial = 'SERIAL' in sql_type
+    unique = 'PRIMARY KEY' in sql_type or 'UNIQUE' in sql_type
+    not_null = serial or 'NOT NULL' in sql_type or 'PRIMARY KEY' in sql_type
+    if '[]' in sql_type:
+        kind = INT_ARRAY
+    elif serial or sql_type.split()[0] in ('INT', 'INTEGER', 'BIGINT',
+                                           'SMALLINT'):
+        kind = INT
+    elif sql_type.startswith('DATE'):
+        kind = DATE
+    else:
+        kind = TEXT
+    return kind, serial, not_null, unique
+
+
+def column_kinds(table_name):
+    """lower case column name -> kind of the SCHEMA table
+    """
+    vars, indexes = SCHEMA.get(table_name, ({}, {}))
+    return {name.lower(): column_kind(sql_type)[0]
+            for name, sql_type in vars.items()}
+
+
+class Storage:
+    """tables of db_tables and the reads and writes the server runs on
+      *them; methods are blocking, the server calls them in DBExecutor
+      *threads. Writes send on_table_changed after they are committed.
+      *Reads return None if the engine fails, invalid arguments raise
+      *ValueError.
+    """
+    def __init__(self, db_tables: tuple, max_connections=4):
+        """max_connections : int - calls run at the same time, the server
+          *sizes its DB worker threads by it
+        """
+        self.db_tables = db_tables
+        self.max_connections = max_connections
+
+    def connect(self):
+        raise NotImplementedError
+
+    def close(self):
+        raise NotImplementedError
+
+    def migrate(self):
+        """create missing tables and indexes of SCHEMA, data is kept
+          *return list of applied schema versions
+        """
+        raise NotImplementedError
+
+    def reset(self):
+        """drop the tables, migrate() creates them again
+        """
+        for table_name in self.db_tables:
+            self.delete_table(table_name)
+
+    def _check_table(self, table_name):
+        if table_name not in self.db_tables:
+            raise ValueError(f'Invalid table "{table_name}".')
+
+    def _check_page(self, table_name, columns, where, order_by, after,
+                    limit):
+        """ValueError for read_page arguments of no SCHEMA column, operator
+          *or order, for a cursor of the wrong length and a limit below 1;
+          *operand types are left to the engine
+        """
+        self._check_table(table_name)
+        if order_by not in PAGE_ORDERS:
+            raise ValueError(f'Invalid order "{order_by}".')
+        if isinstance(limit, bool) or not isinstance(limit, int) \
+                or limit < 1:
+            raise ValueError(f'Invalid limit {limit!r}.')
+        if after is not None and len(after) != len(PAGE_ORDERS[order_by]):
+            raise ValueError('Invalid page cursor.')
+        kinds = column_kinds(table_name)
+        names = self._column_names(columns)
+        if names == '*':
+            names = ()
+        for name in names + tuple(where or {}):
+            if name.lower() not in kinds:
+                raise ValueError(f'Invalid column "{name}".')
+        for condition in (where or {}).values():
+            if not isinstance(condition, dict):
+                continue
+            for operator in condition:
+                if operator not in FILTERS:
+                    raise ValueError(f'Invalid operator "{operator}".')
+
+    def _column_names(self, var_name):
+        """"name, uni_code" or ["name", "uni_code"] -> tuple of names,
+          *"*" -> "*"
+        """
+        if isinstance(var_name, str):
+            if var_name.strip() == '*':
+                return '*'
+            var_name = var_name.split(',')
+        return tuple(name.strip().lower() for name in var_name)
+
+    def create_table(self, table_name: str, vars: dict, indexes=None):
+        """create table if it does not exist
+          *vars : dict - {"id": "SERIAL PRIMARY KEY", "name": "TEXT"}
+          *indexes : dict - {"uni_code": "btree", "codes": "gin"},
+          *created with the table or added to an existing one
+          *return False if table_name is not in db_tables
+        """
+        raise NotImplementedError
+
+    def create_index(self, table_name: str, column: str, method='btree'):
+        """secondary index, kept if it exists
+          *method : str - btree for = and range lookups, gin for array
+          *containment on integer[] columns
+        """
+        raise NotImplementedError
+
+    def delete_table(self, table_name):
+        raise NotImplementedError
+
+    def insert_rows(self, table_name: str, columns, rows):
+        """bulk insert in one transaction
+          *columns : list of column names
+          *rows : list of value tuples
+          *return number of inserted rows
+        """
+        raise NotImplementedError
+
+    def _send_inserted(self, table_name, columns, rows, ids):
+        """on_table_changed of an insert
+          *ids : list - ids the table gave the rows, None if it has no id
+          *column; not added if the insert wrote the ids
+        """
+        if ids is not None and 'id' not in columns:
+            columns = ('id',) + tuple(columns)
+            rows = [(row_id,) + tuple(row) for row_id, row in zip(ids, rows)]
+        on_table_changed.send(self, table_name=table_name, change='insert',
+                              columns=columns, rows=rows)
+
+    def insert_value(self, table_name: str, var_name, value):
+        """insert one row
+          *var_name : str - "name, uni_code" or list of column names
+          *value : tuple - values in var_name order
+        """
+        if table_name in self.db_tables:
+            return self.insert_rows(table_name, self._column_names(var_name),
+                                    [value])
+
+    def execute_batch(self, operations):
+        """run operations in one transaction, nothing is committed if
+          *one of them fails
+          *operation : dict
+          *  {"action": "insert", "table": str, "columns": [str], "rows": [[]]}
+          *  {"action": "read", "table": str, "columns": [str] or "*"}
+          *return list of results: inserted row count or read rows
+        """
+        raise NotImplementedError
+
+    def read_rows(self, var_name, table_name):
+        """all rows of the table as (column names, rows)
+        """
+        raise NotImplementedError
+
+    def read_values(self, var_name, table_name):
+        """first row of the table
+        """
+        answer = self.read_rows(var_name, table_name)
+        if answer is None or not answer[1]:
+            return None
+        return answer[1][0]
+
+    def read_page(self, table_name, columns='*', where=None, order_by='id',
+                  after=None, limit=100):
+        """one page of rows in order_by order, keyset pagination: the next
+          *page starts after the key of the last row
+          *where : dict - {column: value} or {column: {operator: value}},
+          *operators are FILTERS, predicates are ANDed
+          *order_by : str - key of PAGE_ORDERS
+          *after : list - key values of the last row of the previous page
+          *limit : int - rows of the page, 1 or more
+          *return (column names, rows), the key columns of order_by are
+          *appended to every row; arguments are checked by _check_page
+        """
+        raise NotImplementedError
+
+    def stream_rows(self, var_name, table_name, chunk_size=1000):
+        """rows fetched chunk by chunk, an object with columns, fetch() -
+          *next list of rows or None at the end, and close()
+        """
+        raise NotImplementedError
+
+    def persons_by_department(self, uni_code):
+        """persons listed in department.persons_uni_codes, each once, in
+          *id order
+        """
+        raise NotImplementedError
+
+    def persons_by_organization(self, uni_code):
+        """persons of all departments of the organization, each once, in
+          *id order
+        """
+        raise NotImplementedError
+
+    def person_organizations(self, uni_code):
+        """distinct (department, organization) uni_code pairs of the
+          *person in order, organization None for a department of none
+        """
+        raise NotImplementedError
+
+    def salary_stats(self, group_by=None):
+        """headcount and salary_month_USD sum, avg, min and max, one row
+          *per group uni_code in order; a person counts once per department
+          *row listing it
+          *group_by : str - one of SALARY_GROUPS, None for all persons
+        """
+        raise NotImplementedError
@@ -3,92 +3,845 @@
 """
 
 from libs.sql_access_server import *
+from libs.router import Router, HandlerError, Timing, cached, validate, \
+    json_response
+from libs.org_index import OrgIndex, TABLES as INDEX_TABLES
+from libs.storage import SALARY_GROUPS, FILTERS, INT, DATE, INT_ARRAY, \
+    column_kinds
+from libs.memory_db import MemoryDB
+from libs.notify import ChangeFeed, LocalNotifier, PgNotifier
 import logging as log
 import asyncio
 import traceback
-import selectors
-import struct
+import argparse
+import multiprocessing
+import signal
+import time
+import json
+import base64
+import datetime
 
 log.basicConfig(level=log.DEBUG)
-sel = selectors.DefaultSelector()
 
 
 class ServerApp:
-    def __init__(self, addr, data_base: DB):
+    def __init__(self, addr, data_base: Storage, db_workers=None,
+                 db_queue_depth=64, cache_entries=1024,
+                 cache_bytes=64 * 1024 * 1024, cache_ttl=5.0,
+                 init_db=True, reuse_port=False, shutdown_timeout=10.0,
+                 router=None, write_high_water=256 * 1024,
+                 db_mode='migrate', preload=False,
+                 compression_level=6, compression_threshold=1024,
+                 notifier='local', subscriber_buffer=1000,
+                 max_connections=None, max_inflight=None, max_pending=256,
+                 client_rate=None, client_burst=None):
+        """addr : (host, port)
+          *data_base : Storage - DB for PostgreSQL or MemoryDB
+          *db_workers : int - threads running DB queries,
+          *defaults to the size of the DB connection pool
+          *db_queue_depth : int - queries waiting for a free DB worker,
+          *requests over it are answered with an error
+          *cache_entries, cache_bytes, cache_ttl - read_table result cache
+          *limits, see ResultCache
+          *init_db : bool - run db_init, else only connect to the DB
+          *db_mode : str - db_init mode, "migrate" keeps the data and
+          *applies pending schema migrations, "reset" drops the tables
+          *preload : bool - read every table once after the server starts
+          *listening and keep the results cached until a write invalidates
+          *them; the org index is always loaded in the background, so
+          *startup time does not depend on the data size
+          *compression_level : int - zlib level of responses to clients
+          *accepting compression, None to never compress
+          *compression_threshold : int - smaller responses are not compressed
+          *reuse_port : bool - SO_REUSEPORT, for pre-forked workers
+          *shutdown_timeout : float - seconds open connections get to
+          *answer received requests when the server is stopped
+          *router : Router - json request actions, default server.actions
+          *write_high_water : int - bytes buffered per connection before
+          *it stops reading requests, see Server
+          *notifier : str - source of the changes pushed to subscribers,
+          *"local" the writes of this process, "pg" LISTEN/NOTIFY, which
+          *sees the writes of every process and also drops them from the
+          *result cache and brings them into the org index
+          *subscriber_buffer : int - changes buffered per subscriber before
+          *they collapse into a table reset, see Subscription
+          *max_connections, max_inflight, max_pending, client_rate,
+          *client_burst - admission limits, None for unlimited; work over
+          *them is answered with an "overloaded" frame, see Admission
+        """
         self.addr = addr
-        self.data_base = db_init(data_base)
+        self.reuse_port = reuse_port
+        self.shutdown_timeout = shutdown_timeout
+        self.router = router if router is not None else actions
+        self.write_high_water = write_high_water
+        self.compressor = None
+        if compression_level is not None:
+            self.compressor = Compressor(level=compression_level,
+                                         threshold=compression_threshold)
+        if init_db:
+            self.data_base = db_init(data_base, mode=db_mode)
+        else:
+            data_base.connect()
+            self.data_base = data_base
         if self.data_base is None:
             raise Exception(f'DB init error')
+        if db_workers is None:
+            db_workers = data_base.max_connections
+        self.db_executor = DBExecutor(workers=db_workers,
+                                      queue_depth=db_queue_depth)
+        self.cache = ResultCache(max_entries=cache_entries,
+                                 max_bytes=cache_bytes, ttl=cache_ttl)
+        on_table_changed.connect(self.cache.on_table_changed,
+                                 sender=self.data_base)
+        self.org_index = OrgIndex(self.data_base)
+        on_table_changed.connect(self.org_index.on_table_changed,
+                                 sender=self.data_base)
+        self.admission = Admission(
+            max_connections=max_connections, max_inflight=max_inflight,
+            max_pending=max_pending, rate=client_rate, burst=client_burst)
+        self.feed = ChangeFeed(max_pending=subscriber_buffer)
+        # table -> uni_codes to sync into the org index, a None key
+        # reloads it
+        self._index_changes = {}
+        self._index_task = None
+        if notifier == 'pg':
+            self.notifier = PgNotifier(self.feed, self.data_base)
+            self.feed.listen(self._on_feed_change)
+        elif notifier == 'local':
+            self.notifier = LocalNotifier(self.feed)
+            on_table_changed.connect(self.notifier.on_table_changed,
+                                     sender=self.data_base)
+        else:
+            raise ValueError(f'Invalid notifier "{notifier}".')
+        self.preload = preload
+        self.connections = set()
         self.response = None
         self.server = None
 
-    async def accept_wrapper(self, sock):
-        conn, addr = sock.accept()
-        print("accepted connection from", addr)
-        conn.setblocking(False)
-        message = Server(sel, conn, addr, self.data_base)
-        sel.register(conn, selectors.EVENT_READ, data=message)
+    def _create_protocol(self):
+        return Server(self.data_base, self.db_executor, self.cache,
+                      self.router, connections=self.connections,
+                      write_high_water=self.write_high_water,
+                      org_index=self.org_index, compressor=self.compressor,
+                      feed=self.feed, admission=self.admission)
 
     async def run_server(self):
-        lsock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        lsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        lsock.bind(self.addr)
-        lsock.listen()
+        loop = asyncio.get_running_loop()
+        self.server = await loop.create_server(
+            self._create_protocol, *self.addr, reuse_address=True,
+            reuse_port=self.reuse_port or None
+        )
         log.debug(f"listening on {self.addr}")
-        lsock.setblocking(False)
-        sel.register(lsock, selectors.EVENT_READ, data=None)
+        self.feed.start(loop)
+        self.notifier.start()
+        # Index actions answer from the DB until it is loaded
+        for table_name in INDEX_TABLES:
+            self._update_index(table_name, None)
+        preload_task = None
+        if self.preload:
+            preload_task = asyncio.ensure_future(self._preload())
         try:
-            while True:
-                events = sel.select(timeout=None)
-                for key, mask in events:
-                    if key.data is None:
-                        await self.accept_wrapper(key.fileobj)
-                    else:
-                        message = key.data
-                        try:
-                            message.process_events(mask)
-                        except Exception as Error:
-                            print(
-                                "main: error: exception for",
-                                f"{message.addr}:\n{Error}",
-                            )
-                            message.close()
+            async with self.server:
+                await self.server.serve_forever()
+        except asyncio.CancelledError:
+            log.debug(f"server on {self.addr} stopped")
+            # Subscription streams end, so their connections get idle
+            self.feed.close()
+            await self._close_connections()
         except Exception as Error:
             log.error(Error)
         finally:
-            sel.close()
-
-@on_request.connect
-def on_request(sender, **kw):
-    response = None
-    if kw['request']['action'] == 'read_table':
-        answer = sender.data_base.read_values(table_name='organization', var_name=('*'))
-        response = {"result": answer}
-    else:
-        response = {"result": f'Error: invalid action "{action}".'}
-    content_encoding = "utf-8"
-    response = {
-        "content_bytes": sender._json_encode(response, content_encoding),
-        "content_type": "text/json",
-        "content_encoding": content_encoding,
+            for task in (preload_task, self._index_task):
+                if task is not None:
+                    task.cancel()
+            self.feed.close()
+            await loop.run_in_executor(None, self.notifier.stop)
+            self.db_executor.shutdown()
+            self.data_base.close()
+
+    async def _preload(self):
+        """read every table once through the router and pin the results,
+          *so the first requests find the result cache warm however long
+          *after startup they come
+        """
+        try:
+            for table_name in self.data_base.db_tables:
+                # ServerApp has the attributes handlers use on a connection
+                await self.router.dispatch(
+                    self, dict(action='read_table', table=table_name))
+                self.cache.pin(table_name)
+        except DBBusyError as Error:
+            log.debug(f"preload stopped: {Error}")
+        log.debug("preload done")
+
+    def _on_feed_change(self, change, origin):
+        """writes of other processes, seen only through NOTIFY: drop their
+          *table from the result cache and re-read the rows into the org
+          *index, the writes of this DB got there by on_table_changed
+        """
+        if origin == self.data_base.application_name:
+            return
+        table_name = change['table']
+        self.cache.invalidate(table_name)
+        if table_name not in INDEX_TABLES:
+            return
+        self._update_index(
+            table_name, None if change['change'] == 'reset' else change['key'])
+
+    def _update_index(self, table_name, key):
+        """sync the row of the uni_code key into the org index, key None
+          *reloads the index
+        """
+        self._index_changes.setdefault(table_name, set()).add(key)
+        if self._index_task is None:
+            self._index_task = asyncio.ensure_future(self._sync_index())
+
+    async def _sync_index(self):
+        """bring the queued changes into the org index, one DB read at a
+          *time; a change without a key reloads the whole index
+        """
+        try:
+            while self._index_changes:
+                changes, self._index_changes = self._index_changes, {}
+                synced = True
+                try:
+                    if any(None in keys for keys in changes.values()):
+                        await self.db_executor.run(self.org_index.load)
+                        continue
+                    for table_name, keys in changes.items():
+                        synced = await self.db_executor.run(
+                            self.org_index.sync, table_name, keys)
+                        if not synced:
+                            break
+                except DBBusyError as Error:
+                    log.debug(f"org index sync delayed: {Error}")
+                    synced = False
+                if not synced:
+                    for table_name, keys in changes.items():
+                        self._index_changes.setdefault(
+                            table_name, set()).update(keys)
+                    await asyncio.sleep(INDEX_RETRY_DELAY)
+        finally:
+            self._index_task = None
+
+    async def _close_connections(self):
+        """let open connections answer received requests, then close them
+        """
+        for connection in list(self.connections):
+            connection.shutdown()
+        deadline = time.monotonic() + self.shutdown_timeout
+        while self.connections and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        for connection in list(self.connections):
+            connection.close()
+
+
+# Seconds before an org index sync the DB could not serve is retried
+INDEX_RETRY_DELAY = 1.0
+# Most rows a read_table page or a stream_table chunk may ask for
+PAGE_LIMIT = 10000
+PAGE_FIELDS = ('columns', 'where', 'limit', 'cursor', 'order_by')
+# INT columns are 4 byte integers in PostgreSQL
+INT_RANGE = range(-2 ** 31, 2 ** 31)
+
+
+def read_table_key(request):
+    columns = request.get('columns') or '*'
+    if not isinstance(columns, str):
+        columns = ','.join(columns)
+    return ResultCache.make_key(
+        'read_table', request.get('table') or 'organization', columns,
+        columnar=request.get('accept') == COLUMNAR_CONTENT_TYPE,
+        rows=answers_rows(request),
+        where=json.dumps(request.get('where'), sort_keys=True),
+        limit=request.get('limit'), cursor=request.get('cursor'),
+        order_by=request.get('order_by'))
+
+
+def answers_rows(request):
+    """JSON read_table of the whole table answers {"columns", "rows"} to
+      *clients of protocol v2, v1 clients get the first row as before;
+      *request["protocol-version"] is set by the server from the frame
+    """
+    return request.get('protocol-version', 1) >= 2
+
+
+def fixed_table(table_name):
+    """middleware setting request["table"] for read_<table> actions
+    """
+    def middleware(action, handler):
+        async def fixed(sender, request):
+            return await handler(sender, dict(request, table=table_name))
+        return fixed
+    return middleware
+
+
+def known_table(action, handler):
+    """middleware answering an error for request["table"] not in the DB,
+      *ahead of cached() so unknown names never make cache state
+    """
+    async def checked(sender, request):
+        table_name = request.get('table') or 'organization'
+        if table_name not in sender.data_base.db_tables:
+            raise HandlerError(f'invalid table "{table_name}".')
+        return await handler(sender, request)
+    return checked
+
+
+def indexed_columns(table_name):
+    """columns read_table may filter on
+    """
+    vars, indexes = SCHEMA.get(table_name, ({}, {}))
+    return {'id'} | {column.lower() for column in indexes}
+
+
+def encode_cursor(order_by, key):
+    """opaque next page token, the order and key of the last row
+    """
+    return base64.urlsafe_b64encode(
+        json.dumps([order_by, key]).encode()).decode()
+
+
+def decode_cursor(cursor, table_name):
+    try:
+        order_by, key = json.loads(base64.urlsafe_b64decode(cursor))
+    except Exception:
+        raise HandlerError('invalid cursor.')
+    if order_by not in PAGE_ORDERS or not isinstance(key, list) \
+            or len(key) != len(PAGE_ORDERS[order_by]):
+        raise HandlerError('invalid cursor.')
+    kinds = column_kinds(table_name)
+    for column, value in zip(PAGE_ORDERS[order_by], key):
+        if not is_value(kinds[column], value):
+            raise HandlerError('invalid cursor.')
+    return order_by, key
+
+
+def is_value(kind, value):
+    """value is a where operand or page key of a column of kind
+    """
+    if kind == INT:
+        return isinstance(value, int) and not isinstance(value, bool) \
+            and value in INT_RANGE
+    if kind == INT_ARRAY:
+        return isinstance(value, list) \
+            and all(is_value(INT, element) for element in value)
+    if kind == DATE:
+        try:
+            datetime.date.fromisoformat(value)
+        except (TypeError, ValueError):
+            return False
+        return True
+    return isinstance(value, str)
+
+
+def is_operand(kind, operator, operand):
+    """operand fits operator on a column of kind: "in" takes a list of
+      *column values, "contains" a list of elements of an integer[]
+      *column, which otherwise only compares with = and !=
+    """
+    if operator == 'in':
+        return kind != INT_ARRAY and isinstance(operand, list) \
+            and all(is_value(kind, value) for value in operand)
+    if operator == 'contains':
+        return kind == INT_ARRAY and is_value(kind, operand)
+    if kind == INT_ARRAY and operator not in ('=', '!='):
+        return False
+    return is_value(kind, operand)
+
+
+def check_page(sender, request):
+    """HandlerError for page fields the engines can not run, checked
+      *before they make a cache key or reach the DB
+    """
+    table_name = request.get('table') or 'organization'
+    if table_name not in sender.data_base.db_tables:
+        raise HandlerError(f'invalid table "{table_name}".')
+    kinds = column_kinds(table_name)
+    columns = request.get('columns') or ()
+    if not all(isinstance(column, str) for column in columns):
+        raise HandlerError('columns must be column names.')
+    unknown = set(map(str.lower, columns)) - set(kinds)
+    if unknown:
+        raise HandlerError(f'invalid columns {sorted(unknown)}.')
+    where = request.get('where') or {}
+    not_indexed = set(map(str.lower, where)) - indexed_columns(table_name)
+    if not_indexed:
+        raise HandlerError(
+            f'where on columns without an index: {sorted(not_indexed)}.')
+    for column, condition in where.items():
+        if not isinstance(condition, dict):
+            condition = {'=': condition}
+        for operator, operand in condition.items():
+            if operator not in FILTERS:
+                raise HandlerError(f'invalid operator "{operator}".')
+            if not is_operand(kinds[column.lower()], operator, operand):
+                raise HandlerError(
+                    f'invalid operand of {column} {operator}: {operand!r}.')
+    limit = request.get('limit')
+    if limit is not None and not 0 < limit <= PAGE_LIMIT:
+        raise HandlerError(f'limit must be 1..{PAGE_LIMIT}.')
+    order_by = request.get('order_by')
+    if order_by is not None and order_by not in PAGE_ORDERS:
+        raise HandlerError(f'invalid order_by "{order_by}".')
+    if request.get('cursor') is not None:
+        decode_cursor(request['cursor'], table_name)
+
+
+def page_request(action, handler):
+    """middleware checking the page fields of read_table, see check_page
+    """
+    async def checked(sender, request):
+        if any(request.get(field) is not None for field in PAGE_FIELDS):
+            check_page(sender, request)
+        return await handler(sender, request)
+    return checked
+
+
+async def read_table(sender, request):
+    """rows of the table from the result cache or the DB, as JSON
+      *{"columns", "rows"} or binary columnar content of the same rows if
+      *request["accept"] asks for it; v1 clients get the first row as
+      *JSON, see answers_rows
+      *request["table"] : str - table name, "organization" by default
+      *any of request["columns"], ["where"], ["limit"], ["cursor"] or
+      *["order_by"] reads one page instead, see read_page
+      *the table is checked by the known_table middleware
+    """
+    table_name = request.get('table') or 'organization'
+    if any(request.get(field) is not None for field in PAGE_FIELDS):
+        return await read_page(sender, request)
+    answer = await sender.db_executor.run(
+        sender.data_base.read_rows, table_name=table_name, var_name=('*'))
+    if answer is None:
+        raise HandlerError('DB read failed')
+    names, rows = answer
+    if request.get('accept') != COLUMNAR_CONTENT_TYPE:
+        if not answers_rows(request):
+            return rows[0] if rows else None
+        return {"columns": names, "rows": rows}
+    return {
+        "content_bytes": encode_columns(names, rows),
+        "content_type": COLUMNAR_CONTENT_TYPE,
+        "content_encoding": "binary",
     }
-    return response
+
+
+async def read_page(sender, request):
+    """one keyset page of request["table"]
+      *request["columns"] : list - columns to read, all by default
+      *request["where"] : dict - {column: value} or {column: {op: value}}
+      *on indexed columns, op is one of FILTERS
+      *request["order_by"] : str - "id" (default) or "uni_code"
+      *request["limit"] : int - rows per page, 100 by default
+      *request["cursor"] : str - "next" of the previous page
+      *the fields are checked by the page_request middleware
+      *JSON result is {"columns", "rows", "next"}, columnar content has the
+      *"next-cursor" header; next is None after the last page
+    """
+    table_name = request.get('table') or 'organization'
+    limit = request.get('limit')
+    if limit is None:
+        limit = 100
+    order_by = request.get('order_by') or 'id'
+    after = None
+    if request.get('cursor') is not None:
+        order_by, after = decode_cursor(request['cursor'], table_name)
+    try:
+        answer = await sender.db_executor.run(
+            sender.data_base.read_page, table_name,
+            columns=request.get('columns') or '*',
+            where=request.get('where') or {},
+            order_by=order_by, after=after, limit=limit)
+    except ValueError as Error:
+        raise HandlerError(str(Error))
+    if answer is None:
+        raise HandlerError('DB read failed')
+    names, rows = answer
+    # Key columns read_page appended to every row
+    keys = len(PAGE_ORDERS[order_by])
+    names = list(names[:-keys])
+    next_cursor = None
+    if len(rows) == limit:
+        next_cursor = encode_cursor(order_by, list(rows[-1][-keys:]))
+    rows = [row[:-keys] for row in rows]
+    if request.get('accept') != COLUMNAR_CONTENT_TYPE:
+        return {"columns": names, "rows": rows, "next": next_cursor}
+    return {
+        "content_bytes": encode_columns(names, rows),
+        "content_type": COLUMNAR_CONTENT_TYPE,
+        "content_encoding": "binary",
+        "headers": {"next-cursor": next_cursor},
+    }
+
+
+async def batch(sender, request):
+    """list of operations in request["value"] run in one DB transaction,
+      *see DB.execute_batch, result is the list of per-operation results
+    """
+    try:
+        return await sender.db_executor.run(
+            sender.data_base.execute_batch, request['value'])
+    except DBBusyError:
+        raise
+    except Exception as Error:
+        raise HandlerError(f'batch failed, nothing committed: {Error}')
+
+
+def stream_table(sender, request):
+    """whole table sent as chunk frames
+      *request["table"] : str - table name, "organization" by default
+      *request["chunk_size"] : int - rows per chunk frame, 1000 by default
+    """
+    table_name = request.get('table') or 'organization'
+    if table_name not in sender.data_base.db_tables:
+        raise HandlerError(f'invalid table "{table_name}".')
+    chunk_size = request.get('chunk_size')
+    if chunk_size is None:
+        chunk_size = 1000
+    if not 0 < chunk_size <= PAGE_LIMIT:
+        raise HandlerError(f'chunk_size must be 1..{PAGE_LIMIT}.')
+    rows = sender.data_base.stream_rows(
+        table_name=table_name, var_name=('*'), chunk_size=chunk_size)
+    columnar = request.get('accept') == COLUMNAR_CONTENT_TYPE
+    return stream_chunks(sender, rows, columnar)
+
+
+async def stream_chunks(sender, rows, columnar):
+    try:
+        while True:
+            chunk = await sender.db_executor.run(rows.fetch)
+            if chunk is None:
+                return
+            if columnar:
+                yield {
+                    "content_bytes": encode_columns(rows.columns, chunk),
+                    "content_type": COLUMNAR_CONTENT_TYPE,
+                    "content_encoding": "binary",
+                }
+            else:
+                content_encoding = "utf-8"
+                yield {
+                    "content_bytes": json_encode(
+                        {"columns": rows.columns, "result": chunk},
+                        content_encoding),
+                    "content_type": "text/json",
+                    "content_encoding": content_encoding,
+                }
+    finally:
+        # Return the DB connection if the stream is not exhausted
+        sender.db_executor.pool.submit(rows.close)
+
+
+timing = Timing()
+actions = Router(middleware=(timing,))
+page_fields = validate(
+    table=(str, type(None)),
+    columns=(list, type(None)), where=(dict, type(None)),
+    limit=(int, type(None)), cursor=(str, type(None)),
+    order_by=(str, type(None)))
+actions.add('read_table', read_table, page_fields, known_table,
+            page_request, cached(read_table_key))
+for table in ('organization', 'department', 'person'):
+    actions.add(f'read_{table}', read_table, fixed_table(table), page_fields,
+                page_request, cached(read_table_key))
+actions.add('stream_table', stream_table,
+           validate(table=(str, type(None)), chunk_size=(int, type(None))))
+actions.add('batch', batch, validate(value=list))
+actions.add('cache_stats', lambda sender, request: sender.cache.stats())
+actions.add('action_stats', lambda sender, request: timing.stats())
+
+
+def index_loaded(action, handler):
+    """middleware answering an error until the org index is loaded
+    """
+    async def loaded(sender, request):
+        if not sender.org_index.loaded:
+            raise HandlerError('org index is loading, retry later.')
+        return await handler(sender, request)
+    return loaded
+
+
+def get_org_tree(sender, request):
+    """organization request["uni_code"] with its departments and their
+      *persons, every organization if uni_code is not given
+    """
+    uni_code = request.get('uni_code')
+    tree = sender.org_index.org_tree(uni_code)
+    if tree is None:
+        raise HandlerError(f'organization {uni_code} not found.')
+    return tree
+
+
+async def _index_or_db(sender, index_query, db_query, table_name, uni_code):
+    """index_query(uni_code) once the org index is loaded, else the rows
+      *of db_query(uni_code) as dicts, None if there are none and
+      *table_name has no row of the uni_code either
+    """
+    if sender.org_index.loaded:
+        return index_query(uni_code)
+    run = sender.db_executor.run
+    answer = await run(db_query, uni_code)
+    if answer is None:
+        raise HandlerError('DB read failed')
+    names, rows = answer
+    if not rows:
+        found = await run(sender.data_base.read_page, table_name, ['id'],
+                          where={'uni_code': uni_code}, limit=1)
+        if found is None:
+            raise HandlerError('DB read failed')
+        if not found[1]:
+            return None
+    return [dict(zip(names, row)) for row in rows]
+
+
+async def get_department_persons(sender, request):
+    """persons of the departments request["uni_code"], each once in id
+      *order, from the DB while the org index is loading
+    """
+    persons = await _index_or_db(
+        sender, sender.org_index.department_persons,
+        sender.data_base.persons_by_department, 'department',
+        request['uni_code'])
+    if persons is None:
+        raise HandlerError(f'department {request["uni_code"]} not found.')
+    return persons
+
+
+async def get_organization_persons(sender, request):
+    """persons of every department of organization request["uni_code"],
+      *each once in id order, from the DB while the org index is loading
+    """
+    persons = await _index_or_db(
+        sender, sender.org_index.organization_persons,
+        sender.data_base.persons_by_organization, 'organization',
+        request['uni_code'])
+    if persons is None:
+        raise HandlerError(
+            f'organization {request["uni_code"]} not found.')
+    return persons
+
+
+async def find_person_departments(sender, request):
+    """{"department_uni_code", "organization_uni_code"} of every
+      *department listing person request["uni_code"], from the DB while
+      *the org index is loading
+    """
+    pairs = await _index_or_db(
+        sender, sender.org_index.person_departments,
+        sender.data_base.person_organizations, 'person',
+        request['uni_code'])
+    if pairs is None:
+        raise HandlerError(f'person {request["uni_code"]} not found.')
+    return pairs
+
+
+def find_person_org(sender, request):
+    """person request["uni_code"] with its department and organization
+    """
+    found = sender.org_index.person_org(request['uni_code'])
+    if found is None:
+        raise HandlerError(f'person {request["uni_code"]} not found.')
+    return found
+
+
+actions.add('get_org_tree', get_org_tree, index_loaded,
+            validate(uni_code=(int, type(None))))
+actions.add('get_department_persons', get_department_persons,
+            validate(uni_code=int))
+actions.add('get_organization_persons', get_organization_persons,
+            validate(uni_code=int))
+actions.add('find_person_departments', find_person_departments,
+            validate(uni_code=int))
+actions.add('find_person_org', find_person_org, index_loaded,
+            validate(uni_code=int))
+actions.add('org_index_stats',
+            lambda sender, request: sender.org_index.stats())
+
+
+async def salary_stats(sender, request):
+    """headcount and salary sum, avg, min and max, one row per group
+      *request["group_by"] : str - "department", "organization" or None
+      *for all persons
+      *request["source"] : str - "db" (default) aggregates in SQL,
+      *"summary" answers from the org index totals, from the DB while
+      *the index is loading
+      *result is {"count", "sum", ...} or {"columns", "rows"} if grouped
+    """
+    group_by = request.get('group_by')
+    if group_by not in SALARY_GROUPS:
+        raise HandlerError(f'invalid group_by "{group_by}".')
+    source = request.get('source') or 'db'
+    if source not in ('db', 'summary'):
+        raise HandlerError(f'invalid source "{source}".')
+    if source == 'summary' and sender.org_index.loaded:
+        answer = sender.org_index.salary_stats(group_by)
+    else:
+        answer = await sender.db_executor.run(
+            sender.data_base.salary_stats, group_by)
+    if answer is None:
+        raise HandlerError('DB read failed')
+    names, rows = answer
+    if group_by is None:
+        return dict(zip(names, rows[0]))
+    return {"columns": list(names), "rows": rows}
+
+
+def subscribe(sender, request):
+    """stream of the changes of request["tables"], all tables by default,
+      *each chunk frame result is a list of changes, see libs.notify; the
+      *first one is empty and confirms the subscription. The stream ends
+      *when the server stops, send it with a request id to keep using
+      *the connection
+    """
+    tables = request.get('tables') or list(sender.data_base.db_tables)
+    if not all(isinstance(table_name, str) for table_name in tables):
+        raise HandlerError('subscribe tables must be table names.')
+    unknown = set(tables) - set(sender.data_base.db_tables)
+    if unknown:
+        raise HandlerError(f'invalid tables {sorted(unknown)}.')
+    return change_frames(sender.feed.subscribe(tables))
+
+
+async def change_frames(subscription):
+    try:
+        yield json_response([])
+        async for changes in subscription:
+            yield json_response(changes)
+    finally:
+        subscription.close()
+
+
+actions.add('subscribe', subscribe, validate(tables=(list, type(None))))
+actions.add('feed_stats', lambda sender, request: sender.feed.stats())
+actions.add('admission_stats',
+            lambda sender, request: sender.admission.stats())
+actions.add('salary_stats', salary_stats,
+            validate(group_by=(str, type(None)), source=(str, type(None))))
+
+
+async def serve(server: ServerApp):
+    """run the server until SIGTERM or SIGINT
+    """
+    loop = asyncio.get_running_loop()
+    task = asyncio.ensure_future(server.run_server())
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, task.cancel)
+    await task
+
+
+def run_worker(server_addr, db_config, server_config):
+    """pre-forked worker process: own event loop and DB connection pool
+    """
+    data_base = DB(**db_config)
+    server = ServerApp(server_addr, data_base, init_db=False,
+                       reuse_port=True, **server_config)
+    asyncio.run(serve(server))
+
+
+class Supervisor:
+    """starts worker processes sharing the listening port with
+      *SO_REUSEPORT, restarts crashed ones and stops all of them
+      *gracefully on SIGTERM or SIGINT
+    """
+    def __init__(self, workers, server_addr, db_config, server_config):
+        self.workers = workers
+        self.args = (server_addr, db_config, server_config)
+        self.processes = {}
+        self._stopping = False
+
+    def _start(self, index):
+        process = multiprocessing.Process(
+            target=run_worker, args=self.args, name=f"worker-{index}")
+        process.start()
+        self.processes[index] = (process, time.monotonic())
+        log.debug(f"started {process.name} pid {process.pid}")
+
+    def _stop(self, signum, frame):
+        self._stopping = True
+
+    def run(self, restart_delay=1.0, stop_timeout=15.0):
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        for index in range(self.workers):
+            self._start(index)
+        while not self._stopping:
+            time.sleep(0.2)
+            for index, (process, started) in list(self.processes.items()):
+                if process.is_alive() or self._stopping:
+                    continue
+                log.error(f"{process.name} exited with {process.exitcode}")
+                # Do not spin on a worker crashing at startup
+                if time.monotonic() - started < restart_delay:
+                    time.sleep(restart_delay)
+                self._start(index)
+        log.debug("stopping workers")
+        for process, started in self.processes.values():
+            if process.is_alive():
+                process.terminate()
+        deadline = time.monotonic() + stop_timeout
+        for process, started in self.processes.values():
+            process.join(max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                log.error(f"{process.name} did not stop, killing it")
+                process.kill()
+                process.join()
 
 
 def main():
+    parser = argparse.ArgumentParser(description="PseudoOrg server")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="worker processes sharing the port")
+    parser.add_argument("--reset-db", action="store_true",
+                        help="drop and recreate the tables, default keeps "
+                        "the data and applies pending migrations")
+    parser.add_argument("--preload", action="store_true",
+                        help="warm the result cache in the background "
+                        "after startup, warmed reads stay until a write")
+    parser.add_argument("--max-connections", type=int, default=1000,
+                        help="open connections per worker")
+    parser.add_argument("--max-inflight", type=int, default=64,
+                        help="requests handled at once per worker")
+    parser.add_argument("--max-pending", type=int, default=256,
+                        help="requests waiting for an in-flight slot")
+    parser.add_argument("--client-rate", type=float, default=None,
+                        help="requests per second per client host, "
+                        "unlimited by default")
+    parser.add_argument("--storage", choices=("postgres", "memory"),
+                        default="postgres",
+                        help="memory keeps the tables in the process, no "
+                        "DB server needed, data is lost on exit")
+    args = parser.parse_args()
+    limits = dict(max_connections=args.max_connections,
+                  max_inflight=args.max_inflight,
+                  max_pending=args.max_pending, client_rate=args.client_rate)
+    db_mode = 'reset' if args.reset_db else 'migrate'
     db_tables = ('organization', 'department', 'person')
-    data_base = DB(host="172.17.0.2", db_name="postgres",
-                   user="postgres", password="secret", db_tables=db_tables)
+    db_config = dict(host="172.17.0.2", db_name="postgres",
+                     user="postgres", password="secret", db_tables=db_tables)
     server_addr = ('127.0.0.1', 8321)
-    loop = asyncio.get_event_loop()
-    server = ServerApp(server_addr, data_base)
-    loop.create_task(server.run_server())
-    loop.run_forever()
-    loop.close()
-
-    #server = Server(host="127.0.0.1", port=8321, data_base=data_base, max_clients=10)
-    #print(server)
-    #server.server_loop()
+    if args.storage == 'memory':
+        if args.workers > 1:
+            parser.error("memory storage is not shared, use one worker")
+        server = ServerApp(server_addr, MemoryDB(db_tables), db_mode=db_mode,
+                           preload=args.preload, notifier='local', **limits)
+        asyncio.run(serve(server))
+        return
+    if args.workers > 1:
+        # Tables are created once, workers only connect
+        data_base = db_init(DB(**db_config), mode=db_mode)
+        if data_base is None:
+            raise Exception(f'DB init error')
+        data_base.close()
+        # Writes through other workers reach the result cache, the org
+        # index and subscribers through NOTIFY
+        Supervisor(args.workers, server_addr, db_config,
+                   dict(preload=args.preload, notifier='pg',
+                        **limits)).run()
+        return
+    server = ServerApp(server_addr, DB(**db_config), db_mode=db_mode,
+                       preload=args.preload, notifier='pg', **limits)
+    asyncio.run(serve(server))
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,113 @@
+"""
+  *fixtures of the tests, data_base runs a test on MemoryDB and on
+  *PostgreSQL; the PostgreSQL run is skipped if no server answers
+  *
+  *PostgreSQL connection: TEST_PG_HOST, TEST_PG_PORT, TEST_PG_DB,
+  *TEST_PG_USER, TEST_PG_PASSWORD, default the server.py one
+  *python -m pytest tests
+"""
+
+import os
+import time
+import asyncio
+import functools
+import threading
+
+import pytest
+
+from libs.storage import on_table_changed
+from libs.memory_db import MemoryDB
+from libs.sql_access_server import DB, db_init
+import server
+
+try:
+    import psycopg2
+except ImportError:
+    psycopg2 = None
+
+DB_TABLES = ('organization', 'department', 'person')
+PG_CONFIG = dict(
+    host=os.environ.get('TEST_PG_HOST', '172.17.0.2'),
+    port=int(os.environ.get('TEST_PG_PORT', 5432)),
+    db_name=os.environ.get('TEST_PG_DB', 'postgres'),
+    user=os.environ.get('TEST_PG_USER', 'postgres'),
+    password=os.environ.get('TEST_PG_PASSWORD', 'secret'))
+
+
+@functools.lru_cache()
+def _postgres_missing():
+    """why the PostgreSQL tests are skipped, None if the server answers
+    """
+    if psycopg2 is None:
+        return 'psycopg2 is not installed'
+    try:
+        psycopg2.connect(
+            host=PG_CONFIG['host'], port=PG_CONFIG['port'],
+            database=PG_CONFIG['db_name'], user=PG_CONFIG['user'],
+            password=PG_CONFIG['password'], connect_timeout=3).close()
+    except psycopg2.Error as Error:
+        return f'no PostgreSQL server: {Error}'
+    return None
+
+
+def _postgres():
+    if _postgres_missing() is not None:
+        pytest.skip(_postgres_missing())
+    return DB(db_tables=DB_TABLES, **PG_CONFIG)
+
+
+@pytest.fixture(params=['memory', 'postgres'])
+def data_base(request):
+    """empty tables but the one "Corp" organization db_init adds
+    """
+    if request.param == 'memory':
+        data_base = MemoryDB(DB_TABLES)
+    else:
+        data_base = _postgres()
+    assert db_init(data_base, mode='reset') is data_base
+    yield data_base
+    data_base.close()
+
+
+@pytest.fixture
+def postgres():
+    """PostgreSQL DB with the tables of db_init, for DB-only behavior
+    """
+    data_base = _postgres()
+    assert db_init(data_base, mode='reset') is data_base
+    yield data_base
+    data_base.close()
+
+
+@pytest.fixture
+def changes(data_base):
+    """on_table_changed calls of data_base
+    """
+    sent = []
+
+    def receiver(sender, **kw):
+        sent.append(kw)
+    on_table_changed.connect(receiver, sender=data_base)
+    yield sent
+    on_table_changed.disconnect(receiver, sender=data_base)
+
+
+@pytest.fixture
+def server_app():
+    """ServerApp on a MemoryDB run in a thread, app.addr is the bound one
+    """
+    app = server.ServerApp(('127.0.0.1', 0), MemoryDB(DB_TABLES))
+    loop = asyncio.new_event_loop()
+    task = loop.create_task(app.run_server())
+    thread = threading.Thread(target=loop.run_until_complete, args=(task,),
+                              daemon=True)
+    thread.start()
+    deadline = time.monotonic() + 10
+    while app.server is None or not app.server.sockets:
+        assert time.monotonic() < deadline, 'server did not start'
+        time.sleep(0.01)
+    app.addr = app.server.sockets[0].getsockname()[:2]
+    yield app
+    loop.call_soon_threadsafe(task.cancel)
+    thread.join(10)
+    loop.close()
@@ -0,0 +1,127 @@
+"""
+  *org hierarchy actions answer the same from the org index and, while it
+  *is loading, from the DB join helpers
+"""
+
+import json
+import asyncio
+import datetime
+
+import pytest
+
+import server
+from libs.columnar import COLUMNAR_CONTENT_TYPE
+from libs.messenger_client import Connection
+
+# (action, uni_code) of the compared requests
+REQUESTS = [
+    ('get_department_persons', 1), ('get_department_persons', 3),
+    ('get_department_persons', 4), ('get_department_persons', 9),
+    ('get_organization_persons', 100), ('get_organization_persons', 200),
+    ('get_organization_persons', 12345), ('get_organization_persons', 9),
+    ('find_person_departments', 11), ('find_person_departments', 12),
+    ('find_person_departments', 14), ('find_person_departments', 9),
+]
+
+
+@pytest.fixture
+def app(data_base):
+    """ServerApp of data_base, the org index is not loaded
+    """
+    birth_day = datetime.date(1990, 1, 1)
+    data_base.insert_rows(
+        'person', ['name', 'birth_day', 'salary_month_USD', 'uni_code'], [
+            ['ann', birth_day, 1000, 11], ['bob', birth_day, 3000, 12],
+            ['cid', birth_day, None, 13], ['dan', birth_day, 2000, 12],
+            ['eve', birth_day, 500, 14]])
+    data_base.insert_rows(
+        'department', ['name', 'uni_code', 'persons_uni_codes'], [
+            ['sales', 1, [11, 12]], ['dev', 2, [12, 13]], ['lab', 3, [13]],
+            ['lab annex', 3, [11]], ['empty', 4, []]])
+    data_base.insert_rows(
+        'organization', ['name', 'uni_code', 'department_uni_codes'], [
+            ['acme', 100, [1, 2]], ['beta', 200, [2, 4]]])
+    # ServerApp opens its own connections
+    data_base.close()
+    app = server.ServerApp(('127.0.0.1', 0), data_base, init_db=False)
+    yield app
+    app.db_executor.shutdown()
+
+
+def ask(app, action, **fields):
+    response = asyncio.run(
+        app.router.dispatch(app, dict(action=action, **fields)))
+    return json.loads(response["content_bytes"])["result"]
+
+
+def names(persons):
+    return [person["name"] for person in persons]
+
+
+def test_db_fallback_answers_like_the_index(app):
+    assert not app.org_index.loaded
+    from_db = [ask(app, action, uni_code=uni_code)
+               for action, uni_code in REQUESTS]
+    app.org_index.load()
+    from_index = [ask(app, action, uni_code=uni_code)
+                  for action, uni_code in REQUESTS]
+    assert from_db == from_index
+
+
+@pytest.mark.parametrize('loaded', [False, True])
+def test_org_actions(app, loaded):
+    if loaded:
+        app.org_index.load()
+    assert names(ask(app, 'get_department_persons', uni_code=1)) == [
+        'ann', 'bob', 'dan']
+    assert names(ask(app, 'get_department_persons', uni_code=3)) == [
+        'ann', 'cid']
+    assert ask(app, 'get_department_persons', uni_code=4) == []
+    assert ask(app, 'get_department_persons', uni_code=9) == \
+        'Error: department 9 not found.'
+    assert names(ask(app, 'get_organization_persons', uni_code=100)) == [
+        'ann', 'bob', 'cid', 'dan']
+    assert ask(app, 'get_organization_persons', uni_code=12345) == []
+    assert ask(app, 'get_organization_persons', uni_code=9) == \
+        'Error: organization 9 not found.'
+    assert ask(app, 'find_person_departments', uni_code=13) == [
+        dict(department_uni_code=2, organization_uni_code=100),
+        dict(department_uni_code=2, organization_uni_code=200),
+        dict(department_uni_code=3, organization_uni_code=None)]
+    assert ask(app, 'find_person_departments', uni_code=14) == []
+    assert ask(app, 'find_person_departments', uni_code=9) == \
+        'Error: person 9 not found.'
+    assert ask(app, 'get_organization_persons', uni_code='100') == \
+        'Error: get_organization_persons uni_code has invalid type str.'
+
+
+def test_unknown_table_leaves_no_cache_state(app):
+    assert ask(app, 'read_table', table='bogus') == \
+        'Error: invalid table "bogus".'
+    assert ask(app, 'read_table', table='bogus', limit=5) == \
+        'Error: invalid table "bogus".'
+    assert app.cache.generation('bogus') == 0
+    assert 'bogus' not in app.cache._generations
+    assert ask(app, 'read_table', table='person',
+               **{'protocol-version': 2})['columns'][0] == 'id'
+
+
+@pytest.mark.parametrize('version', [1, 2])
+def test_read_table_json_shape_follows_protocol(server_app, version):
+    request = dict(type='text/json', encoding='utf-8',
+                   content=dict(action='read_table'))
+    columnar = dict(request, content=dict(action='read_table',
+                                          accept=COLUMNAR_CONTENT_TYPE))
+    server_app.data_base.insert_rows(
+        'organization', ['name', 'uni_code', 'department_uni_codes'],
+        [['acme', 100, [1, 2]], ['beta', 200, None]])
+    with Connection(*server_app.addr, timeout=10, version=version) as conn:
+        # v1 clients get the first row, as before {"columns", "rows"}
+        for _ in range(2):
+            result = conn.send(request)['result']
+            rows = conn.send(columnar).rows()
+            if version == 1:
+                assert result == list(rows[0])
+            else:
+                assert [tuple(row) for row in result['rows']] == rows
+                assert result['columns'] == conn.send(columnar).names
@@ -0,0 +1,122 @@
+"""
+  *admission limits: connections, in-flight and pending requests and the
+  *per-peer token buckets, on a clock the tests move
+"""
+
+import asyncio
+
+import pytest
+
+from libs.admission import Admission, OverloadedError, TokenBucket
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def refused(call, *args):
+    with pytest.raises(OverloadedError) as error:
+        call(*args)
+    return error.value
+
+
+def test_connection_limit():
+    admission = Admission(max_connections=2)
+    admission.open_connection()
+    admission.open_connection()
+    error = refused(admission.open_connection)
+    assert error.reason == 'too many connections'
+    assert admission.connections == 2
+    admission.close_connection()
+    admission.open_connection()
+    assert admission.stats()['refused'] == {'too many connections': 1}
+
+
+def test_overloaded_response_has_the_reason():
+    response = OverloadedError('rate limit', 0.25).response()
+    assert response['headers'] == {'overloaded': 'rate limit',
+                                   'retry-after': 0.25}
+    assert b'Error: overloaded, rate limit' in response['content_bytes']
+
+
+def test_inflight_and_pending_limits():
+    async def run():
+        admission = Admission(max_inflight=2, max_pending=1)
+        tickets = [admission.admit('a') for _ in range(3)]
+        # Two run, one waits, anything more is refused at once
+        assert refused(admission.admit, 'a').reason == 'too many requests'
+        entered = []
+
+        async def hold(ticket, release):
+            async with ticket:
+                entered.append(ticket)
+                await release.wait()
+        releases = [asyncio.Event() for _ in tickets]
+        tasks = [asyncio.ensure_future(hold(ticket, release))
+                 for ticket, release in zip(tickets, releases)]
+        await asyncio.sleep(0)
+        assert entered == tickets[:2]
+        assert admission.stats()['inflight'] == 2
+        assert admission.stats()['pending'] == 1
+        releases[0].set()
+        await asyncio.sleep(0.01)
+        assert entered == tickets
+        # The finished request freed a place in the pending work
+        extra = admission.admit('a')
+        extra.release()
+        extra.release()
+        for release in releases:
+            release.set()
+        await asyncio.gather(*tasks)
+        assert admission.stats()['inflight'] == 0
+        assert admission.stats()['pending'] == 0
+        assert admission.stats()['refused'] == {'too many requests': 1}
+    asyncio.run(run())
+
+
+def test_dropped_ticket_frees_its_place():
+    admission = Admission(max_inflight=1, max_pending=0)
+    ticket = admission.admit('a')
+    refused(admission.admit, 'a')
+    ticket.release()
+    admission.admit('a')
+
+
+def test_token_bucket_refills_up_to_burst():
+    clock = Clock()
+    bucket = TokenBucket(rate=2.0, burst=3, clock=clock)
+    assert [bucket.take() for _ in range(3)] == [0.0] * 3
+    assert bucket.take() == pytest.approx(0.5)
+    clock.now += 0.25
+    assert bucket.take() == pytest.approx(0.25)
+    clock.now += 0.25
+    assert bucket.take() == 0.0
+    # A long idle time saves up burst tokens, not more
+    clock.now += 60
+    assert [bucket.take() for _ in range(3)] == [0.0] * 3
+    assert bucket.take() > 0
+
+
+def test_rate_limit_per_peer():
+    clock = Clock()
+    admission = Admission(rate=1.0, burst=2, max_peers=2, clock=clock)
+    admission.admit('a').release()
+    admission.admit('a').release()
+    error = refused(admission.admit, 'a')
+    assert error.reason == 'rate limit'
+    assert error.retry_after == pytest.approx(1.0)
+    # Other peers have their own buckets
+    admission.admit('b').release()
+    clock.now += 1.0
+    admission.admit('a').release()
+    refused(admission.admit, 'a')
+    # The least recently used bucket is dropped, its peer starts full
+    admission.admit('c').release()
+    assert admission.stats()['peers'] == 2
+    admission.admit('b').release()
+    admission.admit('b').release()
+    assert admission.stats()['refused'] == {'rate limit': 2}
@@ -0,0 +1,56 @@
+"""
+  *binary columnar encoding of query results
+"""
+
+import datetime
+
+import pytest
+
+from libs.columnar import encode_columns, ColumnarResult, INT, TEXT, DATE, \
+    INT_ARRAY
+
+NAMES = ['id', 'name', 'birth_day', 'codes']
+ROWS = [
+    (1, 'ann', datetime.date(1990, 1, 31), [11, 12]),
+    (None, None, None, None),
+    (-2 ** 63, 'ünïcode', datetime.date(1969, 12, 31), []),
+    (2 ** 63 - 1, '', datetime.date(2100, 2, 28), [-1, 2 ** 40]),
+]
+
+
+def test_round_trip_with_nulls():
+    result = ColumnarResult(encode_columns(NAMES, ROWS))
+    assert len(result) == len(ROWS)
+    assert result.names == NAMES
+    assert result.types == [INT, TEXT, DATE, INT_ARRAY]
+    assert result.rows() == ROWS
+    assert result.validity['name'] == bytes([1, 0, 1, 1])
+    assert result.column('id')[0] == 1
+    assert result.column('name')[2] == 'ünïcode'
+    assert result.column('codes')[3].tolist() == [-1, 2 ** 40]
+
+
+def test_type_of_column_starting_with_null():
+    rows = [(None, None), (5, datetime.date(2000, 1, 1))]
+    result = ColumnarResult(encode_columns(['a', 'b'], rows))
+    assert result.types == [INT, DATE]
+    assert result.rows() == rows
+
+
+def test_all_null_and_empty_results():
+    result = ColumnarResult(encode_columns(['a'], [(None,), (None,)]))
+    assert result.rows() == [(None,), (None,)]
+    result = ColumnarResult(encode_columns(NAMES, []))
+    assert len(result) == 0
+    assert result.names == NAMES
+    assert result.rows() == []
+
+
+def test_invalid_content():
+    data = encode_columns(NAMES, ROWS)
+    with pytest.raises(ValueError):
+        ColumnarResult(b'XXXX' + data[4:])
+    with pytest.raises(ValueError):
+        ColumnarResult(data[:-1])
+    with pytest.raises(TypeError):
+        encode_columns(['a'], [(1.5,)])
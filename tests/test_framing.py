@@ -0,0 +1,259 @@
+"""
+  *framing layer: receive buffer, v1/v2 frames and compression
+"""
+
+import zlib
+
+import pytest
+
+from libs.framing import RecvBuffer, FrameReader, create_message, \
+    negotiate_version, json_encode, Compressor, Decompressor, \
+    V1_PROTOHEADER, V2_HEADER, V2_MAGIC
+from libs.messenger_client import Connection
+
+
+def receive(recv_buffer, data):
+    """data written the way asyncio does, through get_buffer()
+    """
+    while data:
+        view = recv_buffer.get_buffer(-1)
+        nbytes = min(len(view), len(data))
+        view[:nbytes] = data[:nbytes]
+        recv_buffer.buffer_updated(nbytes)
+        data = data[nbytes:]
+
+
+def test_recv_buffer_allocates_on_first_read():
+    recv_buffer = RecvBuffer()
+    assert len(recv_buffer._buffer) == 0
+    receive(recv_buffer, b'abc')
+    assert len(recv_buffer._buffer) == recv_buffer.size
+    assert bytes(recv_buffer.consume(3)) == b'abc'
+
+
+def test_recv_buffer_shrinks_after_a_large_frame():
+    recv_buffer = RecvBuffer(size=1024)
+    data = bytes(range(256)) * 400
+    receive(recv_buffer, data)
+    assert len(recv_buffer._buffer) >= len(data)
+    first = recv_buffer.consume(100)
+    rest = recv_buffer.consume(len(data) - 100)
+    # Views stay valid, the emptied buffer is small again
+    assert bytes(first) + bytes(rest) == data
+    assert len(recv_buffer) == 0
+    assert len(recv_buffer._buffer) == 1024
+    receive(recv_buffer, b'next')
+    assert bytes(recv_buffer.consume(4)) == b'next'
+    assert len(recv_buffer._buffer) == 1024
+
+
+def test_recv_buffer_keeps_partial_data_when_compacting():
+    recv_buffer = RecvBuffer(size=1024)
+    for i in range(50):
+        receive(recv_buffer, bytes([i]) * 300)
+        assert bytes(recv_buffer.consume(200)) == bytes([i]) * 200
+        assert bytes(recv_buffer.peek(100)) == bytes([i]) * 100
+        recv_buffer.consume(100)
+    assert len(recv_buffer._buffer) == 1024
+
+
+def read_frames(chunks, step=None):
+    """frames of the create_message() chunks, fed step bytes at a time,
+      *content copied out of the buffer
+    """
+    data = b''.join(bytes(chunk) for chunk in chunks)
+    step = step or len(data)
+    recv_buffer = RecvBuffer()
+    reader = FrameReader(recv_buffer)
+    frames = []
+    for start in range(0, len(data), step):
+        receive(recv_buffer, data[start:start + step])
+        frames.extend((header, bytes(content))
+                      for header, content in reader.frames())
+    return frames
+
+
+def test_v1_frame_round_trip():
+    chunks = create_message(
+        content_bytes=b'{"action": "x"}', content_type='text/json',
+        content_encoding='utf-8', keep_alive=True, request_id=7,
+        headers={'protocol-versions': [1, 2]})
+    assert len(chunks) == 3
+    [(header, content)] = read_frames(chunks)
+    assert content == b'{"action": "x"}'
+    assert header['version'] == 1
+    assert header['content-type'] == 'text/json'
+    assert header['content-encoding'] == 'utf-8'
+    assert header['connection'] == 'keep-alive'
+    assert header['request-id'] == 7
+    assert header['protocol-versions'] == [1, 2]
+
+
+def test_v2_frame_round_trip():
+    chunks = create_message(
+        content_bytes=b'\x00\x01rows', content_type='binary/columnar',
+        content_encoding='binary', version=2, keep_alive=True,
+        request_id=70000, stream='chunk', compressed=True,
+        accept_compression=True)
+    assert len(chunks) == 2
+    assert bytes(chunks[0][:2]) == V2_MAGIC
+    [(header, content)] = read_frames(chunks)
+    assert content == b'\x00\x01rows'
+    assert header['version'] == 2
+    assert header['content-type'] == 'binary/columnar'
+    assert header['content-encoding'] == 'binary'
+    assert header['connection'] == 'keep-alive'
+    assert header['request-id'] == 70000
+    assert header['stream'] == 'chunk'
+    assert header['content-compression'] == 'zlib'
+    assert header['accept-compression'] == ['zlib']
+    [(header, content)] = read_frames(create_message(
+        content_bytes=b'', content_type='text/json',
+        content_encoding='utf-8', version=2, stream='end'))
+    assert content == b''
+    assert header['stream'] == 'end'
+    assert 'connection' not in header and 'request-id' not in header
+
+
+def test_v2_sends_what_it_can_not_encode_as_v1():
+    # Extra headers and content types missing in the v2 tables
+    for fields in (dict(content_type='text/json', headers={'next': 'a'}),
+                   dict(content_type='text/plain')):
+        chunks = create_message(content_bytes=b'x', version=2,
+                                content_encoding='utf-8', **fields)
+        [(header, content)] = read_frames(chunks)
+        assert header['version'] == 1
+        assert header['content-type'] == fields['content_type']
+
+
+def test_frames_fed_a_byte_at_a_time():
+    messages = [
+        create_message(content_bytes=b'first', content_type='text/json',
+                       content_encoding='utf-8', request_id=1),
+        create_message(content_bytes=b'second' * 100, version=2,
+                       content_type='text/json', content_encoding='utf-8',
+                       request_id=2),
+        create_message(content_bytes=b'', content_type='text/json',
+                       content_encoding='utf-8', version=2, request_id=3),
+        create_message(content_bytes=b'last', content_type='text/json',
+                       content_encoding='utf-8', request_id=4),
+    ]
+    expected = read_frames([chunk for chunks in messages
+                            for chunk in chunks])
+    assert [header['request-id'] for header, content in expected] == \
+        [1, 2, 3, 4]
+    for step in (1, 2, 7):
+        assert read_frames([chunk for chunks in messages
+                            for chunk in chunks], step) == expected
+
+
+def test_partial_frame_is_not_read():
+    chunks = create_message(content_bytes=b'content', version=2,
+                            content_type='text/json',
+                            content_encoding='utf-8')
+    data = b''.join(bytes(chunk) for chunk in chunks)
+    recv_buffer = RecvBuffer()
+    reader = FrameReader(recv_buffer)
+    for byte in data[:-1]:
+        receive(recv_buffer, bytes([byte]))
+        assert reader.read_frame() is None
+    receive(recv_buffer, data[-1:])
+    header, content = reader.read_frame()
+    assert bytes(content) == b'content'
+    assert reader.read_frame() is None
+
+
+def test_invalid_frames_are_rejected():
+    with pytest.raises(ValueError):
+        read_frames([V2_MAGIC + bytes([3]) + bytes(V2_HEADER.size - 3)])
+    with pytest.raises(ValueError):
+        # v1 header without content-length
+        header = json_encode({'byteorder': 'little'}, 'utf-8')
+        read_frames([V1_PROTOHEADER.pack(len(header)), header])
+
+
+def test_negotiate_version():
+    assert negotiate_version([1, 2]) == 2
+    assert negotiate_version([2, 3]) == 2
+    assert negotiate_version([1]) == 1
+    assert negotiate_version([3]) == 1
+    assert negotiate_version([]) == 1
+
+
+@pytest.mark.parametrize('version', [1, 2])
+def test_connection_negotiates_version(server_app, version):
+    request = dict(type='text/json', encoding='utf-8',
+                   content=dict(action='cache_stats'))
+    with Connection(*server_app.addr, timeout=10, version=version) as conn:
+        # The first request is v1 and offers the versions
+        assert conn.version == 1
+        assert 'entries' in conn.send(request)['result']
+        assert conn.version == version
+        for _ in range(2):
+            assert 'entries' in conn.send(request)['result']
+            assert conn.version == version
+
+
+def compressed_frame(content, compressor, **fields):
+    """frame of content as the server sends it, read back
+    """
+    compressed = compressor.compress(content)
+    [(header, content)] = read_frames(create_message(
+        content_bytes=content if compressed is None else compressed,
+        content_type='text/json', content_encoding='utf-8',
+        compressed=compressed is not None, **fields))
+    return header, content
+
+
+@pytest.mark.parametrize('version', [1, 2])
+def test_compressed_round_trip(version):
+    compressor = Compressor(threshold=100)
+    content = b'{"rows": [' + b'[1, "name"], ' * 200 + b'[]]}'
+    header, data = compressed_frame(content, compressor, version=version)
+    assert header['content-compression'] == 'zlib'
+    assert len(data) < len(content) // 10
+    assert Decompressor().decompress(header, data) == content
+    # Small content is sent as is
+    header, data = compressed_frame(b'{}', compressor, version=version)
+    assert 'content-compression' not in header
+    assert Decompressor().decompress(header, data) == b'{}'
+
+
+def test_stream_chunks_decompress_on_arrival():
+    compressor = Compressor(threshold=100).stream()
+    decompressor = Decompressor()
+    chunk = b'{"result": [' + b'[1, "same row"], ' * 100 + b'[]]}'
+    sizes = []
+    for _ in range(3):
+        header, data = compressed_frame(chunk, compressor, version=2,
+                                        request_id=5, stream='chunk')
+        sizes.append(len(data))
+        # Every sync-flushed chunk decompresses without the next one
+        assert decompressor.decompress(header, data) == chunk
+    # Later chunks reuse the window of the earlier ones
+    assert sizes[1] < sizes[0]
+    header, data = compressed_frame(b'{"chunks": 3}', compressor,
+                                    version=2, request_id=5, stream='end')
+    assert decompressor.decompress(header, data) == b'{"chunks": 3}'
+    assert decompressor._streams == {}
+
+
+def test_decompression_is_capped_at_max_size():
+    content = b'0' * 100000
+    header = {'content-compression': 'zlib'}
+    assert Decompressor(max_size=100000).decompress(
+        header, zlib.compress(content)) == content
+    with pytest.raises(ValueError):
+        Decompressor(max_size=99999).decompress(
+            header, zlib.compress(content))
+    # Every chunk of a stream is capped
+    compressor = Compressor(threshold=1).stream()
+    decompressor = Decompressor(max_size=1000)
+    stream = {'content-compression': 'zlib', 'stream': 'chunk',
+              'request-id': 1}
+    assert decompressor.decompress(
+        stream, compressor.compress(b'1' * 1000)) == b'1' * 1000
+    with pytest.raises(ValueError):
+        decompressor.decompress(stream, compressor.compress(b'1' * 1001))
+    with pytest.raises(ValueError):
+        Decompressor().decompress({'content-compression': 'lz4'}, b'')
@@ -0,0 +1,107 @@
+"""
+  *change feed: per-row coalescing of pending changes and the collapse of
+  *a table into one "reset" change past the subscriber buffer
+"""
+
+import asyncio
+import datetime
+
+from libs.memory_db import MemoryDB
+from libs.notify import ChangeFeed, LocalNotifier
+from libs.storage import on_table_changed
+
+
+def change(table, kind, key):
+    return dict(table=table, change=kind, key=key)
+
+
+def pending(feed, tables, changes):
+    """changes a subscription to tables has pending after changes
+    """
+    async def run():
+        feed.start(asyncio.get_running_loop())
+        subscription = feed.subscribe(tables)
+        for each in changes:
+            feed.publish(each)
+        await asyncio.sleep(0)
+        return subscription
+    return asyncio.run(run())
+
+
+def test_changes_of_a_row_coalesce():
+    feed = ChangeFeed(max_pending=10)
+    subscription = pending(feed, ['person'], [
+        change('person', 'insert', 1), change('person', 'insert', 2),
+        change('organization', 'insert', 1),
+        change('person', 'update', 1), change('person', 'delete', 1)])
+    # The last change of a row wins, in the order it arrived
+    assert subscription.take() == [
+        change('person', 'insert', 2), change('person', 'delete', 1)]
+    assert subscription.coalesced == 2
+    assert feed.stats()['coalesced'] == 2
+    assert subscription.take() == []
+
+
+def test_table_change_replaces_the_row_changes():
+    feed = ChangeFeed(max_pending=10)
+    subscription = pending(feed, ['person', 'department'], [
+        change('person', 'insert', 1), change('department', 'insert', 5),
+        change('person', 'delete', None), change('person', 'insert', 2)])
+    assert subscription.take() == [
+        change('department', 'insert', 5), change('person', 'delete', None),
+        change('person', 'insert', 2)]
+
+
+def test_full_buffer_collapses_a_table_into_reset():
+    feed = ChangeFeed(max_pending=3)
+    subscription = pending(feed, ['person', 'department'], [
+        change('person', 'insert', 1), change('person', 'insert', 2),
+        change('department', 'insert', 5),
+        # Over the buffer: every person change becomes one reset
+        change('person', 'insert', 3),
+        change('person', 'update', 4), change('person', 'delete', None),
+        change('department', 'update', 6)])
+    assert subscription.take() == [
+        change('department', 'insert', 5), change('person', 'reset', None),
+        change('department', 'update', 6)]
+    assert subscription.coalesced == 4
+    # The buffer is empty again, rows are tracked one by one
+    subscription.put(change('person', 'insert', 7))
+    assert subscription.take() == [change('person', 'insert', 7)]
+
+
+def test_local_writes_reach_subscribers_coalesced():
+    data_base = MemoryDB(('organization', 'department', 'person'))
+    data_base.migrate()
+    feed = ChangeFeed(max_pending=4)
+    notifier = LocalNotifier(feed)
+    on_table_changed.connect(notifier.on_table_changed, sender=data_base)
+    birth_day = datetime.date(1990, 1, 1)
+
+    async def run():
+        feed.start(asyncio.get_running_loop())
+        subscription = feed.subscribe(['person'])
+        batches = []
+
+        async def read():
+            async for changes in subscription:
+                batches.append(changes)
+        reader = asyncio.ensure_future(read())
+        columns = ['name', 'birth_day', 'salary_month_USD', 'uni_code']
+        data_base.insert_rows('person', columns, [
+            ['ann', birth_day, 1, 11], ['bob', birth_day, 2, 11]])
+        await asyncio.sleep(0.01)
+        data_base.insert_rows('person', columns, [
+            [f'p{code}', birth_day, 1, code] for code in range(20, 30)])
+        await asyncio.sleep(0.01)
+        subscription.close()
+        await reader
+        return batches
+
+    try:
+        batches = asyncio.run(run())
+    finally:
+        on_table_changed.disconnect(notifier.on_table_changed,
+                                    sender=data_base)
+    assert batches == [[change('person', 'insert', 11)],
+                       [change('person', 'reset', None)]]
@@ -0,0 +1,175 @@
+"""
+  *keyset pages of read_page on both engines and the read_table page
+  *request checks of the server
+"""
+
+import types
+import datetime
+
+import pytest
+
+import server
+from libs.memory_db import MemoryDB
+from libs.router import HandlerError
+from libs.storage import PAGE_ORDERS, INT, TEXT, DATE, INT_ARRAY
+from libs.messenger_client import Connection
+
+PERSON_COLUMNS = ['name', 'birth_day', 'salary_month_USD', 'uni_code']
+BIRTH_DAY = datetime.date(1990, 1, 1)
+
+
+def seed(data_base, count=25):
+    data_base.insert_rows('person', PERSON_COLUMNS, [
+        [f'p{i}', BIRTH_DAY, None if i % 5 == 0 else i * 100, i % 7]
+        for i in range(count)])
+
+
+def pages(data_base, limit, **options):
+    """rows of every page, walked by the cursor of the last row
+    """
+    keys = len(PAGE_ORDERS[options.get('order_by', 'id')])
+    after = None
+    result = []
+    while True:
+        columns, rows = data_base.read_page(
+            'person', ['name'], after=after, limit=limit, **options)
+        assert len(rows) <= limit
+        result.append([row[0] for row in rows])
+        if len(rows) < limit:
+            return result
+        after = list(rows[-1][-keys:])
+
+
+@pytest.mark.parametrize('order_by', sorted(PAGE_ORDERS))
+@pytest.mark.parametrize('where', [None, {'uni_code': {'>=': 3}},
+                                   {'uni_code': {'in': [1, 6]}}])
+def test_cursor_continues_the_order(data_base, order_by, where):
+    seed(data_base)
+    columns, rows = data_base.read_rows('*', 'person')
+    columns = list(columns)
+    keys = [columns.index(key) for key in PAGE_ORDERS[order_by]]
+    code = columns.index('uni_code')
+    if where is None:
+        selected = rows
+    elif 'in' in where['uni_code']:
+        selected = [row for row in rows if row[code] in (1, 6)]
+    else:
+        selected = [row for row in rows if row[code] >= 3]
+    expected = [row[columns.index('name')] for row in sorted(
+        selected, key=lambda row: [row[key] for key in keys])]
+    for limit in (1, 4, len(expected), 100):
+        walked = pages(data_base, limit, order_by=order_by, where=where)
+        assert sum(walked, []) == expected
+        assert all(len(page) == limit for page in walked[:-1])
+
+
+def test_limit_bounds(data_base):
+    seed(data_base, 3)
+    assert len(data_base.read_page('person', limit=1)[1]) == 1
+    assert len(data_base.read_page('person', limit=10000)[1]) == 3
+    for limit in (0, -1, '5', True, None):
+        with pytest.raises(ValueError):
+            data_base.read_page('person', limit=limit)
+
+
+@pytest.mark.parametrize('options', [
+    dict(table_name='nope'),
+    dict(columns=['name', 'nope']),
+    dict(where={'nope': 1}),
+    dict(where={'uni_code': {'~': 1}}),
+    dict(where={'uni_code': {'like': 1}}),
+    dict(order_by='name'),
+    dict(order_by='uni_code', after=[1]),
+    dict(after=[1, 2]),
+])
+def test_invalid_page_arguments(data_base, options):
+    seed(data_base, 3)
+    options = dict(dict(table_name='person'), **options)
+    with pytest.raises(ValueError):
+        data_base.read_page(**options)
+
+
+@pytest.mark.parametrize('kind, value, expected', [
+    (INT, 5, True), (INT, -2 ** 31, True), (INT, 2 ** 31, False),
+    (INT, True, False), (INT, '5', False), (INT, 5.0, False),
+    (INT_ARRAY, [1, 2], True), (INT_ARRAY, [], True),
+    (INT_ARRAY, [1, '2'], False), (INT_ARRAY, 1, False),
+    (DATE, '1990-01-31', True), (DATE, '1990-02-31', False),
+    (DATE, 19900131, False),
+    (TEXT, 'ann', True), (TEXT, 1, False),
+])
+def test_is_value(kind, value, expected):
+    assert server.is_value(kind, value) is expected
+
+
+@pytest.mark.parametrize('kind, operator, operand, expected', [
+    (INT, '=', 1, True), (INT, '<', 1, True), (INT, 'in', [1, 2], True),
+    (INT, 'in', 1, False), (INT, 'in', [1, 'x'], False),
+    (INT, 'contains', [1], False),
+    (INT_ARRAY, 'contains', [1], True), (INT_ARRAY, 'contains', 1, False),
+    (INT_ARRAY, '=', [1], True), (INT_ARRAY, '!=', [1], True),
+    (INT_ARRAY, '<', [1], False), (INT_ARRAY, 'in', [[1]], False),
+    (DATE, '>=', '2000-01-01', True), (TEXT, 'in', ['a'], True),
+])
+def test_is_operand(kind, operator, operand, expected):
+    assert server.is_operand(kind, operator, operand) is expected
+
+
+def check(**request):
+    sender = types.SimpleNamespace(
+        data_base=MemoryDB(('organization', 'department', 'person')))
+    server.check_page(sender, request)
+
+
+def test_check_page_accepts_valid_requests():
+    check()
+    check(table='person', columns=['name', 'UNI_CODE'],
+          where={'uni_code': {'in': [1, 2]}, 'id': {'>': 10}},
+          limit=server.PAGE_LIMIT, order_by='uni_code')
+    check(table='department', where={'persons_uni_codes': {'contains': [1]}},
+          limit=1)
+    check(table='person',
+          cursor=server.encode_cursor('uni_code', [3, 12]))
+
+
+@pytest.mark.parametrize('request_fields, error', [
+    (dict(table='nope'), 'invalid table'),
+    (dict(columns=[1]), 'columns must be column names'),
+    (dict(columns=['nope']), 'invalid columns'),
+    (dict(table='person', where={'name': 'ann'}), 'without an index'),
+    (dict(where={'uni_code': {'~': 1}}), 'invalid operator'),
+    (dict(where={'uni_code': 'x'}), 'invalid operand'),
+    (dict(where={'uni_code': {'in': 1}}), 'invalid operand'),
+    (dict(where={'department_uni_codes': {'<': [1]}}), 'invalid operand'),
+    (dict(limit=0), 'limit must be'),
+    (dict(limit=server.PAGE_LIMIT + 1), 'limit must be'),
+    (dict(order_by='name'), 'invalid order_by'),
+    (dict(cursor='not base64!'), 'invalid cursor'),
+    (dict(cursor=server.encode_cursor('name', [1])), 'invalid cursor'),
+    (dict(cursor=server.encode_cursor('uni_code', [1])), 'invalid cursor'),
+    (dict(cursor=server.encode_cursor('id', ['1'])), 'invalid cursor'),
+])
+def test_check_page_rejects(request_fields, error):
+    with pytest.raises(HandlerError, match=error):
+        check(**request_fields)
+
+
+def test_read_table_pages_follow_next(server_app):
+    seed(server_app.data_base)
+    request = dict(type='text/json', encoding='utf-8', content=dict(
+        action='read_table', table='person', columns=['name'],
+        where={'uni_code': {'>=': 3}}, order_by='uni_code', limit=4))
+    names = []
+    with Connection(*server_app.addr, timeout=10) as conn:
+        while True:
+            result = conn.send(request)['result']
+            names.extend(row[0] for row in result['rows'])
+            if result['next'] is None:
+                break
+            request['content']['cursor'] = result['next']
+        bad = dict(request, content=dict(request['content'], limit=0))
+        assert conn.send(bad)['result'].startswith('Error: limit must be')
+    columns, rows = server_app.data_base.read_page(
+        'person', ['name'], where={'uni_code': {'>=': 3}},
+        order_by='uni_code', limit=100)
+    assert names == [row[0] for row in rows]
@@ -0,0 +1,66 @@
+"""
+  *connection pool and prepared statements of the PostgreSQL DB under
+  *concurrent calls
+"""
+
+import threading
+import concurrent.futures
+
+THREADS = 8
+READS = 240
+
+
+def backend_pid(data_base):
+    with data_base.checkout() as connection:
+        return connection.info.backend_pid
+
+
+def test_concurrent_reads_reuse_connections(postgres):
+    pids = set()
+    barrier = threading.Barrier(postgres.max_connections)
+
+    def read(i):
+        if i < postgres.max_connections:
+            # Every pooled connection is checked out at once
+            with postgres.checkout() as connection:
+                pids.add(connection.info.backend_pid)
+                barrier.wait(timeout=10)
+        if i % 2:
+            return postgres.read_rows('*', 'organization')
+        return postgres.read_page('person', where={'uni_code': i})
+
+    with concurrent.futures.ThreadPoolExecutor(THREADS) as executor:
+        results = list(executor.map(read, range(READS)))
+    assert all(result is not None for result in results)
+    assert [row[1] for row in results[1][1]] == ['Corp']
+    # The pool kept the connections open, later checkouts reuse them
+    pids.update(backend_pid(postgres) for _ in range(THREADS))
+    assert len(pids) == postgres.max_connections
+    assert len(postgres._last_used) == postgres.max_connections
+    assert len(postgres._prepared) <= postgres.max_connections
+
+
+def test_closed_connections_leave_no_prepared_names(postgres):
+    def read_closing(i):
+        answer = postgres.read_rows('*', 'organization')
+        with postgres.checkout() as connection:
+            if i % 3 == 0:
+                connection.close()
+        return answer
+
+    with concurrent.futures.ThreadPoolExecutor(THREADS) as executor:
+        results = list(executor.map(read_closing, range(READS)))
+    assert all(result is not None for result in results)
+    assert len(postgres._last_used) <= postgres.max_connections
+
+
+def test_lost_prepared_statement_is_prepared_again(postgres):
+    assert postgres.read_rows('*', 'organization') is not None
+    # The server forgets the statements, the name cache does not know
+    with postgres.checkout() as connection:
+        with connection.cursor() as cursor:
+            cursor.execute("DEALLOCATE ALL")
+        connection.commit()
+    for _ in range(2):
+        columns, rows = postgres.read_rows('*', 'organization')
+        assert [row[1] for row in rows] == ['Corp']
@@ -0,0 +1,179 @@
+"""
+  *behavior of the Storage engines, every test runs on MemoryDB and on
+  *PostgreSQL, see conftest.py
+"""
+
+import datetime
+
+import pytest
+
+try:
+    import psycopg2
+except ImportError:
+    psycopg2 = None
+
+PERSON_COLUMNS = ['name', 'birth_day', 'salary_month_USD', 'uni_code']
+# Errors of a write breaking a key constraint, per engine
+KEY_ERRORS = (ValueError,) + ((psycopg2.IntegrityError,) if psycopg2 else ())
+
+
+def person(name, salary, uni_code, birth_day='1990-01-01'):
+    return [name, datetime.date.fromisoformat(birth_day), salary, uni_code]
+
+
+def seed(data_base):
+    """departments 1 and 2 share person 12, department 3 is listed twice
+      *under uni_code 3 and belongs to no organization
+    """
+    data_base.insert_rows('person', PERSON_COLUMNS, [
+        person('ann', 1000, 11), person('bob', 3000, 12),
+        person('cid', None, 13), person('dan', 2000, 12)])
+    data_base.insert_rows(
+        'department', ['name', 'uni_code', 'persons_uni_codes'], [
+            ['sales', 1, [11, 12, 12]], ['dev', 2, [12, 13]],
+            ['lab', 3, [13]], ['lab annex', 3, [11]]])
+    data_base.insert_rows(
+        'organization', ['name', 'uni_code', 'department_uni_codes'], [
+            ['acme', 100, [1, 2]], ['beta', 200, [2]]])
+
+
+def names(answer):
+    columns, rows = answer
+    index = list(columns).index('name')
+    return [row[index] for row in rows]
+
+
+def test_insert_rows_reports_ids(data_base, changes):
+    assert data_base.insert_rows('person', PERSON_COLUMNS, [
+        person('ann', 1000, 11), person('bob', None, 12)]) == 2
+    assert data_base.insert_rows('person', PERSON_COLUMNS, [
+        person('cid', 10, 13)]) == 1
+    inserts = [change for change in changes if change['change'] == 'insert']
+    assert [change['table_name'] for change in inserts] == ['person'] * 2
+    assert inserts[0]['columns'][0] == 'id'
+    ids = [row[0] for change in inserts for row in change['rows']]
+    assert len(set(ids)) == 3
+    assert [row[1:] for row in inserts[0]['rows']] == [
+        tuple(person('ann', 1000, 11)), tuple(person('bob', None, 12))]
+
+
+def test_read_rows(data_base):
+    data_base.insert_rows('person', PERSON_COLUMNS, [
+        person('ann', 1000, 11, '1985-02-03')])
+    columns, rows = data_base.read_rows('*', 'person')
+    assert list(columns) == [
+        'id', 'name', 'birth_day', 'salary_month_usd', 'uni_code']
+    assert [tuple(row[1:]) for row in rows] == [
+        ('ann', datetime.date(1985, 2, 3), 1000, 11)]
+    columns, rows = data_base.read_rows(['uni_code', 'name'], 'person')
+    assert [tuple(row) for row in rows] == [(11, 'ann')]
+
+
+def test_read_page(data_base):
+    data_base.insert_rows('person', PERSON_COLUMNS, [
+        person(name, salary, uni_code) for name, salary, uni_code in (
+            ('a', 10, 3), ('b', 20, 1), ('c', None, 2), ('d', 40, 1),
+            ('e', 50, 2))])
+    pages = []
+    after = None
+    while True:
+        columns, rows = data_base.read_page(
+            'person', ['name'], order_by='uni_code', after=after, limit=2)
+        assert list(columns) == ['name', 'uni_code', 'id']
+        if not rows:
+            break
+        pages.append([row[0] for row in rows])
+        after = list(rows[-1][1:])
+    assert pages == [['b', 'd'], ['c', 'e'], ['a']]
+    assert names(data_base.read_page(
+        'person', where={'uni_code': {'in': [1, 3]},
+                         'salary_month_USD': {'>=': 20}})) == ['b', 'd']
+    assert names(data_base.read_page(
+        'person', where={'salary_month_usd': {'!=': 20}, 'uni_code': 2},
+        limit=10)) == ['e']
+    columns, rows = data_base.read_page('person', ['name'], limit=3)
+    assert names(data_base.read_page(
+        'person', after=[rows[-1][-1]])) == ['d', 'e']
+    with pytest.raises(ValueError):
+        data_base.read_page('person', order_by='name')
+    with pytest.raises(ValueError):
+        data_base.read_page('person', where={'uni_code': {'~': 1}})
+
+
+def test_read_page_contains(data_base):
+    seed(data_base)
+    assert names(data_base.read_page(
+        'department', where={'persons_uni_codes': {'contains': [12]}})) \
+        == ['sales', 'dev']
+
+
+def test_execute_batch(data_base, changes):
+    results = data_base.execute_batch([
+        dict(action='insert', table='person', columns=PERSON_COLUMNS,
+             rows=[person('ann', 1000, 11)]),
+        dict(action='read', table='person', columns=['name'])])
+    assert results[0] == 1
+    assert [tuple(row) for row in results[1]] == [('ann',)]
+    assert [change['table_name'] for change in changes
+            if change['change'] == 'insert'] == ['person']
+
+
+def test_execute_batch_rolls_back(data_base, changes):
+    with pytest.raises(ValueError):
+        data_base.execute_batch([
+            dict(action='insert', table='person', columns=PERSON_COLUMNS,
+                 rows=[person('ann', 1000, 11)]),
+            dict(action='drop', table='person')])
+    assert data_base.read_rows('*', 'person')[1] == []
+    assert [change for change in changes
+            if change['change'] == 'insert'] == []
+    # The table takes writes after the rollback
+    assert data_base.insert_rows('person', PERSON_COLUMNS, [
+        person('bob', 1000, 12)]) == 1
+    assert names(data_base.read_rows('*', 'person')) == ['bob']
+
+
+def test_primary_key_is_unique(data_base):
+    columns = ['id'] + PERSON_COLUMNS
+    data_base.insert_rows('person', columns, [[7] + person('ann', 1, 11)])
+    with pytest.raises(KEY_ERRORS):
+        data_base.insert_rows('person', columns, [[7] + person('bob', 2, 12)])
+    with pytest.raises(KEY_ERRORS):
+        data_base.insert_rows('person', columns, [
+            [8] + person('cid', 3, 13), [8] + person('dan', 4, 14)])
+    assert names(data_base.read_rows('*', 'person')) == ['ann']
+
+
+def test_salary_stats(data_base):
+    seed(data_base)
+    columns, rows = data_base.salary_stats()
+    assert list(columns) == ['count', 'sum', 'avg', 'min', 'max']
+    assert [tuple(row) for row in rows] == [(4, 6000, 2000.0, 1000, 3000)]
+    columns, rows = data_base.salary_stats('department')
+    assert list(columns) == ['uni_code', 'count', 'sum', 'avg', 'min', 'max']
+    assert [tuple(row) for row in rows] == [
+        (1, 3, 6000, 2000.0, 1000, 3000),
+        (2, 3, 5000, 2500.0, 2000, 3000),
+        (3, 2, 1000, 1000.0, 1000, 1000)]
+    columns, rows = data_base.salary_stats('organization')
+    assert [tuple(row) for row in rows] == [
+        (100, 6, 11000, 2200.0, 1000, 3000),
+        (200, 3, 5000, 2500.0, 2000, 3000),
+        (12345, 0, None, None, None, None)]
+    with pytest.raises(ValueError):
+        data_base.salary_stats('person')
+
+
+def test_join_helpers(data_base):
+    seed(data_base)
+    assert names(data_base.persons_by_department(1)) == ['ann', 'bob', 'dan']
+    assert names(data_base.persons_by_department(3)) == ['ann', 'cid']
+    assert names(data_base.persons_by_department(4)) == []
+    assert names(data_base.persons_by_organization(100)) == [
+        'ann', 'bob', 'cid', 'dan']
+    assert names(data_base.persons_by_organization(12345)) == []
+    columns, rows = data_base.person_organizations(12)
+    assert list(columns) == ['department_uni_code', 'organization_uni_code']
+    assert [tuple(row) for row in rows] == [(1, 100), (2, 100), (2, 200)]
+    columns, rows = data_base.person_organizations(13)
+    assert [tuple(row) for row in rows] == [(2, 100), (2, 200), (3, None)]